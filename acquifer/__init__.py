@@ -1,5 +1,6 @@
 from . import tcpip, utils, metadata # scripts excluded to avoid issue when importing clr/pythonnet in spyder # needed to be able to do from acquifer import tcpip, utils, metadata
 from .version import __version__
+from .positions import WellPositionSet
 
 class WellPosition():
 	"""
@@ -7,7 +8,7 @@ class WellPosition():
 	It also has the reference to the well and subposition, which is used when calling moveXYto(wellPosition).
 	"""
 	
-	def __init__(self, wellID:str, x:float, y:float, subposition:int = 1):
+	def __init__(self, wellID:str, x:float, y:float, subposition:int = 1, z:float = None):
 		"""
 		Create a new well position
 		
@@ -24,6 +25,9 @@ class WellPosition():
 		
 		subposition : int, optional
 			subposition index within a well, this will impact the PO tag in the filename. The default is 1.
+		
+		z : float, optional
+			Objective Z-coordinate in µm. The default is None, ie undefined.
 		"""
 		self.wellID = utils.checkWellID(wellID.upper())
 		
@@ -40,6 +44,10 @@ class WellPosition():
 		if subposition < 1:
 			raise ValueError(error)
 		
+		if z is not None and (not isinstance(z, (int, float)) or z < 0):
+			raise ValueError("z must be a positive number.")
+		
 		self.x = x
 		self.y = y
-		self.subposition = subposition
\ No newline at end of file
+		self.subposition = subposition
+		self.z = z
\ No newline at end of file
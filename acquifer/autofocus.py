@@ -0,0 +1,186 @@
+"""
+Adaptive coarse-to-fine software autofocus.
+
+A single SoftwareAutofocus command with a fixed number of slices must cover the full uncertainty on the focus with the final precision,
+ex: 61 slices every 5 µm to find the focus within +/-150 µm.
+The adaptive autofocus uses the same command, but with a few successive short sweeps :
+- a coarse sweep covering the search range with a large step,
+- if the best slice is at the edge of the sweep, the focus is likely outside of it : the sweep is shifted (up to maxShifts times),
+- then finer sweeps centered on the best slice, each dividing the step, until the step reaches the requested precision (early stopping).
+
+With the defaults (7 coarse slices every 50 µm, 5 slices per fine sweep, precision 5 µm), the focus is found within +/-150 µm at 3.1 µm precision with 27 slices,
+instead of about 100 slices for a single sweep with the same range and precision.
+Statistics are recorded for every autofocus (number of sweeps and slices, shifts, duration) to tune the speed against the accuracy.
+
+import acquifer
+from acquifer.autofocus import AdaptiveAutofocus
+
+myIM = acquifer.TcpIp()
+autofocus = AdaptiveAutofocus(myIM, objective=2, lightSource="bf", detectionFilter=1, intensity=50, exposure=10, precision=5)
+
+myIM.moveXYto(14.160, 11.287)
+zFocus = autofocus.run(21500, label="A001")
+autofocus.exportStatistics("autofocus.csv")
+"""
+import csv
+import math
+import time
+import logging
+from .tcpip import checkChannelParameters, checkLightSource, checkZstackParameters, isNumber, isPositiveInteger
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class AdaptiveAutofocus(object):
+	"""
+	Coarse-to-fine software autofocus, with edge shifting and early stopping, built on the SoftwareAutofocus command of TcpIp.runSoftwareAutoFocus.
+	The objective and light-source are set once per run, only the SoftwareAutofocus command is sent for each sweep.
+	"""
+
+	def __init__(self, im, objective, lightSource, detectionFilter, intensity, exposure,
+				 coarseSlices=7, coarseStep=50.0, fineSlices=5, precision=5.0, maxShifts=2, lightConstantOn=False):
+		"""
+		Parameters
+		----------
+		im : TcpIp
+			connection to the IM.
+
+		objective, lightSource, detectionFilter, intensity, exposure, lightConstantOn :
+			autofocus channel, see TcpIp.runSoftwareAutoFocus.
+
+		coarseSlices : int, optional
+			number of slices of the coarse sweep (odd, such that a slice is acquired at the center). The default is 7.
+
+		coarseStep : float, optional
+			step between the slices of the coarse sweep in µm. The default is 50.
+
+		fineSlices : int, optional
+			number of slices of each fine sweep (odd, at least 3). Each fine sweep spans +/- one step of the previous sweep around the best slice. The default is 5.
+
+		precision : float, optional
+			the refinement stops once the step between slices is below or equal to this value in µm. The default is 5.
+
+		maxShifts : int, optional
+			maximal number of times a sweep is shifted when the best slice is at its edge. The default is 2.
+		"""
+		checkLightSource(lightSource)
+		checkChannelParameters(1, detectionFilter, intensity, exposure, lightConstantOn)
+
+		for name, value in (("coarseSlices", coarseSlices), ("fineSlices", fineSlices)):
+			if not isPositiveInteger(value) or value < 3 or value % 2 == 0:
+				raise ValueError("{} must be an odd integer >= 3.".format(name))
+
+		if not isNumber(coarseStep) or coarseStep < 0.1:
+			raise ValueError("coarseStep must be a number >= 0.1 µm.")
+
+		if not isNumber(precision) or precision < 0.1:
+			raise ValueError("precision must be a number >= 0.1 µm.")
+
+		if not isPositiveInteger(maxShifts) and maxShifts != 0:
+			raise ValueError("maxShifts must be a positive integer.")
+
+		self.im = im
+		self.channel = (objective, lightSource, detectionFilter, intensity, exposure)
+		self.lightConstantOn = lightConstantOn
+		self.coarseSlices = coarseSlices
+		self.coarseStep = coarseStep
+		self.fineSlices = fineSlices
+		self.precision = precision
+		self.maxShifts = maxShifts
+		self.statistics = [] # one dictionary per autofocus run
+
+	def _sweep(self, zCenter, nSlices, zStep):
+		"""Run one SoftwareAutofocus sweep with the channel already set, return the best Z and whether it is at the edge of the sweep."""
+		zCenter = max(round(zCenter, 1), 0.0)
+		checkZstackParameters(zCenter, nSlices, zStep)
+		zFocus = self.im._sendSoftwareAutoFocus(zCenter, nSlices, zStep)
+		halfRange = (nSlices-1) / 2 * zStep
+		isAtEdge = abs(abs(zFocus - zCenter) - halfRange) < 0.05 + 1e-9
+		return zFocus, isAtEdge
+
+	def run(self, zCenter, label=None):
+		"""
+		Run the adaptive autofocus at the current XY-position, and return the Z-position of the focus in µm.
+
+		Parameters
+		----------
+		zCenter : float
+			center of the coarse sweep, ie expected focus position in µm.
+
+		label : str, optional
+			label of this autofocus in the statistics, ex: the well ID. The default is None.
+		"""
+		t0 = time.perf_counter()
+		zStep = self.coarseStep
+		nSweeps, nSlices, nShifts = 1, self.coarseSlices, 0
+		self.im.checkLidClosed()
+
+		# Objective and light-source set once for all the sweeps
+		with self.im._softwareAutoFocusChannel(*self.channel, self.lightConstantOn):
+
+			# Coarse sweep, shifted while the best slice is at the edge
+			zFocus, isAtEdge = self._sweep(zCenter, self.coarseSlices, zStep)
+			while isAtEdge and nShifts < self.maxShifts:
+				zFocus, isAtEdge = self._sweep(zFocus, self.coarseSlices, zStep)
+				nSweeps += 1
+				nSlices += self.coarseSlices
+				nShifts += 1
+
+			# Fine sweeps spanning +/- the previous step around the best slice, until the step reaches the precision
+			# No refinement if the focus is still at the edge, it is likely out of the search range
+			while zStep > self.precision and not isAtEdge:
+				zStep = max(round(2 * zStep / (self.fineSlices-1), 1), 0.1)
+				zFocus, _ = self._sweep(zFocus, self.fineSlices, zStep)
+				nSweeps += 1
+				nSlices += self.fineSlices
+
+		record = {"label"      : label,
+				  "zStart"     : zCenter,
+				  "zFocus"     : zFocus,
+				  "nSweeps"    : nSweeps,
+				  "nSlices"    : nSlices,
+				  "nShifts"    : nShifts,
+				  "isAtEdge"   : isAtEdge, # True if the focus is still at the edge of the coarse sweeps, ie likely outside the search range
+				  "precision"  : zStep,
+				  "duration"   : time.perf_counter() - t0}
+		self.statistics.append(record)
+
+		if isAtEdge:
+			logger.warning("Autofocus %s : focus at the edge of the search range after %d shifts (%.1f µm).", label or "", nShifts, zFocus)
+
+		logger.debug("Autofocus %s : %.1f µm, %d slices in %d sweeps, %.2f s.", label or "", zFocus, nSlices, nSweeps, record["duration"])
+		return zFocus
+
+	def __call__(self, x, y, zCenter):
+		"""Move to x,y (mm) and run the autofocus, such that the object can be used as autofocus function for focusmap.createFocusMap."""
+		self.im.moveXYto(x, y)
+		return self.run(zCenter, label="X{:.3f}-Y{:.3f}".format(x, y))
+
+	def getEquivalentSlices(self):
+		"""Return the number of slices of a single SoftwareAutofocus command with the same search range and final precision."""
+		halfRange = (self.coarseSlices-1) / 2 * self.coarseStep * (1 + 2*self.maxShifts)
+		return 2 * math.ceil(halfRange / self.precision) + 1
+
+	def summary(self):
+		"""Return the average statistics of the autofocus runs so far (number of runs, mean slices, sweeps and duration, fraction of runs at the edge)."""
+		nRuns = len(self.statistics)
+		if nRuns == 0:
+			return {"nRuns" : 0}
+
+		return {"nRuns"        : nRuns,
+				"meanSlices"   : sum(record["nSlices"]  for record in self.statistics) / nRuns,
+				"meanSweeps"   : sum(record["nSweeps"]  for record in self.statistics) / nRuns,
+				"meanDuration" : sum(record["duration"] for record in self.statistics) / nRuns,
+				"fractionShifted" : sum(record["nShifts"] > 0 for record in self.statistics) / nRuns,
+				"fractionAtEdge"  : sum(record["isAtEdge"]    for record in self.statistics) / nRuns}
+
+	def exportStatistics(self, path):
+		"""Export the statistics of every autofocus run to a .csv file, one row per run."""
+		if not path.lower().endswith(".csv"):
+			raise ValueError("Statistics can be exported as .csv file only.")
+
+		with open(path, "w", newline="") as csvFile:
+			writer = csv.DictWriter(csvFile, fieldnames=["label", "zStart", "zFocus", "nSweeps", "nSlices", "nShifts", "isAtEdge", "precision", "duration"])
+			writer.writeheader()
+			writer.writerows(self.statistics)
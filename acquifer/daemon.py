@@ -0,0 +1,365 @@
+"""
+Long-lived local daemon owning the connection to the IM, shared by several python processes.
+
+Creating a TcpIp object in every script or notebook opens a new connection, and closeConnection resets the camera, switches to live mode and turns off the lights,
+so that the next script has to set up the machine again.
+The daemon instead keeps a single TcpIp session open (with its cached state, ex: plate geometry), and serves the commands of light proxy clients over a local socket
+(a Unix socket, or a named pipe on Windows). A TcpIpProxy has the same methods as TcpIp, it connects instantly and closing it leaves the IM session untouched.
+
+Start the daemon once, in a terminal :
+python -m acquifer.daemon --port 6200
+
+Then in any script or notebook :
+from acquifer.daemon import TcpIpProxy
+
+myIM = TcpIpProxy(port=6200) # same methods as TcpIp
+myIM.moveXYto(10, 20)
+
+with myIM.exclusive(): # no command from other clients in-between
+	myIM.setMetadataWellId("A001")
+	myIM.acquire(1, 2, "bf", 1, 50, 10, 21500, 1, 0)
+
+myIM.closeConnection() # only closes the proxy, the daemon keeps the IM session
+myIM.shutdown()        # closes the IM session and stops the daemon
+
+The commands of the clients are sent to the IM one at a time, in the order they arrive.
+The arguments and results are pickled, the daemon and its clients must trust each other :
+- on Unix, the default socket is in a directory only accessible to the current user ($XDG_RUNTIME_DIR, or acquifer-<uid> in the temporary directory, with mode 0700).
+  A custom address should also be in a private directory.
+- on Windows, set an authkey : the daemon and its clients then authenticate each other before exchanging any data.
+"""
+import os
+import sys
+import stat
+import inspect
+import logging
+import pickle
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+from .tcpip import TcpIp
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def getSocketDirectory():
+	"""Return the per-user directory of the default Unix sockets : $XDG_RUNTIME_DIR if defined, otherwise acquifer-<uid> in the temporary directory."""
+	runtimeDirectory = os.environ.get("XDG_RUNTIME_DIR")
+	if runtimeDirectory and os.path.isdir(runtimeDirectory):
+		return runtimeDirectory
+	return os.path.join(tempfile.gettempdir(), "acquifer-{}".format(os.getuid()))
+
+def getDefaultAddress(port=6200):
+	"""Return the default address of the daemon for an IM port : a named pipe on Windows, a Unix socket in the per-user socket directory otherwise (see getSocketDirectory)."""
+	if sys.platform == "win32":
+		return r"\\.\pipe\acquifer-im-{}".format(port)
+	return os.path.join(getSocketDirectory(), "acquifer-im-{}.sock".format(port))
+
+def _checkSocketDirectory(address, create=False):
+	"""
+	For the default Unix socket, create its directory with mode 0700 if create is True,
+	and raise a PermissionError if the directory is not owned by the current user or is accessible to other users.
+	"""
+	if sys.platform == "win32" or os.path.dirname(address) != getSocketDirectory():
+		return
+
+	directory = os.path.dirname(address)
+	if create:
+		os.makedirs(directory, mode=0o700, exist_ok=True)
+
+	try:
+		info = os.lstat(directory)
+	except FileNotFoundError: # no daemon started yet
+		return
+
+	if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+		raise PermissionError("The socket directory {} must be a directory owned by the current user, with mode 0700.".format(directory))
+
+def _isLocalMethod(name):
+	"""Generator methods of TcpIp (ex: iterWellPositions) run in the client, calling the other methods through the proxy."""
+	return inspect.isgeneratorfunction(getattr(TcpIp, name, None))
+
+def _getRemoteMethods():
+	"""Return the names of the public TcpIp methods served by the daemon."""
+	return [name for name, function in inspect.getmembers(TcpIp, inspect.isfunction)
+			if not name.startswith("_") and name not in ("addCommandHook", "removeCommandHook", "closeConnection") and not _isLocalMethod(name)]
+
+
+class ImDaemon(object):
+	"""Server owning a TcpIp session, executing the commands of TcpIpProxy clients."""
+
+	def __init__(self, port=6200, host="localhost", address=None, authkey=None, im=None):
+		"""
+		Parameters
+		----------
+		port, host : optional
+			address of the IM control software, see TcpIp. The default is localhost, port 6200.
+
+		address : str, optional
+			local socket (Unix) or named pipe (Windows) the clients connect to. The default is None, ie getDefaultAddress(port).
+
+		authkey : bytes, optional
+			shared key to authenticate the daemon and the clients, recommended on Windows. The default is None, ie no authentication (the default Unix socket is only accessible to the current user).
+
+		im : TcpIp, optional
+			already open session to serve, instead of opening a new one. The default is None.
+		"""
+		self.address = address or getDefaultAddress(port)
+		self.authkey = authkey
+		_checkSocketDirectory(self.address, create=True)
+		self._removeStaleSocket() # before connecting to the IM, which may be used by a running daemon
+		self.im = im if im is not None else TcpIp(port, host)
+		self.nClients = 0
+		self.nCalls = 0
+		self._imLock = threading.RLock() # one command at a time, held across calls by TcpIpProxy.exclusive
+		self._stopEvent = threading.Event()
+		self._startEvent = threading.Event() # set once listening, or if serveForever failed to start
+		self._startError = None
+		self._listener = None
+
+	def addCommandHook(self, hook):
+		"""Register a command hook on the served TcpIp session (the hooks run in the daemon process), see TcpIp.addCommandHook."""
+		self.im.addCommandHook(hook)
+
+	def _removeStaleSocket(self):
+		"""Raise an error if a daemon is running at the address, otherwise remove the socket file left by a daemon which was not stopped properly."""
+		try:
+			Client(self.address, authkey=self.authkey).close()
+		except (ConnectionRefusedError, FileNotFoundError): # nothing listening
+			if sys.platform != "win32" and os.path.exists(self.address):
+				os.remove(self.address)
+			return
+		except (OSError, EOFError, AuthenticationError): # a daemon with another authkey
+			pass
+		raise RuntimeError("A daemon is already running at {}.".format(self.address))
+
+	def serveForever(self):
+		"""Accept clients until shutdown is called (by a client or another thread), then close the IM session."""
+		self._stopEvent.clear()
+		try:
+			_checkSocketDirectory(self.address, create=True)
+			self._removeStaleSocket()
+			self._listener = Listener(self.address, authkey=self.authkey)
+
+			if sys.platform != "win32":
+				os.chmod(self.address, 0o600)
+
+		except Exception as exception:
+			self._startError = exception
+			raise
+
+		finally:
+			self._startEvent.set()
+
+		logger.info("IM daemon listening on %s", self.address)
+		try:
+			while not self._stopEvent.is_set():
+				try:
+					connection = self._listener.accept()
+				except (OSError, EOFError) as exception: # failed authentication, or listener closed by shutdown
+					if not self._stopEvent.is_set():
+						logger.warning("Client connection refused : %s", exception)
+					continue
+
+				threading.Thread(target=self._handleClient, args=(connection,), daemon=True).start()
+		finally:
+			self._listener.close()
+			with self._imLock:
+				self.im.closeConnection()
+			logger.info("IM daemon stopped.")
+
+	def start(self):
+		"""Serve in a background thread, and return the daemon once listening. Raise the error of serveForever if it could not start."""
+		self._startEvent.clear()
+		self._startError = None
+		threading.Thread(target=self.serveForever, daemon=True).start()
+		self._startEvent.wait()
+
+		if self._startError is not None:
+			raise self._startError
+		return self
+
+	def shutdown(self):
+		"""Stop accepting clients and close the IM session, once the current command is done."""
+		self._stopEvent.set()
+		try:
+			Client(self.address, authkey=self.authkey).close() # unblock accept
+		except (OSError, EOFError):
+			pass
+
+	def _handleClient(self, connection):
+		"""Execute the requests of one client, until it disconnects."""
+		self.nClients += 1
+		nLocks = 0 # locks held by this client with exclusive, released if the client disconnects
+
+		try:
+			try:
+				connection.send({"methods" : _getRemoteMethods()})
+			except (OSError, EOFError): # client closed right away, ex: check for a running daemon
+				return
+
+			while True:
+				try:
+					request = connection.recv()
+				except (OSError, EOFError):
+					break
+
+				action = request[0]
+				if action == "lock":
+					self._imLock.acquire()
+					nLocks += 1
+					connection.send(("ok", None))
+
+				elif action == "unlock":
+					self._imLock.release()
+					nLocks -= 1
+					connection.send(("ok", None))
+
+				elif action == "shutdown":
+					connection.send(("ok", None))
+					self.shutdown()
+					break
+
+				else:
+					_, name, args, kwargs = request
+					connection.send(self._call(name, args, kwargs))
+
+		finally:
+			for _ in range(nLocks):
+				self._imLock.release()
+			connection.close()
+			self.nClients -= 1
+
+	def _call(self, name, args, kwargs):
+		"""Run a TcpIp method, and return ("ok", result) or ("error", exception)."""
+		if name not in _getRemoteMethods():
+			return ("error", AttributeError("TcpIp has no method {} served by the daemon.".format(name)))
+
+		try:
+			with self._imLock:
+				self.nCalls += 1
+				result = getattr(self.im, name)(*args, **kwargs)
+			pickle.dumps(result)
+			return ("ok", result)
+
+		except Exception as exception:
+			try:
+				pickle.dumps(exception)
+			except Exception:
+				exception = RuntimeError(repr(exception))
+			return ("error", exception)
+
+
+class TcpIpProxy(object):
+	"""Client of an ImDaemon, with the same methods as TcpIp, executed by the session of the daemon."""
+
+	def __init__(self, port=6200, address=None, authkey=None):
+		"""
+		Parameters
+		----------
+		port : int, optional
+			port of the IM, used for the default address of the daemon. The default is 6200.
+
+		address : str, optional
+			address of the daemon, see ImDaemon. The default is None, ie getDefaultAddress(port).
+
+		authkey : bytes, optional
+			key of the daemon, if any. The default is None.
+		"""
+		address = address or getDefaultAddress(port)
+		_checkSocketDirectory(address)
+		try:
+			self._connection = Client(address, authkey=authkey)
+		except (OSError, EOFError):
+			raise ConnectionError("Cannot connect to the IM daemon at {}, start it with 'python -m acquifer.daemon --port {}'.".format(address, port))
+
+		self._methods = set(self._connection.recv()["methods"])
+		self._lock = threading.Lock() # the proxy can be shared by threads of the client process
+		self._isConnected = True
+
+	def __getattr__(self, name):
+		if name.startswith("_"):
+			raise AttributeError(name)
+
+		if _isLocalMethod(name):
+			return getattr(TcpIp, name).__get__(self)
+
+		if name not in self._methods:
+			raise AttributeError("{} is not available through the IM daemon.".format(name))
+
+		def method(*args, **kwargs):
+			return self._request("call", name, args, kwargs)
+
+		method.__name__ = name
+		method.__doc__ = getattr(TcpIp, name).__doc__
+		return method
+
+	def __dir__(self):
+		return sorted(set(object.__dir__(self)) | self._methods)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.closeConnection()
+
+	def _request(self, *request):
+		if not self._isConnected:
+			raise ConnectionError("Connection to the IM daemon was closed. Create a new TcpIpProxy to establish a new connection.")
+
+		with self._lock:
+			self._connection.send(request)
+			status, result = self._connection.recv()
+
+		if status == "error":
+			raise result
+		return result
+
+	@contextmanager
+	def exclusive(self):
+		"""Context manager ensuring that no command from other clients is sent to the IM in-between the commands of the block."""
+		self._request("lock")
+		try:
+			yield self
+		finally:
+			self._request("unlock")
+
+	def addCommandHook(self, hook):
+		raise TypeError("Command hooks run in the daemon process, register them with ImDaemon.addCommandHook.")
+
+	def removeCommandHook(self, hook):
+		raise TypeError("Command hooks run in the daemon process, see ImDaemon.addCommandHook.")
+
+	def closeConnection(self):
+		"""Close the connection to the daemon. Unlike TcpIp.closeConnection, the IM session stays open with its current state."""
+		if self._isConnected:
+			self._connection.close()
+			self._isConnected = False
+
+	def shutdown(self):
+		"""Stop the daemon, closing the IM session (live mode, camera reset and lights off, see TcpIp.closeConnection)."""
+		self._request("shutdown")
+		self.closeConnection()
+
+
+def main(arguments=None):
+	import argparse
+	parser = argparse.ArgumentParser(description="Keep a connection to the IM open, and serve the commands of acquifer.daemon.TcpIpProxy clients.")
+	parser.add_argument("--port", type=int, default=6200, help="port of the IM control software (default 6200)")
+	parser.add_argument("--host", default="localhost", help="host of the IM control software (default localhost)")
+	parser.add_argument("--address", default=None, help="local socket or named pipe of the daemon (default: see getDefaultAddress)")
+	parser.add_argument("--authkey", default=None, help="key to authenticate the clients (default: none)")
+	arguments = parser.parse_args(arguments)
+
+	logging.basicConfig(level=logging.INFO)
+	authkey = arguments.authkey.encode() if arguments.authkey else None
+	daemon = ImDaemon(arguments.port, arguments.host, arguments.address, authkey)
+	try:
+		daemon.serveForever()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
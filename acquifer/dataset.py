@@ -0,0 +1,114 @@
+"""
+Select and group the images of an IM dataset based on the metadata in the image filenames.
+
+from acquifer.dataset import Dataset
+
+dataset = Dataset(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default")
+brightfield = dataset.filter(channel=1, timepoint=1)
+
+for (wellId, zSlice), images in brightfield.groupBy("well", "zSlice").items():
+	print(wellId, zSlice, images.paths)
+"""
+import os
+import numpy as np
+from . import metadata, naming
+
+# Metadata available for filtering/grouping, and the function extracting them from a filename
+metadataGetters = {"well"        : metadata.getWellId,
+				   "row"         : metadata.getWellRow,
+				   "column"      : metadata.getWellColumn,
+				   "wellNumber"  : metadata.getWellIndex,
+				   "subposition" : metadata.getWellSubPosition,
+				   "timepoint"   : metadata.getTimepoint,
+				   "channel"     : metadata.getChannelIndex,
+				   "zSlice"      : metadata.getZSlice}
+
+def isImageFilename(filename):
+	"""Return True if the filename follows the IM naming convention, ex: '-A001--PO01--LO001--CO6--SL001--...--WE00001.tif'."""
+	return filename.startswith("-") and filename.lower().endswith(".tif") and "--PO" in filename and "--WE" in filename
+
+def _getMetadataGetter(key):
+	if key not in metadataGetters:
+		raise ValueError("Unknown metadata '{}', should be one of {}.".format(key, list(metadataGetters)))
+	return metadataGetters[key]
+
+def _getValueArrays(filenames, keys):
+	"""Return a dictionary metadata name -> numpy array of values for the filenames, decoded at once (see naming.decodeArray)."""
+	for key in keys:
+		_getMetadataGetter(key)
+	return naming.decodeArray(filenames, keys)
+
+
+class Dataset(object):
+	"""Collection of IM image files, which can be filtered and grouped by filename metadata."""
+
+	def __init__(self, directory, filenames=None):
+		"""
+		Parameters
+		----------
+		directory : str
+			directory containing the images.
+
+		filenames : list of str, optional
+			image filenames within the directory. The default is None, ie all IM images in the directory (sorted by name).
+		"""
+		self.directory = directory
+
+		if filenames is None:
+			filenames = sorted(filename for filename in os.listdir(directory) if isImageFilename(filename))
+
+		self.filenames = list(filenames)
+
+	@property
+	def paths(self):
+		"""Full path to the image files."""
+		return [os.path.join(self.directory, filename) for filename in self.filenames]
+
+	def __len__(self):
+		return len(self.filenames)
+
+	def __iter__(self):
+		"""Iterate over the full paths of the images."""
+		return iter(self.paths)
+
+	def __repr__(self):
+		return "Dataset({!r}, {} images)".format(self.directory, len(self))
+
+	def getValues(self, key):
+		"""Return the list of values of a metadata (ex: 'well', 'channel', see metadataGetters) for each image."""
+		return _getValueArrays(self.filenames, [key])[key].tolist()
+
+	def getUniqueValues(self, key):
+		"""Return the sorted distinct values of a metadata in the dataset."""
+		return sorted(set(self.getValues(key)))
+
+	def filter(self, **criteria):
+		"""
+		Return a new Dataset with the images matching all criteria.
+		Each criterion is a metadata name (see metadataGetters) with a single value or a list of accepted values.
+		ex: dataset.filter(channel=1, well=["A001", "A002"])
+		"""
+		arrays = _getValueArrays(self.filenames, list(criteria))
+
+		isSelected = np.ones(len(self.filenames), bool)
+		for key, values in criteria.items():
+			values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+			isSelected &= np.isin(arrays[key], values)
+
+		filenames = [filename for filename, selected in zip(self.filenames, isSelected) if selected]
+		return Dataset(self.directory, filenames)
+
+	def groupBy(self, *keys):
+		"""
+		Group the images by one or several metadata, ex: dataset.groupBy("well", "channel").
+		Return a dictionary (sorted by keys) mapping the tuple of metadata values to a Dataset with the corresponding images.
+		"""
+		arrays = _getValueArrays(self.filenames, keys)
+
+		rows = zip(*(arrays[key].tolist() for key in keys)) if keys else [()] * len(self.filenames)
+
+		groups = {}
+		for filename, values in zip(self.filenames, rows):
+			groups.setdefault(values, []).append(filename)
+
+		return {key : Dataset(self.directory, groups[key]) for key in sorted(groups)}
@@ -0,0 +1,201 @@
+"""
+Batch detection of objects in the images of a prescreen, and conversion of the detections to rescreen positions.
+
+A detector is any function taking an image (2D numpy array) and returning the detected objects as a list of (x, y, score),
+with x, y the pixel coordinates (column, row) of the object center and a score (higher is better), ex: templatematching.TemplateDetector.
+The images are processed in parallel in a pool of processes, the detections are converted to objective coordinates (mm) with the pixel size and position from the filenames.
+Objects detected twice in neighbouring overlapping tiles can be merged, before writing the rescreen positions to an IM script.
+
+from acquifer import detection
+
+detections = detection.detectObjects(r"D:\IMAGING-DATA\IMAGES\prescreen", myDetector, channel=1)
+detections = detections.deduplicate(minDistance=0.5)
+detections.toScript("4X-script.imsf", "4X-script_rescreen.imsf", z=21500.1)
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import naming, utils
+from .dataset import Dataset
+from .positions import WellPositionSet
+
+def _detectInFile(path, detector, reader):
+	"""Run the detector on one image, return the detections as an array (n, 3) of x, y, score and the image shape."""
+	image = reader(path)
+	hits = np.asarray(detector(image), np.float64).reshape(-1, 3)
+	return hits, image.shape
+
+def _detectInFiles(paths, detector, reader):
+	return [_detectInFile(path, detector, reader) for path in paths]
+
+def pixelToStage(xPixel, yPixel, pixelSize_um, x0, y0, width, height):
+	"""
+	Convert pixel coordinates in images to objective coordinates in mm, for arrays of detections (vectorized version of metadata.convertXY_PixToIM).
+	The image center is at the objective position x0, y0 (mm), the stage Y-axis is oriented towards the top of the image.
+	"""
+	pixelSize_mm = np.asarray(pixelSize_um, np.float64) / 1000
+	x = np.asarray(x0, np.float64) + (np.asarray(xPixel, np.float64) - np.asarray(width) / 2) * pixelSize_mm
+	y = np.asarray(y0, np.float64) + (np.asarray(height) / 2 - np.asarray(yPixel, np.float64)) * pixelSize_mm
+	return np.round(x, 3), np.round(y, 3)
+
+
+class Detections(object):
+	"""Table of detected objects, with one array per column : source image, pixel and objective coordinates, score."""
+
+	__slots__ = ("filenames", "wellIDs", "xPixel", "yPixel", "scores", "x", "y")
+
+	def __init__(self, filenames, xPixel, yPixel, scores, x, y):
+		"""
+		Parameters
+		----------
+		filenames : array-like of str
+			filename of the image with each detection.
+
+		xPixel, yPixel : array-like of float
+			pixel coordinates of the object centers in the images.
+
+		scores : array-like of float
+			detection scores.
+
+		x, y : array-like of float
+			objective coordinates of the object centers in mm.
+		"""
+		self.filenames = np.asarray(filenames, dtype="U")
+		self.wellIDs = naming.decodeArray(self.filenames.tolist(), ["well"])["well"]
+		self.xPixel = np.asarray(xPixel, np.float64)
+		self.yPixel = np.asarray(yPixel, np.float64)
+		self.scores = np.asarray(scores, np.float64)
+		self.x = np.asarray(x, np.float64)
+		self.y = np.asarray(y, np.float64)
+
+	def __len__(self):
+		return len(self.scores)
+
+	def __repr__(self):
+		return "Detections({} objects in {} wells)".format(len(self), len(np.unique(self.wellIDs)))
+
+	def _subset(self, index):
+		subset = Detections.__new__(Detections)
+		for field in Detections.__slots__:
+			setattr(subset, field, getattr(self, field)[index])
+		return subset
+
+	def filter(self, minScore=None, wellIDs=None):
+		"""Return the detections with a score >= minScore and/or in the given wells."""
+		mask = np.ones(len(self), bool)
+
+		if minScore is not None:
+			mask &= self.scores >= minScore
+
+		if wellIDs is not None:
+			mask &= np.isin(self.wellIDs, np.char.upper(np.asarray(wellIDs, dtype="U4")))
+
+		return self._subset(mask)
+
+	def deduplicate(self, minDistance):
+		"""
+		Merge detections of the same well closer than minDistance (mm), ex: an object detected in 2 overlapping tiles.
+		The detection with the highest score is kept.
+		"""
+		order = np.argsort(-self.scores, kind="stable")
+		keep = np.zeros(len(self), bool)
+
+		for wellID in np.unique(self.wellIDs):
+			indexes = order[self.wellIDs[order] == wellID] # by decreasing score
+			kept = []
+			for index in indexes:
+				if not kept or np.min((self.x[kept] - self.x[index])**2 + (self.y[kept] - self.y[index])**2) >= minDistance**2:
+					kept.append(index)
+			keep[kept] = True
+
+		return self._subset(np.sort(np.flatnonzero(keep)))
+
+	def toPositions(self, z=np.nan, maxPerWell=99):
+		"""
+		Return the detections as a WellPositionSet for a rescreen, with one subposition per detection (by decreasing score within each well).
+
+		Parameters
+		----------
+		z : float, optional
+			Z-position in µm of the rescreen positions. The default is NaN, ie undefined.
+
+		maxPerWell : int, optional
+			maximal number of positions per well (the IM supports up to 99 subpositions), the detections with the lowest scores are dropped. The default is 99.
+		"""
+		if not 1 <= maxPerWell <= 99:
+			raise ValueError("maxPerWell must be in range [1;99].")
+
+		order = np.lexsort((-self.scores, self.wellIDs)) # by well, then decreasing score
+		wellIDs = self.wellIDs[order]
+
+		# Rank of each detection within its well
+		isNewWell = np.r_[True, wellIDs[1:] != wellIDs[:-1]]
+		wellStarts = np.flatnonzero(isNewWell)
+		ranks = np.arange(len(order)) - np.repeat(wellStarts, np.diff(np.r_[wellStarts, len(order)]))
+
+		order = order[ranks < maxPerWell]
+		subpositions = ranks[ranks < maxPerWell] + 1
+
+		positions = WellPositionSet.fromWellIDs(self.wellIDs[order], self.x[order], self.y[order], subpositions, z).sortByWell(snake=True)
+		return WellPositionSet(positions.rows, positions.columns, positions.x, positions.y, positions.subpositions, positions.z) # wells numbered in the acquisition order
+
+	def toScript(self, scriptPath, outputPath, z, maxPerWell=99):
+		"""Write a copy of an IM script with the detections as well positions, see toPositions and WellPositionSet.toScript."""
+		return self.toPositions(z, maxPerWell).toScript(scriptPath, outputPath)
+
+def detectObjects(directory, detector, nWorkers=None, reader=utils.readImage, chunkSize=16, **criteria):
+	"""
+	Run a detector on the images of a dataset in a pool of processes, and return the detections with their objective coordinates.
+
+	Parameters
+	----------
+	directory : str or Dataset
+		directory with the IM images, or a Dataset.
+
+	detector : callable
+		function image -> list of (x, y, score), x,y being the pixel coordinates (column, row) of each detected object center.
+		It must be picklable (defined at the module level, or a functools.partial) to be used in the process pool.
+
+	nWorkers : int, optional
+		number of processes. The default is None, ie the number of CPUs. With 1, the images are processed in the current process.
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+
+	chunkSize : int, optional
+		number of images sent at once to a process. The default is 16.
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+
+	Returns
+	-------
+	Detections
+	"""
+	dataset = directory if isinstance(directory, Dataset) else Dataset(directory)
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	paths = dataset.paths
+	chunks = [paths[start : start + chunkSize] for start in range(0, len(paths), chunkSize)]
+
+	if nWorkers == 1:
+		results = [_detectInFiles(chunk, detector, reader) for chunk in chunks]
+
+	else:
+		with ProcessPoolExecutor(nWorkers) as executor:
+			results = list(executor.map(_detectInFiles, chunks, [detector] * len(chunks), [reader] * len(chunks)))
+
+	results = [result for chunk in results for result in chunk]
+
+	# Gather all detections, with per-detection image information, for a vectorized conversion to objective coordinates
+	nHits = [len(hits) for hits, _ in results]
+	hits = np.concatenate([hits for hits, _ in results]) if results else np.zeros((0, 3))
+	filenames = np.repeat([os.path.basename(path) for path in paths], nHits)
+	heights = np.repeat([shape[0] for _, shape in results], nHits)
+	widths  = np.repeat([shape[1] for _, shape in results], nHits)
+
+	values = naming.decodeArray(filenames.tolist(), ["pixelSize", "positionX", "positionY"])
+
+	x, y = pixelToStage(hits[:,0], hits[:,1], values["pixelSize"], values["positionX"], values["positionY"], widths, heights)
+	return Detections(filenames, hits[:,0], hits[:,1], hits[:,2], x, y)
@@ -0,0 +1,556 @@
+"""
+Dry-run of acquisitions and duration estimates, without sending any command to the IM.
+
+DryRunTcpIp has the same methods as TcpIp, but records the commands instead of sending them. The replies come from an in-process SimulatedIM,
+so that acquisition code runs unchanged (positions, mode, objective...). IM scripts (.imsf) are expanded to the sequence of commands they execute, see expandScript.
+
+The duration of a command sequence is estimated with a CostModel, a linear model per kind of command (term) :
+- XY moves : overhead + travel distance (mm) and Z travel (µm) x time per unit, Z moves : overhead + Z travel x time per µm
+- acquisition and software autofocus : overhead + time per slice + exposure x slices
+- objective and mode switches (only when the objective/mode actually changes), other commands : fixed latency per category (see acquifer.instrumentation)
+- waits until the end of the interval between the loops of a script (WaitEndOfInterval)
+
+The default coefficients are rough values, the model should be calibrated from the command timings of real runs, recorded with a command hook.
+
+from acquifer.dryrun import DryRunTcpIp, CostModel, comparePlans
+
+# calibration, on a real run
+records = []
+myIM.addCommandHook(records.append)
+... # acquisition
+model = CostModel.fromRecords(records)
+model.save("costModel.json")
+
+# estimates, without IM
+model = CostModel.load("costModel.json")
+dryIM = DryRunTcpIp()
+myAcquisition(dryIM)  # any code written for TcpIp
+dryIM.estimate(model) # {"total_s" : ..., "byTerm" : {...}, "nCommands" : ...}
+
+comparePlans({"2 channels" : planA, "3 channels" : planB}, model) # estimated durations in seconds
+"""
+import os
+import re
+import ast
+import json
+import math
+import socket
+from collections import deque, defaultdict
+import numpy as np
+from .tcpip import TcpIp
+from .simulator import SimulatedIM, parseCommand
+from .instrumentation import CommandRecord, getCommandCategory
+
+# Features of the terms of the cost model, the duration of a command is the dot product of its features with the coefficients of its term
+termFeatures = {"moveXY"            : ("overhead_s", "perMillimeter_s", "perMicrometerZ_s"),
+				"moveZ"             : ("overhead_s", "perMicrometer_s"),
+				"acquire"           : ("overhead_s", "perSlice_s", "exposureFactor"),
+				"autofocus"         : ("overhead_s", "perSlice_s", "exposureFactor"),
+				"hardwareAutofocus" : ("overhead_s",),
+				"objectiveSwitch"   : ("overhead_s",),
+				"modeSwitch"        : ("overhead_s",)}
+
+# Rough defaults, to be calibrated from real runs with CostModel.fromRecords
+# Other commands have a single overhead coefficient per category, "command" is used for categories without coefficient
+defaultCoefficients = {"moveXY"            : (0.3, 0.03, 0.0005),
+					   "moveZ"             : (0.1, 0.0005),
+					   "acquire"           : (0.2, 0.05, 1.0),
+					   "autofocus"         : (0.2, 0.05, 1.0),
+					   "hardwareAutofocus" : (1.0,),
+					   "objectiveSwitch"   : (3.0,),
+					   "modeSwitch"        : (0.5,),
+					   "command"           : (0.06,)}
+
+def _getRecordValues(record):
+	"""Return (command, roundTripTime) of a CommandRecord, or of its dictionary version (CommandRecord.toDict)."""
+	if isinstance(record, dict):
+		return record["command"], record["roundTripTime"]
+	return record.command, record.roundTripTime
+
+
+class _MachineState(object):
+	"""Position, objective, mode and exposure of the IM along a command sequence, used to compute the features of each command."""
+
+	def __init__(self):
+		self.x, self.y, self.z = None, None, None
+		self.objective = None
+		self.isScriptMode = None
+		self.exposure = 0.0 # s, of the last light-source command
+
+	def getFeatures(self, command):
+		"""Update the state with a command, and return (term, features)."""
+		name, args = parseCommand(command)
+
+		if name in ("GotoXY", "GotoXYZ"):
+			x, y = float(args[0]), float(args[1])
+			if name == "GotoXY" and len(args) > 2 and args[2] == "GotoMode.Rel":
+				x, y = (self.x or 0.0) + x, (self.y or 0.0) + y
+
+			distance = 0.0 if self.x is None else math.hypot(x - self.x, y - self.y)
+			self.x, self.y = x, y
+
+			dz = 0.0
+			if name == "GotoXYZ":
+				z = float(args[2])
+				dz = 0.0 if self.z is None else abs(z - self.z)
+				self.z = z
+
+			return "moveXY", (1.0, distance, dz)
+
+		if name == "GotoZ":
+			z = float(args[0])
+			if len(args) > 1 and args[1] == "GotoMode.Rel":
+				z += self.z or 0.0
+
+			dz = 0.0 if self.z is None else abs(z - self.z)
+			self.z = z
+			return "moveZ", (1.0, dz)
+
+		if name == "Acquire":
+			nSlices = int(args[0])
+			return "acquire", (1.0, nSlices, nSlices * self.exposure)
+
+		if name == "SoftwareAutofocus":
+			nSlices = int(args[1])
+			return "autofocus", (1.0, nSlices, nSlices * self.exposure)
+
+		if name == "HardwareAutofocus":
+			return "hardwareAutofocus", (1.0,)
+
+		if name in ("SetBrightField", "SetFluoChannel"):
+			self.exposure = float(args[3 if name == "SetBrightField" else 4]) / 1000
+
+		elif name == "SetObjective":
+			objective, previous = int(args[0]), self.objective
+			self.objective = objective
+			if objective != previous: # an unknown objective is counted as a switch
+				return "objectiveSwitch", (1.0,)
+
+		elif name == "SetScriptMode":
+			isScriptMode, previous = args[0] == "1", self.isScriptMode
+			self.isScriptMode = isScriptMode
+			if isScriptMode != previous:
+				return "modeSwitch", (1.0,)
+
+		return getCommandCategory(command), (1.0,)
+
+
+class CostModel(object):
+	"""Linear model of the duration of IM commands, see the module documentation."""
+
+	def __init__(self, coefficients=None):
+		"""
+		Parameters
+		----------
+		coefficients : dict, optional
+			term -> tuple of coefficients (see termFeatures), the missing terms have the default coefficients.
+		"""
+		self.coefficients = dict(defaultCoefficients)
+		if coefficients:
+			self.coefficients.update((term, tuple(values)) for term, values in coefficients.items())
+
+	def __repr__(self):
+		return "CostModel({})".format(self.coefficients)
+
+	def getDuration(self, term, features):
+		"""Return the estimated duration in seconds of a command with the given term and features."""
+		coefficients = self.coefficients.get(term) or self.coefficients["command"]
+		return sum(coefficient * feature for coefficient, feature in zip(coefficients, features))
+
+	def estimate(self, commands):
+		"""
+		Return the estimated duration of a sequence of command strings, as a dictionary with
+		the total duration in seconds (total_s), the duration per term (byTerm) and the number of commands (nCommands).
+		"""
+		state = _MachineState()
+		elapsed = 0.0
+		intervalStart = 0.0
+		byTerm = defaultdict(float)
+
+		for command in commands:
+			name, args = parseCommand(command)
+
+			if name == "StartInterval":
+				intervalStart = elapsed
+				continue
+
+			if name == "WaitEndOfInterval":
+				wait = max(intervalStart + float(args[0]) / 1000 - elapsed, 0.0)
+				byTerm["wait"] += wait
+				elapsed += wait
+				continue
+
+			term, features = state.getFeatures(command)
+			duration = self.getDuration(term, features)
+			byTerm[term] += duration
+			elapsed += duration
+
+		return {"total_s"   : elapsed,
+				"byTerm"    : dict(byTerm),
+				"nCommands" : len(commands)}
+
+	@classmethod
+	def fromRecords(cls, records, minSamples=5):
+		"""
+		Calibrate a cost model from the command timings of real runs.
+
+		Parameters
+		----------
+		records : list of CommandRecord or of dictionaries
+			records collected with a command hook (ex: list.append, see TcpIp.addCommandHook) in the order the commands were sent, or their toDict version (ex: from a json export).
+			Commands run by the IM outside of the tcpip commands (RunScript) are ignored.
+
+		minSamples : int, optional
+			minimal number of commands to calibrate a term, the other terms keep the default coefficients. The default is 5.
+			The coefficients of features which do not vary in the records (ex: always the same number of slices) keep their default value.
+		"""
+		state = _MachineState()
+		samples = defaultdict(list)
+
+		for record in records:
+			command, duration = _getRecordValues(record)
+			if getCommandCategory(command) == "script":
+				continue
+
+			term, features = state.getFeatures(command)
+			samples[term].append(features + (duration,))
+
+		coefficients = {}
+		for term, rows in samples.items():
+			if len(rows) < minSamples:
+				continue
+
+			rows = np.array(rows, dtype=float)
+			features, durations = rows[:, :-1], rows[:, -1]
+			default = np.array(defaultCoefficients.get(term, defaultCoefficients["command"]), dtype=float)
+
+			# Fit the overhead and the coefficients of the features which vary, the others keep their default value
+			fitted = default.copy()
+			varying = [0] + [index for index in range(1, features.shape[1]) if np.ptp(features[:, index]) > 0]
+			fixed = [index for index in range(features.shape[1]) if index not in varying]
+			residuals = durations - features[:, fixed] @ default[fixed]
+
+			if np.linalg.matrix_rank(features[:, varying]) == len(varying):
+				fitted[varying] = np.linalg.lstsq(features[:, varying], residuals, rcond=None)[0]
+			else:
+				fitted[0] = np.mean(durations - features[:, 1:] @ default[1:])
+
+			coefficients[term] = tuple(float(value) for value in np.clip(fitted, 0, None))
+
+		return cls(coefficients)
+
+	def save(self, path):
+		"""Save the coefficients to a json file."""
+		with open(path, "w") as jsonFile:
+			json.dump(self.coefficients, jsonFile, indent=2)
+
+	@classmethod
+	def load(cls, path):
+		"""Load a model saved with save."""
+		with open(path) as jsonFile:
+			return cls(json.load(jsonFile))
+
+
+# ---------------------------------------------------------------------------
+# Expansion of .imsf scripts
+# ---------------------------------------------------------------------------
+
+_wellPattern = re.compile(r'Coordinate\s*=\s*"(\w+)"\s*,\s*X\s*=\s*([-\d.]+)\s*,\s*Y\s*=\s*([-\d.]+)(?:\s*,\s*Z\s*=\s*([-\d.]+))?')
+_wellsPattern = re.compile(r"Wells\s*=\s*new\s+WellInfo\s*\[\]\s*\{.*?\}\s*;", re.DOTALL)
+_blockPattern = re.compile(r"(for|if)\s*\(")
+_assignmentPattern = re.compile(r"^(?:[\w\[\]]+\s+)?(\w+)\s*=(?!=)\s*(.+)$", re.DOTALL)
+_callPattern = re.compile(r"^(\w+)\s*\((.*)\)$", re.DOTALL)
+_scriptFunctions = ("PathCombine",) # functions of the script language, not IM commands
+
+def _findClosing(text, start, opening, closing):
+	"""Return the index of the bracket closing the one at index start."""
+	depth = 0
+	isString = False
+	for index in range(start, len(text)):
+		character = text[index]
+		if character == '"':
+			isString = not isString
+		elif isString:
+			continue
+		elif character == opening:
+			depth += 1
+		elif character == closing:
+			depth -= 1
+			if depth == 0:
+				return index
+	raise ValueError("Unbalanced '{}' in script.".format(opening))
+
+def _splitArguments(arguments):
+	"""Split the arguments of a call at the top-level commas."""
+	parts, depth, isString, start = [], 0, False, 0
+	for index, character in enumerate(arguments):
+		if character == '"':
+			isString = not isString
+		elif not isString and character in "([":
+			depth += 1
+		elif not isString and character in ")]":
+			depth -= 1
+		elif not isString and depth == 0 and character == ",":
+			parts.append(arguments[start:index].strip())
+			start = index + 1
+	parts.append(arguments[start:].strip())
+	return [part for part in parts if part]
+
+def _parseBlock(text):
+	"""Parse script code to a list of statements (str) and blocks ("for"/"if", header, list of statements and blocks)."""
+	items = []
+	index = 0
+	while True:
+		while index < len(text) and text[index] in " \t\r\n;{}":
+			index += 1
+		if index >= len(text):
+			return items
+
+		match = _blockPattern.match(text, index)
+		if match:
+			headerStart = match.end() - 1
+			headerEnd = _findClosing(text, headerStart, "(", ")")
+			bodyStart = headerEnd + 1
+			while text[bodyStart] in " \t\r\n":
+				bodyStart += 1
+
+			if text[bodyStart] == "{":
+				bodyEnd = _findClosing(text, bodyStart, "{", "}")
+				body = text[bodyStart+1:bodyEnd]
+			else:
+				bodyEnd = text.index(";", bodyStart)
+				body = text[bodyStart:bodyEnd+1]
+
+			items.append((match.group(1), text[headerStart+1:headerEnd], _parseBlock(body)))
+			index = bodyEnd + 1
+			continue
+
+		end = index
+		isString = False
+		while end < len(text) and (isString or text[end] != ";"):
+			if text[end] == '"':
+				isString = not isString
+			end += 1
+		items.append(text[index:end].strip())
+		index = end + 1
+
+class _ScriptInterpreter(object):
+	"""Run the statements of an IM script, collecting the IM commands with evaluated arguments."""
+
+	_operators = {ast.Add : lambda a, b: a + b,
+				  ast.Sub : lambda a, b: a - b,
+				  ast.Mult : lambda a, b: a * b,
+				  ast.Div : lambda a, b: a / b,
+				  ast.Lt : lambda a, b: a < b,
+				  ast.LtE : lambda a, b: a <= b,
+				  ast.Gt : lambda a, b: a > b,
+				  ast.GtE : lambda a, b: a >= b,
+				  ast.Eq : lambda a, b: a == b,
+				  ast.NotEq : lambda a, b: a != b}
+
+	def __init__(self, wells):
+		self.variables = {"Wells" : wells, "true" : True, "false" : False}
+		self.commands = []
+
+	def evaluate(self, expression):
+		"""Evaluate a numerical or logical C# expression of the script, raise a ValueError if not supported (ex: strings, .NET calls)."""
+		expression = expression.replace("&&", " and ").replace("||", " or ")
+		expression = re.sub(r"!(?!=)", " not ", expression)
+		try:
+			return self._evaluateNode(ast.parse(expression.strip(), mode="eval").body)
+		except (SyntaxError, KeyError, IndexError, TypeError) as exception:
+			raise ValueError("Unsupported expression : {}".format(expression)) from exception
+
+	def _evaluateNode(self, node):
+		if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+			return node.value
+		if isinstance(node, ast.Name):
+			return self.variables[node.id]
+		if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.Not)):
+			value = self._evaluateNode(node.operand)
+			return -value if isinstance(node.op, ast.USub) else not value
+		if isinstance(node, ast.BinOp) and type(node.op) in self._operators:
+			return self._operators[type(node.op)](self._evaluateNode(node.left), self._evaluateNode(node.right))
+		if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in self._operators:
+			return self._operators[type(node.ops[0])](self._evaluateNode(node.left), self._evaluateNode(node.comparators[0]))
+		if isinstance(node, ast.BoolOp):
+			values = [self._evaluateNode(value) for value in node.values]
+			return all(values) if isinstance(node.op, ast.And) else any(values)
+		if isinstance(node, ast.Subscript):
+			return self._evaluateNode(node.value)[self._evaluateNode(node.slice)]
+		if isinstance(node, ast.Attribute):
+			value = self._evaluateNode(node.value)
+			return len(value) if node.attr == "Length" else value[node.attr]
+		raise TypeError(ast.dump(node))
+
+	def _formatArgument(self, argument):
+		try:
+			value = self.evaluate(argument)
+		except ValueError:
+			return argument # ex: string
+		if isinstance(value, bool):
+			return "true" if value else "false"
+		return str(round(value, 3)) if isinstance(value, float) else str(value)
+
+	def call(self, expression):
+		"""Run a call statement, collecting IM commands, and return its value if any (ex: SoftwareAutofocus)."""
+		name, arguments = _callPattern.match(expression).groups()
+		arguments = _splitArguments(arguments)
+
+		if name in ("GotoXYZ", "SetWellInfo") and len(arguments) == 1: # well argument
+			well = self.evaluate(arguments[0])
+			if name == "GotoXYZ":
+				self.commands.append("GotoXYZ({:.3f},{:.3f},{:.1f})".format(well["X"], well["Y"], well["Z"]))
+			return None
+
+		self.commands.append("{}({})".format(name, ", ".join(self._formatArgument(argument) for argument in arguments)))
+
+		if name == "SoftwareAutofocus": # the focus is estimated at the center of the stack
+			return self.evaluate(arguments[0])
+		return None
+
+	def run(self, items):
+		for item in items:
+			if isinstance(item, tuple):
+				self._runBlock(*item)
+				continue
+
+			assignment = _assignmentPattern.match(item)
+			if assignment:
+				variable, expression = assignment.groups()
+				call = _callPattern.match(expression.strip())
+				if call and call.group(1) not in _scriptFunctions:
+					self.variables[variable] = self.call(expression.strip())
+				else:
+					try:
+						self.variables[variable] = self.evaluate(expression)
+					except ValueError: # non-numerical value, ex: ProjectFolder
+						self.variables[variable] = None
+
+			elif _callPattern.match(item):
+				self.call(item)
+
+	def _runBlock(self, keyword, header, body):
+		if keyword == "if":
+			if self.evaluate(header):
+				self.run(body)
+			return
+
+		initialisation, condition, increment = (part.strip() for part in header.split(";"))
+		variable, start = _assignmentPattern.match(initialisation).groups()
+		if not increment.endswith("++"):
+			raise ValueError("Unsupported loop increment : {}".format(increment))
+
+		self.variables[variable] = self.evaluate(start)
+		while self.evaluate(condition):
+			self.run(body)
+			self.variables[variable] += 1
+
+def expandScriptContent(content):
+	"""
+	Return the list of IM commands executed by an IM script, given as a string (see expandScript).
+	The script should follow the structure of the IM script editor and of acquifer.plan : well definitions, then for loops and if statements using numerical variables.
+	The software autofocus is assumed to return the center of its stack.
+	"""
+	content = re.sub(r"/\*.*?\*/", "", content, flags=re.DOTALL)
+	content = re.sub(r"//[^\n]*", "", content)
+
+	wells = [{"Coordinate" : wellID, "X" : float(x), "Y" : float(y), "Z" : float(z) if z else 0.0} for wellID, x, y, z in _wellPattern.findall(content)]
+	content = _wellsPattern.sub("", content)
+
+	interpreter = _ScriptInterpreter(wells)
+	interpreter.run(_parseBlock(content))
+	return interpreter.commands
+
+def expandScript(scriptPath):
+	"""Return the list of IM commands executed by a .imsf script, including the StartInterval and WaitEndOfInterval(ms) statements (see expandScriptContent)."""
+	if not scriptPath.lower().endswith(".imsf"):
+		raise ValueError("Only .imsf scripts can be expanded.")
+
+	with open(scriptPath) as scriptFile:
+		return expandScriptContent(scriptFile.read())
+
+def estimateScript(scriptPath, model=None):
+	"""Return the estimated duration of a .imsf script (see CostModel.estimate), with the default model if None."""
+	return (model or CostModel()).estimate(expandScript(scriptPath))
+
+def estimatePlan(plan, model=None):
+	"""Return the estimated duration of an AcquisitionPlan (see CostModel.estimate), with the default model if None."""
+	return (model or CostModel()).estimate(expandScriptContent(plan.toScript()))
+
+def comparePlans(plans, model=None):
+	"""Return the estimated durations in seconds of alternative plans, given as a dictionary name -> AcquisitionPlan."""
+	return {name : estimatePlan(plan, model)["total_s"] for name, plan in plans.items()}
+
+
+class DryRunTcpIp(TcpIp):
+	"""TcpIp recording the commands instead of sending them to the IM, with the replies of a SimulatedIM."""
+
+	def __init__(self, simulatedIM=None):
+		"""
+		Parameters
+		----------
+		simulatedIM : SimulatedIM, optional
+			simulated IM replying to the commands, ex: with a given plate format or focus surface. The default is None, ie a 96-well plate.
+		"""
+		self._simulatedIM = simulatedIM if simulatedIM is not None else SimulatedIM()
+		self._replies = deque()
+		self.commands = [] # command strings, in the order they would be sent
+		self._isConnected = True
+		self._hooks = []
+		self._pendingRecord = None
+		self._plateId = ""
+		self._plateGeometry = None
+		self._cameraSettings = None
+
+	def closeConnection(self):
+		"""Record the commands sent when closing the connection, no more commands can be sent afterwards."""
+		self.setMode("live")
+		self.resetCamera()
+		self.setBrightFieldOff()
+		self.setFluoChannelOff()
+		self._endCommand()
+		self._isConnected = False
+
+	def sendCommand(self, stringCommand):
+		"""Record a command, and queue the replies of the simulated IM."""
+		if not self._isConnected:
+			raise socket.error("Connection to IM was closed. Create a new IM object to establish a new connection.")
+
+		self._endCommand()
+
+		if self._hooks:
+			self._pendingRecord = CommandRecord(stringCommand, self._plateId)
+
+		self.commands.append(stringCommand)
+		self._replies = deque(self._simulatedIM.respond(stringCommand))
+
+	def _getFeedback(self, nbytes=256):
+		feedback = self._replies.popleft() if self._replies else ""
+
+		if self._pendingRecord is not None:
+			self._pendingRecord.addReply(feedback)
+
+		return feedback
+
+	def runScript(self, scriptPath):
+		"""Record the commands executed by a .imsf script (see expandScript) and return the simulated image directory."""
+		self.checkLidClosed()
+
+		if not os.path.exists(scriptPath):
+			raise ValueError("Script file not existing : {}".format(scriptPath))
+
+		commands = expandScript(scriptPath)
+		for command in commands:
+			self._simulatedIM.respond(command)
+		self.commands.extend(commands)
+
+		return self._simulatedIM.respond("RunScript({})".format(scriptPath))[0]
+
+	def estimate(self, model=None):
+		"""Return the estimated duration of the recorded commands (see CostModel.estimate), with the default model if None."""
+		return (model or CostModel()).estimate(self.commands)
+
+	def clear(self):
+		"""Clear the recorded commands, ex: to estimate successive parts of an acquisition."""
+		self.commands = []
@@ -0,0 +1,326 @@
+"""
+Export of an IM plate folder to a single chunked and compressed N-D array, instead of thousands of individual TIFF files.
+
+The images are stored in an array with dimensions (well, position, time, channel, z, y, x), split in chunks of one plane per chunk along the first dimensions
+and tiles of chunkShape pixels along y,x. Each chunk is compressed with zlib, such that any region can be read back by decompressing only the chunks it overlaps.
+The layout follows the Zarr v2 format, the store can thus also be opened with the zarr library (ex: zarr.open(zarr.ZipStore(path)), the array is named "images").
+The store is either a directory, or a single zip file (path ending with .zip), which is the easiest for backups.
+
+The filename metadata of every plane (filename, exposure, light power, temperature, objective coordinates, time...) are saved as columns in the array attributes.
+
+from acquifer import export
+
+export.exportPlate(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default", r"D:\export\plate1.zip")
+
+images = export.openPlate(r"D:\export\plate1.zip")
+images.attributes["wells"]      # well IDs along the first dimension
+crop = images[0, 0, 0, 0, 0, 500:700, 800:1000] # well 1, position 1, time 1, channel 1, slice 1
+"""
+import os
+import json
+import zlib
+import zipfile
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import naming, utils
+from .dataset import Dataset
+
+dimensions = ("well", "position", "time", "channel", "z", "y", "x")
+
+# Per-plane metadata saved as columns in the attributes, decoded from the filenames (see naming.tags)
+metadataColumns = ("exposure", "lightPower", "temperature", "positionX", "positionY", "positionZ", "pixelSize", "time")
+
+
+class _DirectoryStore(object):
+	"""Key-value store with one file per key in a directory, safe for writes from several threads."""
+
+	def __init__(self, path, mode="r"):
+		self.path = path
+		if mode == "w":
+			os.makedirs(path, exist_ok=True)
+
+	def __getitem__(self, key):
+		try:
+			with open(os.path.join(self.path, key), "rb") as file:
+				return file.read()
+		except FileNotFoundError:
+			raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		path = os.path.join(self.path, key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as file:
+			file.write(value)
+
+	def close(self):
+		pass
+
+
+class _ZipStore(object):
+	"""Key-value store in a single zip file (uncompressed entries, the chunks being compressed already), with writes serialized by a lock."""
+
+	def __init__(self, path, mode="r"):
+		self.path = path
+		self._zipFile = zipfile.ZipFile(path, mode, zipfile.ZIP_STORED, allowZip64=True)
+		self._lock = threading.Lock()
+
+	def __getitem__(self, key):
+		with self._lock:
+			try:
+				return self._zipFile.read(key)
+			except KeyError:
+				raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		with self._lock:
+			self._zipFile.writestr(key, value)
+
+	def close(self):
+		self._zipFile.close()
+
+def _openStore(path, mode="r"):
+	"""Return a zip store for a path ending with .zip, a directory store otherwise."""
+	if path.lower().endswith(".zip"):
+		return _ZipStore(path, mode)
+	return _DirectoryStore(path, mode)
+
+
+class ChunkedArray(object):
+	"""
+	N-D array stored as zlib-compressed chunks in a store, following the Zarr v2 layout.
+	Regions are read with the usual indexing (integers and slices with step 1), only the chunks overlapping the region are read.
+	"""
+
+	def __init__(self, store, name, shape, dtype, chunks, attributes=None):
+		self.store = store
+		self.name = name
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		self.chunks = tuple(chunks)
+		self.attributes = {} if attributes is None else attributes
+
+	@classmethod
+	def create(cls, store, name, shape, dtype, chunks, compressionLevel=1, attributes=None):
+		"""Create a new array in the store, with the Zarr v2 metadata (.zarray, .zattrs)."""
+		array = cls(store, name, shape, dtype, chunks, attributes)
+		array.compressionLevel = compressionLevel
+
+		store[".zgroup"] = json.dumps({"zarr_format" : 2}).encode()
+		store[name + "/.zarray"] = json.dumps({"zarr_format" : 2,
+											   "shape"       : list(array.shape),
+											   "chunks"      : list(array.chunks),
+											   "dtype"       : array.dtype.str,
+											   "compressor"  : {"id" : "zlib", "level" : compressionLevel},
+											   "fill_value"  : 0,
+											   "order"       : "C",
+											   "filters"     : None}, indent=2).encode()
+		store[name + "/.zattrs"] = json.dumps(array.attributes).encode()
+		return array
+
+	@classmethod
+	def open(cls, store, name):
+		"""Open an existing array of the store."""
+		header = json.loads(store[name + "/.zarray"])
+		if header["compressor"] is not None and header["compressor"]["id"] != "zlib":
+			raise ValueError("Only zlib-compressed arrays are supported, got {}.".format(header["compressor"]["id"]))
+
+		try:
+			attributes = json.loads(store[name + "/.zattrs"])
+		except KeyError:
+			attributes = {}
+
+		array = cls(store, name, header["shape"], header["dtype"], header["chunks"], attributes)
+		array.compressionLevel = None if header["compressor"] is None else header["compressor"]["level"]
+		return array
+
+	@property
+	def ndim(self):
+		return len(self.shape)
+
+	def __repr__(self):
+		return "ChunkedArray(shape={}, dtype={}, chunks={})".format(self.shape, self.dtype, self.chunks)
+
+	def _getKey(self, chunkIndex):
+		return "{}/{}".format(self.name, ".".join(str(index) for index in chunkIndex))
+
+	def _readChunk(self, chunkIndex):
+		"""Return a chunk as an array of the full chunk shape, filled with 0 if the chunk was never written."""
+		try:
+			data = self.store[self._getKey(chunkIndex)]
+		except KeyError:
+			return np.zeros(self.chunks, self.dtype)
+
+		if self.compressionLevel is not None:
+			data = zlib.decompress(data)
+
+		return np.frombuffer(data, self.dtype).reshape(self.chunks)
+
+	def _writeChunk(self, chunkIndex, chunk):
+		data = np.ascontiguousarray(chunk, self.dtype).tobytes()
+		self.store[self._getKey(chunkIndex)] = data if self.compressionLevel is None else zlib.compress(data, self.compressionLevel)
+
+	def setPlane(self, index, plane):
+		"""
+		Write a 2D plane at a position of the leading dimensions, ex: (well, position, time, channel, z).
+		The array must have chunks of size 1 along the leading dimensions.
+		"""
+		chunkHeight, chunkWidth = self.chunks[-2:]
+		if any(size != 1 for size in self.chunks[:-2]):
+			raise ValueError("setPlane requires chunks of size 1 along the leading dimensions.")
+
+		if plane.shape != self.shape[-2:]:
+			raise ValueError("Expected a plane of shape {}, got {}.".format(self.shape[-2:], plane.shape))
+
+		for top in range(0, self.shape[-2], chunkHeight):
+			for left in range(0, self.shape[-1], chunkWidth):
+
+				tile = plane[top : top + chunkHeight, left : left + chunkWidth]
+				if tile.shape != (chunkHeight, chunkWidth): # edge chunks are stored with the full chunk shape
+					tile = np.pad(tile, ((0, chunkHeight - tile.shape[0]), (0, chunkWidth - tile.shape[1])))
+
+				self._writeChunk(tuple(index) + (top // chunkHeight, left // chunkWidth), tile.reshape(self.chunks))
+
+	def __getitem__(self, key):
+		"""Read a region, defined by integers and/or slices (step 1) along each dimension."""
+		if not isinstance(key, tuple):
+			key = (key,)
+
+		if len(key) > self.ndim:
+			raise IndexError("Too many indices for an array with {} dimensions.".format(self.ndim))
+
+		starts, stops, isInteger = [], [], []
+		for dimension, size in enumerate(self.shape):
+			index = key[dimension] if dimension < len(key) else slice(None)
+
+			if isinstance(index, (int, np.integer)):
+				index = range(size)[index] # handle negative indexes and out of range
+				starts.append(index)
+				stops.append(index + 1)
+				isInteger.append(True)
+
+			elif isinstance(index, slice):
+				start, stop, step = index.indices(size)
+				if step != 1:
+					raise IndexError("Only slices with step 1 are supported.")
+				starts.append(start)
+				stops.append(max(stop, start))
+				isInteger.append(False)
+
+			else:
+				raise IndexError("Only integers and slices are supported.")
+
+		out = np.zeros([stop - start for start, stop in zip(starts, stops)], self.dtype)
+
+		# Read only the chunks overlapping the region
+		chunkRanges = [range(start // chunk, (stop - 1) // chunk + 1) if stop > start else range(0)
+					   for start, stop, chunk in zip(starts, stops, self.chunks)]
+
+		for chunkIndex in itertools.product(*chunkRanges):
+			chunk = self._readChunk(chunkIndex)
+
+			source, target = [], []
+			for index, start, stop, size in zip(chunkIndex, starts, stops, self.chunks):
+				chunkStart = index * size
+				low, high = max(start, chunkStart), min(stop, chunkStart + size)
+				source.append(slice(low - chunkStart, high - chunkStart))
+				target.append(slice(low - start, high - start))
+
+			out[tuple(target)] = chunk[tuple(source)]
+
+		return out[tuple(0 if integer else slice(None) for integer in isInteger)]
+
+	def close(self):
+		self.store.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def exportPlate(directory, outputPath, chunkShape=(512, 512), compressionLevel=1, nWorkers=None, reader=utils.readImage, **criteria):
+	"""
+	Export the images of an IM plate folder to a chunked array (well, position, time, channel, z, y, x), in a directory or a single zip file.
+	The images are read, compressed and written in parallel in a pool of threads.
+
+	Parameters
+	----------
+	directory : str
+		directory with the IM images.
+
+	outputPath : str
+		path of the store, a zip file if the path ends with .zip, a directory otherwise.
+
+	chunkShape : tuple of int, optional
+		size (y, x) of the chunks in pixels. The default is (512, 512).
+
+	compressionLevel : int, optional
+		zlib compression level, from 1 (fastest) to 9 (smallest), or None for no compression. The default is 1.
+
+	nWorkers : int, optional
+		number of threads. The default is None, ie the default of ThreadPoolExecutor.
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+
+	Returns
+	-------
+	outputPath
+	"""
+	dataset = Dataset(directory)
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	if len(dataset) == 0:
+		raise ValueError("No IM image to export in {}.".format(directory))
+
+	# Coordinates of each plane along the leading dimensions
+	keys = ("well", "subposition", "timepoint", "channel", "zSlice")
+	values = [dataset.getValues(key) for key in keys]
+	axes, indexes = zip(*(np.unique(keyValues, return_inverse=True) for keyValues in values)) # sorted values, and index of each plane along each axis
+	axes = [axis.tolist() for axis in axes]
+	indexes = np.stack(indexes, axis=1)
+
+	firstImage = reader(dataset.paths[0])
+	shape = tuple(len(axis) for axis in axes) + firstImage.shape
+	chunks = (1,) * len(keys) + tuple(min(size, chunk) for size, chunk in zip(firstImage.shape, chunkShape))
+
+	attributes = {"dimensions" : list(dimensions),
+				  "wells"      : axes[0],
+				  "positions"  : axes[1],
+				  "timepoints" : axes[2],
+				  "channels"   : axes[3],
+				  "zSlices"    : axes[4],
+				  "planes"     : {"filename" : dataset.filenames,
+								  "index"    : indexes.tolist()}}
+
+	for column, columnValues in naming.decodeArray(dataset.filenames, metadataColumns).items():
+		attributes["planes"][column] = columnValues.tolist()
+
+	store = _openStore(outputPath, "w")
+	try:
+		array = ChunkedArray.create(store, "images", shape, firstImage.dtype, chunks, compressionLevel, attributes)
+
+		def writePlane(planeIndex):
+			image = firstImage if planeIndex == 0 else reader(dataset.paths[planeIndex])
+			array.setPlane(indexes[planeIndex], image)
+
+		with ThreadPoolExecutor(nWorkers) as executor:
+			list(executor.map(writePlane, range(len(dataset)))) # list to raise the exceptions of the threads
+
+	finally:
+		store.close()
+
+	return outputPath
+
+def openPlate(path):
+	"""Open a plate exported with exportPlate, return a ChunkedArray (read-only) with the metadata in its attributes."""
+	if not os.path.exists(path):
+		raise FileNotFoundError(path)
+
+	return ChunkedArray.open(_openStore(path, "r"), "images")
@@ -0,0 +1,352 @@
+"""
+Flat-field and dark-frame correction of the IM images, with the flat-field profiles estimated from the plates and cached on disk.
+
+The illumination non-uniformity depends on the imaging configuration : objective and camera binning (both encoded by the pixel size in the filename),
+channel (CO tag), and light source/detection filter which can be given per channel.
+A profile is estimated per configuration by accumulating the planes of a plate one by one (streaming), as a mean, or as a median robust to the objects in the images.
+The profiles are saved in a cache directory, with one .npz file per configuration named after a hash of the configuration, such that each configuration is estimated only once.
+The dark frame and estimation parameters are saved with the profiles, a cached profile estimated with other parameters is estimated again.
+
+The correction (image - dark) / flat is applied in place, with a precomputed gain (1/flat), without temporary copies of the images.
+A FlatfieldCorrector can be passed as reader to the functions processing plates (export, projection, stitching...) to correct the images while loading them.
+
+from acquifer import flatfield, export
+
+cache = flatfield.FlatfieldCache(r"D:\IMAGING-DATA\FLATFIELDS")
+profiles = cache.getProfiles(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default", dark=100) # estimated only for new configurations
+corrector = flatfield.FlatfieldCorrector(profiles)
+export.exportPlate(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default", "plate.zarr.zip", reader=corrector)
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import naming, utils
+from .dataset import Dataset
+from .projection import _boxFilter
+
+estimationMethods = ("mean", "median")
+
+def getConfiguration(filename, channelSettings=None):
+	"""
+	Return the imaging configuration of an image as a dictionary : channel and pixel size (objective and binning) from the filename,
+	and the settings of the channel given in channelSettings (dictionary channel -> dictionary of settings, ex: {1 : {"lightSource" : "bf", "detectionFilter" : 1}}).
+	"""
+	values = naming.decode(filename, ["channel", "pixelSize"])
+	configuration = {"channel" : values["channel"], "pixelSize" : values["pixelSize"]}
+
+	if channelSettings and values["channel"] in channelSettings:
+		configuration.update(channelSettings[values["channel"]])
+
+	return configuration
+
+def getConfigurationKey(configuration):
+	"""Return a short hash identifying a configuration dictionary, used as filename for the cached profiles."""
+	text = json.dumps(configuration, sort_keys=True, default=str)
+	return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class FlatfieldProfile(object):
+	"""Flat-field profile (normalized to a mean of 1) and dark frame of one imaging configuration."""
+
+	def __init__(self, flat, dark=0, configuration=None, nPlanes=0, parameters=None):
+		"""
+		Parameters
+		----------
+		flat : 2D numpy array
+			illumination profile, normalized to a mean of 1 on creation.
+
+		dark : float or 2D numpy array, optional
+			dark frame (camera offset) subtracted before the flat-field correction. The default is 0.
+
+		configuration : dict, optional
+			imaging configuration of the profile, see getConfiguration. The default is None, ie an empty configuration.
+
+		nPlanes : int, optional
+			number of planes used to estimate the profile. The default is 0.
+
+		parameters : dict, optional
+			estimation parameters of the profile (method, groupSize, smoothing), see ProfileEstimator. The default is None, ie unknown.
+		"""
+		flat = np.asarray(flat, np.float64)
+		if flat.ndim != 2:
+			raise ValueError("The flat-field profile must be a 2D array.")
+
+		if np.any(flat <= 0):
+			raise ValueError("The flat-field profile must be strictly positive, check the dark frame.")
+
+		self.flat = (flat / flat.mean()).astype(np.float32)
+		self.dark = np.asarray(dark, np.float32) if np.ndim(dark) else float(dark)
+		self.configuration = dict(configuration) if configuration else {}
+		self.nPlanes = nPlanes
+		self.parameters = dict(parameters) if parameters else {}
+		self.gain = 1 / self.flat
+		self._limits = {} # integer dtype -> maximal value before correction for each pixel, to avoid overflows
+
+	@property
+	def key(self):
+		return getConfigurationKey(self.configuration)
+
+	def matches(self, dark=0, parameters=None):
+		"""Return True if the profile was estimated with this dark frame and estimation parameters (see ProfileEstimator.getParameters)."""
+		return self.parameters == (parameters or {}) and np.shape(self.dark) == np.shape(dark) and np.array_equal(self.dark, dark)
+
+	def __repr__(self):
+		return "FlatfieldProfile({}, shape={}, {} planes)".format(self.configuration, self.flat.shape, self.nPlanes)
+
+	def _getLimit(self, dtype):
+		if dtype not in self._limits:
+			self._limits[dtype] = np.floor(np.iinfo(dtype).max * self.flat).astype(np.float32)
+		return self._limits[dtype]
+
+	def correct(self, image, out=None):
+		"""
+		Apply (image - dark) / flat to an image and return the corrected image.
+		The correction is done in place (out=None) or in the preallocated array out, without temporary copy of the image.
+		For integer images, the values below the dark are set to 0, the results are rounded down and clipped to the range of the data type.
+		"""
+		if image.shape != self.flat.shape:
+			raise ValueError("Image shape {} different from the profile shape {}.".format(image.shape, self.flat.shape))
+
+		out = image if out is None else out
+
+		if np.issubdtype(out.dtype, np.integer):
+			if np.any(self.dark):
+				np.maximum(image, self.dark, out=out, casting="unsafe") # no negative value after the subtraction
+				np.subtract(out, self.dark, out=out, casting="unsafe")
+			elif out is not image:
+				np.copyto(out, image, casting="unsafe")
+			np.minimum(out, self._getLimit(out.dtype), out=out, casting="unsafe")
+			np.multiply(out, self.gain, out=out, casting="unsafe")
+
+		else:
+			np.subtract(image, self.dark, out=out, casting="unsafe")
+			np.multiply(out, self.gain, out=out)
+
+		return out
+
+	def save(self, path):
+		"""Save the profile as a .npz file, with the configuration as json."""
+		np.savez_compressed(path, flat=self.flat, dark=np.asarray(self.dark), configuration=json.dumps(self.configuration, default=str), nPlanes=self.nPlanes,
+							parameters=json.dumps(self.parameters))
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as data:
+			dark = data["dark"]
+			parameters = json.loads(str(data["parameters"])) if "parameters" in data else None # profiles saved by older versions
+			return cls(data["flat"], dark if dark.ndim else float(dark), json.loads(str(data["configuration"])), int(data["nPlanes"]), parameters)
+
+
+class ProfileEstimator(object):
+	"""
+	Streaming estimation of a flat-field profile from planes added one by one, with a memory usage independent of the number of planes.
+	- mean : running sum of the planes.
+	- median : the planes are buffered by groups of groupSize, the profile is the mean of the per-pixel medians of the groups,
+	  which removes the objects present in a minority of the planes of each group.
+	"""
+
+	def __init__(self, method="median", groupSize=16):
+		if method not in estimationMethods:
+			raise ValueError("The method must be one of {}.".format(estimationMethods))
+
+		if groupSize < 1:
+			raise ValueError("The group size must be >= 1.")
+
+		self.method = method
+		self.groupSize = groupSize
+		self.nPlanes = 0
+		self._sum = None    # sum of the planes (mean), or of the group medians (median)
+		self._nSummed = 0   # number of planes or groups in the sum
+		self._group = None  # buffer of the current group of planes, for the median
+		self._nGroup = 0
+
+	def add(self, image):
+		image = np.asarray(image)
+		if self._sum is None:
+			self._sum = np.zeros(image.shape, np.float64)
+			if self.method == "median":
+				self._group = np.empty((self.groupSize,) + image.shape, np.float32)
+
+		elif image.shape != self._sum.shape:
+			raise ValueError("All planes must have the same shape, expected {}.".format(self._sum.shape))
+
+		self.nPlanes += 1
+
+		if self.method == "mean":
+			self._sum += image
+			self._nSummed += 1
+			return
+
+		self._group[self._nGroup] = image
+		self._nGroup += 1
+		if self._nGroup == self.groupSize:
+			self._addGroup()
+
+	def _addGroup(self):
+		self._sum += np.median(self._group[:self._nGroup], axis=0)
+		self._nSummed += 1
+		self._nGroup = 0
+
+	def getParameters(self, smoothing=0):
+		"""Return the estimation parameters stored with the profiles, as a dictionary."""
+		return {"method" : self.method, "groupSize" : self.groupSize, "smoothing" : smoothing}
+
+	def getProfile(self, dark=0, smoothing=0, configuration=None):
+		"""
+		Return the FlatfieldProfile of the planes added so far.
+
+		Parameters
+		----------
+		dark : float or 2D numpy array, optional
+			dark frame subtracted from the estimated illumination. The default is 0.
+
+		smoothing : int, optional
+			radius in pixels of a mean filter applied to the profile, to remove the noise and remaining structures. The default is 0, ie no smoothing.
+
+		configuration : dict, optional
+			configuration stored with the profile.
+		"""
+		if self.nPlanes == 0:
+			raise ValueError("No plane added to the estimator.")
+
+		if self.method == "median" and self._nGroup: # incomplete last group, weighted by its number of planes
+			weight = self._nGroup / self.groupSize
+			profile = (self._sum + weight * np.median(self._group[:self._nGroup], axis=0)) / (self._nSummed + weight)
+		else:
+			profile = self._sum / self._nSummed
+
+		profile = profile - dark
+		if smoothing:
+			profile = _boxFilter(profile, smoothing)
+
+		return FlatfieldProfile(profile, dark, configuration, self.nPlanes, self.getParameters(smoothing))
+
+
+def estimateProfiles(directory, dark=0, method="median", groupSize=16, smoothing=0, channelSettings=None, nWorkers=None, reader=utils.readImage, **criteria):
+	"""
+	Estimate the flat-field profile of each imaging configuration of a plate, reading every image once (in a pool of threads).
+	Return a dictionary configuration key -> FlatfieldProfile, see getConfigurationKey.
+
+	Parameters
+	----------
+	directory : str or Dataset
+		directory with the IM images, or a Dataset.
+
+	dark : float or 2D numpy array, optional
+		dark frame (ex: camera offset), see ProfileEstimator.getProfile. The default is 0.
+
+	method, groupSize : optional
+		estimation method, "mean" or "median", see ProfileEstimator. The default is the median over groups of 16 planes.
+
+	smoothing : int, optional
+		radius of the mean filter applied to the profiles. The default is 0.
+
+	channelSettings : dict, optional
+		channel -> dictionary of settings added to the configuration, ex: {1 : {"lightSource" : "bf", "detectionFilter" : 1}}. The default is None.
+
+	nWorkers : int, optional
+		number of threads reading the images. The default is None, ie the default of ThreadPoolExecutor.
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+	"""
+	dataset = directory if isinstance(directory, Dataset) else Dataset(directory)
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	configurations = [getConfiguration(filename, channelSettings) for filename in dataset.filenames]
+	keys = [getConfigurationKey(configuration) for configuration in configurations]
+	estimators = {key : ProfileEstimator(method, groupSize) for key in keys}
+
+	with ThreadPoolExecutor(nWorkers) as executor:
+		for key, image in zip(keys, utils.mapBounded(executor, reader, dataset.paths, 2 * nWorkers if nWorkers else None)):
+			estimators[key].add(image)
+
+	configurationsByKey = dict(zip(keys, configurations))
+	return {key : estimator.getProfile(dark, smoothing, configurationsByKey[key]) for key, estimator in estimators.items()}
+
+
+class FlatfieldCache(object):
+	"""Directory of flat-field profiles, with one .npz file per configuration named after the configuration key."""
+
+	def __init__(self, directory):
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+
+	def getPath(self, key):
+		return os.path.join(self.directory, key + ".npz")
+
+	def __contains__(self, key):
+		return os.path.exists(self.getPath(key))
+
+	def load(self, key):
+		"""Return the cached profile for a configuration key, or None if not in the cache."""
+		return FlatfieldProfile.load(self.getPath(key)) if key in self else None
+
+	def save(self, profile):
+		profile.save(self.getPath(profile.key))
+
+	def getProfiles(self, directory, dark=0, method="median", groupSize=16, smoothing=0, channelSettings=None, nWorkers=None, reader=utils.readImage, **criteria):
+		"""
+		Return the profiles (configuration key -> FlatfieldProfile) of all configurations of a plate.
+		The cached profiles are loaded, the others are estimated from the plate (see estimateProfiles) and added to the cache.
+		Cached profiles estimated with another dark frame or other estimation parameters are estimated again, and replaced in the cache.
+		"""
+		dataset = directory if isinstance(directory, Dataset) else Dataset(directory)
+		if criteria:
+			dataset = dataset.filter(**criteria)
+
+		keys = [getConfigurationKey(getConfiguration(filename, channelSettings)) for filename in dataset.filenames]
+		parameters = ProfileEstimator(method, groupSize).getParameters(smoothing)
+		profiles = {key : self.load(key) for key in set(keys) if key in self}
+		profiles = {key : profile for key, profile in profiles.items() if profile.matches(dark, parameters)}
+
+		missing = [filename for filename, key in zip(dataset.filenames, keys) if key not in profiles]
+		if missing:
+			estimated = estimateProfiles(Dataset(dataset.directory, missing), dark, method, groupSize, smoothing, channelSettings, nWorkers, reader)
+			for profile in estimated.values():
+				self.save(profile)
+			profiles.update(estimated)
+
+		return profiles
+
+
+class FlatfieldCorrector(object):
+	"""
+	Image reader applying the flat-field correction of the configuration of each image, usable as reader argument for the plate processing functions.
+	Called with an image path, it reads the image and returns it corrected in place.
+	"""
+
+	def __init__(self, profiles, channelSettings=None, reader=utils.readImage):
+		"""
+		Parameters
+		----------
+		profiles : dict or list of FlatfieldProfile
+			profiles by configuration key (see FlatfieldCache.getProfiles), or a list of profiles.
+
+		channelSettings : dict, optional
+			settings per channel, as used to estimate the profiles. The default is None.
+
+		reader : callable, optional
+			function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+		"""
+		self.profiles = profiles if isinstance(profiles, dict) else {profile.key : profile for profile in profiles}
+		self.channelSettings = channelSettings
+		self.reader = reader
+
+	def getProfile(self, filename):
+		key = getConfigurationKey(getConfiguration(filename, self.channelSettings))
+		if key not in self.profiles:
+			raise ValueError("No flat-field profile for the configuration {} of {}.".format(getConfiguration(filename, self.channelSettings), filename))
+		return self.profiles[key]
+
+	def __call__(self, path):
+		image = self.reader(path)
+		if not image.flags.writeable:
+			image = image.copy()
+		return self.getProfile(os.path.basename(path)).correct(image)
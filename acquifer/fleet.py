@@ -0,0 +1,297 @@
+"""
+Control of several IMs from a single python process.
+
+A Fleet holds one Instrument per IM, each with its own TcpIp session to the host and port of the IM control software.
+Jobs (acquisition plans, IM scripts or python functions taking the TcpIp session) are sent to the instruments in parallel, with one thread per instrument :
+the instruments run independently, a failure on one instrument does not interrupt the others.
+The progress (current job, number of commands and acquisitions, elapsed time) and the command timings of each instrument are gathered with command hooks (see acquifer.instrumentation).
+
+from acquifer.fleet import Fleet
+
+fleet = Fleet({"IM-1" : "localhost:6200", "IM-2" : ("192.168.0.12", 6200)})
+fleet.connect()
+results = fleet.run({"IM-1" : planA, "IM-2" : [planB, planC]}) # plans run one after the other on IM-2, in parallel with IM-1
+fleet.getProgress()   # can be called from another thread while running
+fleet.summary()       # command timings per instrument
+fleet.close()
+
+The .imsf scripts of the plans are written to a temporary file by default : for remote IMs, set a scriptDirectory shared with the IM computer.
+"""
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .tcpip import TcpIp
+from .instrumentation import HistogramHook
+from .plan import AcquisitionPlan
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def parseAddress(address, defaultPort=6200):
+	"""
+	Return (host, port) from an address given as "host", "host:port", "[ipv6]:port" or a (host, port) tuple.
+	IPv6 addresses without port can be given without brackets, ex: "::1".
+	"""
+	if isinstance(address, (tuple, list)):
+		host, port = address
+		return host, int(port)
+
+	if address.startswith("["): # [ipv6]:port
+		host, _, port = address[1:].partition("]")
+		return host, int(port.lstrip(":")) if port else defaultPort
+
+	if address.count(":") == 1:
+		host, port = address.split(":")
+		return host, int(port)
+
+	return address, defaultPort
+
+
+class Instrument(object):
+	"""One IM of a fleet : address, TcpIp session and progress of the current jobs."""
+
+	def __init__(self, name, host="localhost", port=6200, scriptDirectory=None, timeout=10):
+		"""
+		Parameters
+		----------
+		name : str
+			name of the instrument in the fleet.
+
+		host, port : optional
+			address of the IM control software, see TcpIp. The default is localhost, port 6200.
+
+		scriptDirectory : str, optional
+			directory where the scripts of the acquisition plans are written, it must be accessible by the IM computer. The default is None, ie a temporary file.
+
+		timeout : float, optional
+			maximal time in seconds to connect. The default is 10.
+		"""
+		self.name = name
+		self.host = host
+		self.port = port
+		self.scriptDirectory = scriptDirectory
+		self.timeout = timeout
+		self.im = None
+		self.timings = HistogramHook()
+
+		self.status = "disconnected" # disconnected, idle, running, failed
+		self.error = None
+		self.currentJob = None
+		self.results = [] # results of the jobs done by the last runJobs, kept if a job failed
+		self.nJobs = 0
+		self.nJobsDone = 0
+		self.nCommands = 0
+		self.nAcquisitions = 0
+		self.lastCommand = ""
+		self.startTime = None
+		self.endTime = None
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "Instrument({!r}, {}:{}, {})".format(self.name, self.host, self.port, self.status)
+
+	def connect(self):
+		"""Open the TcpIp session, if not already open."""
+		if self.im is None:
+			self.im = TcpIp(self.port, self.host, self.timeout)
+			self.im.addCommandHook(self._onCommand)
+			self.im.addCommandHook(self.timings)
+			self.status = "idle"
+		return self.im
+
+	def close(self):
+		"""Close the TcpIp session (switching the IM back to live mode)."""
+		if self.im is not None:
+			self.im.closeConnection()
+			self.im = None
+			self.status = "disconnected"
+
+	def _onCommand(self, record):
+		with self._lock:
+			self.nCommands += 1
+			self.lastCommand = record.command
+			if record.category == "acquire":
+				self.nAcquisitions += 1
+
+	def runJob(self, job):
+		"""
+		Run one job on the instrument and return its result.
+		A job is an AcquisitionPlan (run with TcpIp.runPlan), the path of an IM script (.imsf or .cs, run with TcpIp.runScript) or a function called with the TcpIp session.
+		"""
+		im = self.connect()
+		self.currentJob = job
+
+		if isinstance(job, AcquisitionPlan):
+			scriptPath = None
+			if self.scriptDirectory is not None:
+				scriptPath = os.path.join(self.scriptDirectory, "{}_{}_{}.imsf".format(job.plateName, self.name, time.strftime("%Y%m%d_%H%M%S")))
+			return im.runPlan(job, scriptPath)
+
+		if isinstance(job, str):
+			return im.runScript(job)
+
+		if callable(job):
+			return job(im)
+
+		raise TypeError("A job must be an AcquisitionPlan, the path of an IM script or a function taking a TcpIp object.")
+
+	def runJobs(self, jobs):
+		"""
+		Run jobs one after the other, and return the list of results.
+		The instrument status is 'failed' with the exception as error if a job raised an exception, the results of the jobs done before are kept in the results attribute.
+		"""
+		with self._lock:
+			self.status = "running"
+			self.error = None
+			self.nJobs, self.nJobsDone = len(jobs), 0
+			self.startTime, self.endTime = time.time(), None
+			self.results = []
+
+		try:
+			for job in jobs:
+				self.results.append(self.runJob(job))
+				self.nJobsDone += 1
+
+			self.status = "idle"
+			return self.results
+
+		except Exception as exception:
+			self.status = "failed"
+			self.error = exception
+			logger.error("Instrument %s failed on job %d/%d : %s", self.name, self.nJobsDone + 1, self.nJobs, exception)
+			raise
+
+		finally:
+			self.currentJob = None
+			self.endTime = time.time()
+
+	def getProgress(self):
+		"""Return a dictionary with the status, number of jobs done, number of commands and acquisitions, last command and elapsed time (s)."""
+		with self._lock:
+			end = self.endTime if self.endTime is not None else time.time()
+			return {"status"        : self.status,
+					"host"          : self.host,
+					"port"          : self.port,
+					"nJobs"         : self.nJobs,
+					"nJobsDone"     : self.nJobsDone,
+					"nCommands"     : self.nCommands,
+					"nAcquisitions" : self.nAcquisitions,
+					"lastCommand"   : self.lastCommand,
+					"elapsed_s"     : end - self.startTime if self.startTime is not None else 0.0,
+					"error"         : repr(self.error) if self.error else None}
+
+
+class Fleet(object):
+	"""Several IMs driven in parallel from one process, with one TcpIp session and one thread per instrument."""
+
+	def __init__(self, instruments):
+		"""
+		Parameters
+		----------
+		instruments : dict or list
+			dictionary name -> address ("host", "host:port" or (host, port), see parseAddress), or list of Instrument.
+		"""
+		if isinstance(instruments, dict):
+			instruments = [Instrument(name, *parseAddress(address)) for name, address in instruments.items()]
+
+		self.instruments = {}
+		for instrument in instruments:
+			if instrument.name in self.instruments:
+				raise ValueError("Duplicated instrument name {}.".format(instrument.name))
+			self.instruments[instrument.name] = instrument
+
+	def __getitem__(self, name):
+		return self.instruments[name]
+
+	def __iter__(self):
+		return iter(self.instruments.values())
+
+	def __len__(self):
+		return len(self.instruments)
+
+	def __repr__(self):
+		return "Fleet({})".format(", ".join(repr(instrument) for instrument in self))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def connect(self, raiseErrors=True):
+		"""
+		Connect to all instruments in parallel.
+		Return the dictionary name -> exception of the instruments which could not be connected, or raise the first error if raiseErrors is True.
+		"""
+		errors = {}
+		with ThreadPoolExecutor(max(len(self), 1)) as executor:
+			futures = {instrument.name : executor.submit(instrument.connect) for instrument in self}
+
+			for name, future in futures.items():
+				exception = future.exception()
+				if exception is not None:
+					self.instruments[name].status, self.instruments[name].error = "failed", exception
+					errors[name] = exception
+
+		if errors and raiseErrors:
+			name = next(iter(errors))
+			raise ConnectionError("Cannot connect to instrument {} : {}".format(name, errors[name]))
+
+		return errors
+
+	def close(self):
+		"""Close the sessions of all connected instruments."""
+		for instrument in self:
+			try:
+				instrument.close()
+			except Exception as exception:
+				logger.warning("Error when closing the connection to %s : %s", instrument.name, exception)
+
+	def run(self, jobs, raiseErrors=False):
+		"""
+		Run jobs on the instruments in parallel, and wait until all instruments are done.
+
+		Parameters
+		----------
+		jobs : dict
+			instrument name -> job or list of jobs run one after the other on this instrument.
+			A job is an AcquisitionPlan, the path of an IM script or a function called with the TcpIp session of the instrument (see Instrument.runJob).
+
+		raiseErrors : bool, optional
+			if True, raise the error of the first failed instrument once all instruments are done.
+			The default is False, ie the failed instruments have the status 'failed' and the exception as error attribute.
+
+		Returns
+		-------
+		dict
+			instrument name -> list of job results. For failed instruments, the results of the jobs done before the failure.
+		"""
+		for name in jobs:
+			if name not in self.instruments:
+				raise ValueError("Unknown instrument {}, should be one of {}.".format(name, list(self.instruments)))
+
+		jobs = {name : list(instrumentJobs) if isinstance(instrumentJobs, (list, tuple)) else [instrumentJobs] for name, instrumentJobs in jobs.items()}
+
+		results = {}
+		with ThreadPoolExecutor(max(len(jobs), 1)) as executor:
+			futures = {name : executor.submit(self.instruments[name].runJobs, instrumentJobs) for name, instrumentJobs in jobs.items()}
+
+			for name, future in futures.items():
+				future.exception() # wait, the error is kept by the instrument
+				results[name] = self.instruments[name].results
+
+		failed = [name for name in jobs if self.instruments[name].status == "failed"]
+		if failed and raiseErrors:
+			raise RuntimeError("Instrument {} failed : {}".format(failed[0], self.instruments[failed[0]].error)) from self.instruments[failed[0]].error
+
+		return results
+
+	def getProgress(self):
+		"""Return the progress of each instrument, as a dictionary name -> dictionary (see Instrument.getProgress)."""
+		return {instrument.name : instrument.getProgress() for instrument in self}
+
+	def summary(self):
+		"""Return the command timings of each instrument, as a dictionary name -> plateId -> category -> statistics (see instrumentation.HistogramHook.summary)."""
+		return {instrument.name : instrument.timings.summary() for instrument in self}
@@ -0,0 +1,229 @@
+"""
+Focus map : predict the focus position of every well from the autofocus of a few sample wells.
+
+Running a software autofocus in every well acquires a full Z-stack per well, which dominates the acquisition time of large plates.
+Instead, the autofocus is run for a sparse sample of positions spread over the plate, and a smooth surface (plane or low-order polynomial) is fitted to the focus positions.
+Sample positions deviating from the surface are re-checked with a second autofocus centered on the prediction :
+- if the new value agrees with the surface, the first autofocus is considered a failure (ex: focus on debris) and replaced.
+- otherwise the deviation is confirmed, the position keeps its measured Z and the nearest positions are sampled as well.
+
+import acquifer
+from acquifer import focusmap
+from acquifer.plates import PlateGeometry
+
+myIM = acquifer.TcpIp()
+positions = PlateGeometry(384).getPositions()
+autofocus = focusmap.getSoftwareAutofocus(myIM, objective=2, lightSource="bf", detectionFilter=1, intensity=50, exposure=10, nSlices=20, zStepSize=10)
+
+positionsZ, surface = focusmap.createFocusMap(autofocus, positions, zStart=21500, nSamples=12)
+
+for position in myIM.iterWellPositions(positionsZ): # single XYZ move per well
+	myIM.acquire(...)
+
+positionsZ.toScript("template.imsf", "focused.imsf") # or write the Z-positions in a script
+"""
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class FocusMap(object):
+	"""Polynomial surface z = f(x, y) fitted by least-squares to focus positions, with x,y in mm and z in µm."""
+
+	def __init__(self, order=1):
+		"""
+		Parameters
+		----------
+		order : int, optional
+			degree of the polynomial : 1 for a plane (tilted plate), 2 for a quadratic surface (ex: bent plate bottom), up to 3. The default is 1.
+		"""
+		if order not in (1,2,3):
+			raise ValueError("Order must be 1, 2 or 3.")
+
+		self.order = order
+		self.coefficients = None
+		self._center = (0.0, 0.0)
+		self._scale = 1.0
+
+	@property
+	def nTerms(self):
+		"""Number of polynomial coefficients, ie minimal number of positions to fit the surface."""
+		return (self.order+1) * (self.order+2) // 2
+
+	def __repr__(self):
+		return "FocusMap(order={}, {})".format(self.order, "not fitted" if self.coefficients is None else "fitted")
+
+	def _getDesignMatrix(self, x, y):
+		"""Return the matrix of monomials x^i * y^j (i+j <= order), on coordinates centered and scaled for numerical stability."""
+		u = (np.asarray(x, np.float64).ravel() - self._center[0]) / self._scale
+		v = (np.asarray(y, np.float64).ravel() - self._center[1]) / self._scale
+		return np.stack([u**i * v**(degree-i) for degree in range(self.order+1) for i in range(degree+1)], axis=1)
+
+	def fit(self, x, y, z):
+		"""Fit the surface to focus positions z (µm) measured at x,y (mm), return self."""
+		x = np.asarray(x, np.float64).ravel()
+		y = np.asarray(y, np.float64).ravel()
+		z = np.asarray(z, np.float64).ravel()
+
+		if not len(x) == len(y) == len(z):
+			raise ValueError("x, y, z must have the same length.")
+
+		if len(z) < self.nTerms:
+			raise ValueError("At least {} positions are needed to fit a surface of order {}.".format(self.nTerms, self.order))
+
+		self._center = (x.mean(), y.mean())
+		self._scale = max(np.ptp(x), np.ptp(y), 1.0)
+		self.coefficients = np.linalg.lstsq(self._getDesignMatrix(x, y), z, rcond=None)[0]
+		return self
+
+	def predict(self, x, y):
+		"""Return the predicted focus positions (µm) at x,y (mm), as an array."""
+		if self.coefficients is None:
+			raise ValueError("The focus map is not fitted.")
+
+		return self._getDesignMatrix(x, y) @ self.coefficients
+
+	def getResiduals(self, x, y, z):
+		"""Return the difference between measured focus positions and the surface."""
+		return np.asarray(z, np.float64).ravel() - self.predict(x, y)
+
+	def getLeaveOneOutResiduals(self, x, y, z):
+		"""
+		Return the difference between each measured focus position and the surface fitted without this position, for the positions used to fit the surface.
+		Contrary to the plain residuals, a single wrong value is not masked by the shift of the surface towards it.
+		"""
+		designMatrix = self._getDesignMatrix(x, y)
+		leverages = np.sum(np.linalg.qr(designMatrix)[0]**2, axis=1) # diagonal of the hat matrix
+		return self.getResiduals(x, y, z) / np.maximum(1 - leverages, 1e-9)
+
+def selectSamples(x, y, nSamples):
+	"""
+	Return the indexes of nSamples positions spread over the plate, selected by farthest-point sampling.
+	The first position is the one the farthest from the center (a corner of the plate), then each new position is the farthest from the already selected ones.
+	"""
+	x = np.asarray(x, np.float64).ravel()
+	y = np.asarray(y, np.float64).ravel()
+	nSamples = min(nSamples, len(x))
+
+	distances = (x - x.mean())**2 + (y - y.mean())**2
+	indexes = []
+	for _ in range(nSamples):
+		index = int(np.argmax(distances))
+		indexes.append(index)
+		distances = np.minimum(distances, (x - x[index])**2 + (y - y[index])**2)
+
+	return np.array(indexes, np.int64)
+
+def getSoftwareAutofocus(im, objective, lightSource, detectionFilter, intensity, exposure, nSlices, zStepSize, lightConstantOn=False):
+	"""
+	Return a function autofocus(x, y, zCenter) for createFocusMap, which moves the objective to x,y and runs a software autofocus with a stack centered on zCenter.
+	See TcpIp.runSoftwareAutoFocus for the parameters.
+	"""
+	def autofocus(x, y, zCenter):
+		im.moveXYto(x, y)
+		return im.runSoftwareAutoFocus(objective, lightSource, detectionFilter, intensity, exposure, zCenter, nSlices, zStepSize, lightConstantOn)
+
+	return autofocus
+
+def createFocusMap(autofocus, positions, zStart, nSamples=9, order=1, tolerance=20.0, maxSamples=None):
+	"""
+	Autofocus a sample of the positions, fit a focus surface and predict the Z-position of all positions.
+
+	Parameters
+	----------
+	autofocus : callable
+		function autofocus(x, y, zCenter) returning the focus position (µm) at x,y (mm), searching around zCenter. See getSoftwareAutofocus.
+
+	positions : WellPositionSet
+		positions to focus, ex: PlateGeometry.getPositions().
+
+	zStart : float
+		center of the autofocus search for the initial samples, in µm.
+
+	nSamples : int, optional
+		number of positions sampled initially. The default is 9.
+
+	order : int, optional
+		order of the polynomial surface, see FocusMap. The default is 1 (plane).
+
+	tolerance : float, optional
+		maximal deviation in µm between a measured focus position and the surface, above which the position is re-checked. The default is 20.
+
+	maxSamples : int, optional
+		maximal number of autofocus runs, including the re-checks. The default is None, ie 2*nSamples.
+
+	Returns
+	-------
+	positionsZ : WellPositionSet
+		copy of the positions with the predicted Z-positions, sampled positions keep their measured Z.
+
+	focusMap : FocusMap
+		the fitted surface.
+	"""
+	focusMap = FocusMap(order)
+	nSamples = max(nSamples, focusMap.nTerms)
+	maxSamples = 2*nSamples if maxSamples is None else maxSamples
+
+	if len(positions) < focusMap.nTerms:
+		raise ValueError("At least {} positions are needed for a focus map of order {}.".format(focusMap.nTerms, order))
+
+	x, y = positions.x, positions.y
+	measured = {} # position index -> measured z
+	deviating = set() # positions with a confirmed deviation, excluded from the fit
+	nRuns = 0
+
+	for index in selectSamples(x, y, nSamples):
+		measured[index] = autofocus(float(x[index]), float(y[index]), zStart)
+		nRuns += 1
+
+	rechecked = set()
+	while True:
+		fitted = sorted(set(measured) - deviating)
+		focusMap.fit(x[fitted], y[fitted], [measured[index] for index in fitted])
+
+		# Re-check the largest outlier only, then refit, since a single wrong value also shifts the residuals of the other positions
+		residuals = np.abs(focusMap.getLeaveOneOutResiduals(x[fitted], y[fitted], [measured[index] for index in fitted]))
+		candidates = [(residual, index) for residual, index in zip(residuals, fitted) if residual > tolerance and index not in rechecked]
+
+		if not candidates or nRuns >= maxSamples:
+			break
+
+		index = max(candidates)[1]
+		rechecked.add(index)
+
+		# Prediction without the outlier
+		others = [other for other in fitted if other != index]
+		if len(others) >= focusMap.nTerms:
+			focusMap.fit(x[others], y[others], [measured[other] for other in others])
+
+		prediction = float(focusMap.predict(x[index], y[index])[0])
+		zCheck = autofocus(float(x[index]), float(y[index]), prediction)
+		nRuns += 1
+
+		if abs(zCheck - prediction) <= tolerance:
+			logger.info("Focus of %s re-checked : %.1f µm instead of %.1f µm.", positions.wellIDs[index], zCheck, measured[index])
+			measured[index] = zCheck
+			continue
+
+		# Confirmed deviation : keep the measured value, and sample the nearest position not yet measured to densify the map around it
+		logger.info("Focus of %s deviates from the focus map by %.1f µm.", positions.wellIDs[index], zCheck - prediction)
+		measured[index] = zCheck
+		if len(others) >= focusMap.nTerms: # keep enough positions to fit the surface
+			deviating.add(index)
+
+		distances = (x - x[index])**2 + (y - y[index])**2
+		distances[list(measured)] = np.inf
+		neighbour = int(np.argmin(distances))
+
+		if np.isfinite(distances[neighbour]) and nRuns < maxSamples:
+			measured[neighbour] = autofocus(float(x[neighbour]), float(y[neighbour]), zCheck)
+			nRuns += 1
+
+	z = np.maximum(focusMap.predict(x, y), 0)
+	for index, zMeasured in measured.items():
+		z[index] = zMeasured
+
+	logger.info("Focus map fitted with %d autofocus runs for %d positions.", nRuns, len(positions))
+	return positions.withZ(z), focusMap
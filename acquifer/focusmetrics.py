@@ -0,0 +1,127 @@
+"""
+Image-based focus metrics, to score the sharpness of images on disk (ex: for quality control, or to pick the best slice of a Z-stack).
+
+The metrics work on numpy arrays, with the image in the last 2 dimensions : a 2D image returns a single score, a 3D stack (slice, y, x) returns one score per slice.
+Higher scores correspond to sharper images.
+
+from acquifer import focusmetrics
+
+bestSlices = focusmetrics.getBestSlices(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default", metric="tenengrad", channel=1)
+bestSlices[("A001", 1, 1, 1)] # best SL index for well A001, subposition 1, channel 1, timepoint 1
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import metadata, utils
+from .dataset import Dataset
+
+def _asFloat(image):
+	image = np.asarray(image)
+	if image.ndim < 2:
+		raise ValueError("Expected an image or a stack of images, with at least 2 dimensions.")
+	return image.astype(np.float32, copy=False)
+
+def varianceOfLaplacian(image):
+	"""Variance of the Laplacian (4-neighbours) of the image, computed on the image interior."""
+	image = _asFloat(image)
+	laplacian = (image[..., :-2, 1:-1] + image[..., 2:, 1:-1] + image[..., 1:-1, :-2] + image[..., 1:-1, 2:]
+				 - 4 * image[..., 1:-1, 1:-1])
+	return laplacian.var(axis=(-2, -1))
+
+def brenner(image):
+	"""Brenner gradient : mean squared difference between pixels 2 apart, along the rows and the columns."""
+	image = _asFloat(image)
+	dx = image[..., :, 2:] - image[..., :, :-2]
+	dy = image[..., 2:, :] - image[..., :-2, :]
+	return (dx**2).mean(axis=(-2, -1)) + (dy**2).mean(axis=(-2, -1))
+
+def tenengrad(image):
+	"""Tenengrad : mean squared magnitude of the Sobel gradient, computed on the image interior."""
+	image = _asFloat(image)
+
+	# Sobel filters as separable sums of shifted slices
+	smoothY = image[..., :-2, :] + 2 * image[..., 1:-1, :] + image[..., 2:, :]
+	smoothX = image[..., :, :-2] + 2 * image[..., :, 1:-1] + image[..., :, 2:]
+	gx = smoothY[..., :, 2:] - smoothY[..., :, :-2]
+	gy = smoothX[..., 2:, :] - smoothX[..., :-2, :]
+	return (gx**2 + gy**2).mean(axis=(-2, -1))
+
+def normalizedVariance(image):
+	"""Variance of the intensities divided by the mean intensity, less sensitive to illumination changes than the plain variance."""
+	image = _asFloat(image)
+	mean = image.mean(axis=(-2, -1))
+	return image.var(axis=(-2, -1)) / np.maximum(mean, np.finfo(np.float32).eps)
+
+focusMetrics = {"varianceOfLaplacian" : varianceOfLaplacian,
+				"brenner"             : brenner,
+				"tenengrad"           : tenengrad,
+				"normalizedVariance"  : normalizedVariance}
+
+def getFocusMetric(metric):
+	"""Return a focus metric function from its name (see focusMetrics), a callable is returned as is."""
+	if callable(metric):
+		return metric
+
+	if metric not in focusMetrics:
+		raise ValueError("Focus metric must be one of {}.".format(list(focusMetrics)))
+
+	return focusMetrics[metric]
+
+def scoreStack(stack, metric="varianceOfLaplacian"):
+	"""Return the focus scores of each slice of a stack (slice, y, x) as a 1D array."""
+	stack = np.asarray(stack)
+	if stack.ndim != 3:
+		raise ValueError("Expected a stack with 3 dimensions (slice, y, x).")
+
+	return np.asarray(getFocusMetric(metric)(stack), np.float64)
+
+def _scoreFiles(paths, metric, reader):
+	"""Score a stack stored as one image file per slice."""
+	return scoreStack(np.stack([reader(path) for path in paths]), metric)
+
+def scoreDataset(directory, metric="varianceOfLaplacian", nWorkers=None, reader=utils.readImage, **criteria):
+	"""
+	Score the focus of every slice of the Z-stacks of a dataset, with the stacks scored in parallel in a pool of threads.
+
+	Parameters
+	----------
+	directory : str or Dataset
+		directory with the IM images, or a Dataset.
+
+	metric : str or callable, optional
+		name of a focus metric (see focusMetrics) or a function image -> score. The default is "varianceOfLaplacian".
+
+	nWorkers : int, optional
+		number of threads. The default is None, ie the default of ThreadPoolExecutor.
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+
+	Returns
+	-------
+	dict
+		(well, subposition, channel, timepoint) -> (array of SL indexes, array of scores), sorted by SL index.
+	"""
+	dataset = directory if isinstance(directory, Dataset) else Dataset(directory)
+	metric = getFocusMetric(metric)
+
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	stacks = dataset.groupBy("well", "subposition", "channel", "timepoint")
+	for stack in stacks.values():
+		stack.filenames.sort(key=metadata.getZSlice)
+
+	with ThreadPoolExecutor(nWorkers) as executor:
+		futures = {key : executor.submit(_scoreFiles, stack.paths, metric, reader) for key, stack in stacks.items()}
+		return {key : (np.array(stacks[key].getValues("zSlice")), future.result()) for key, future in futures.items()}
+
+def getBestSlices(directory, metric="varianceOfLaplacian", nWorkers=None, reader=utils.readImage, **criteria):
+	"""
+	Return the SL index of the sharpest slice of each Z-stack of a dataset, as a dictionary (well, subposition, channel, timepoint) -> SL index.
+	See scoreDataset for the parameters.
+	"""
+	scores = scoreDataset(directory, metric, nWorkers, reader, **criteria)
+	return {key : int(zSlices[np.argmax(stackScores)]) for key, (zSlices, stackScores) in scores.items()}
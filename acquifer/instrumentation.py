@@ -0,0 +1,367 @@
+"""
+Per-command instrumentation for the TcpIp communication with the IM.
+
+When at least one hook is registered on a TcpIp object (see TcpIp.addCommandHook), a CommandRecord is created for every command sent to the IM.
+The record holds the send time, the time until the first reply from the IM, the total round-trip time, the size of the reply and a command category (move, lid, mode...).
+Once the command is completed, the record is passed to every hook.
+
+A hook is any callable taking a CommandRecord as single argument, for instance
+- a custom function, or list.append to simply collect the records
+- a LoggingHook, to log each command with the python logging module
+- a HistogramHook, to aggregate the round-trip times per plate and per command category, and export a summary
+
+from acquifer.tcpip import TcpIp
+from acquifer.instrumentation import HistogramHook
+
+myIM = TcpIp()
+stats = HistogramHook()
+myIM.addCommandHook(stats)
+# ... run the acquisition
+stats.exportSummary("timings.json")
+"""
+import time, json, csv, logging, bisect
+
+# Map the name of the IM commands to a category, used to aggregate timings
+commandCategories = {"GotoXY"            : "move",
+					 "GotoZ"             : "move",
+					 "GotoXYZ"           : "move",
+					 "OpenLid"           : "lid",
+					 "CloseLid"          : "lid",
+					 "LidClosed"         : "lid",
+					 "LidOpened"         : "lid",
+					 "LiveModeActive"    : "mode",
+					 "SetScriptMode"     : "mode",
+					 "SettingModeOn"     : "mode",
+					 "SettingModeOff"    : "mode",
+					 "Acquire"           : "acquire",
+					 "SoftwareAutofocus" : "autofocus",
+					 "HardwareAutofocus" : "autofocus",
+					 "SetBrightField"    : "light",
+					 "SetFluoChannel"    : "light",
+					 "SetCamera"         : "camera",
+					 "SetBinning"        : "camera",
+					 "SetObjective"      : "objective",
+					 "GetObjective"      : "objective",
+					 "SetImageFileNameAttribute" : "metadata",
+					 "SetDefaultProjectFolder"   : "metadata",
+					 "SetPlateId"                : "metadata",
+					 "GetTemperatureRegulation"  : "temperature",
+					 "SetTemperatureRegulation"  : "temperature",
+					 "GetAmbientTemperature"     : "temperature",
+					 "GetSampleTemperature"      : "temperature",
+					 "GetTargetTemperature"      : "temperature",
+					 "SetTargetTemperature"      : "temperature",
+					 "RunScript"         : "script",
+					 "StopScript"        : "script",
+					 "GetCountWellsX"    : "query",
+					 "GetCountWellsY"    : "query",
+					 "GetXPosition"      : "query",
+					 "GetYPosition"      : "query",
+					 "GetZPosition"      : "query",
+					 "Log"               : "log"}
+
+def getCommandName(command):
+	"""Return the name of an IM command, ex: 'GotoXY' for 'GotoXY(10.000, 20.000, GotoMode.Abs)'."""
+	return command.split("(", 1)[0].strip()
+
+def getCommandCategory(command):
+	"""Return the category of an IM command (ex: 'move', 'lid', 'mode'...), or 'other' for unknown commands."""
+	return commandCategories.get(getCommandName(command), "other")
+
+
+class CommandRecord(object):
+	"""
+	Timing information for a single command sent to the IM.
+	The time to first byte and round-trip time are measured from the end of the fixed wait after sending the command (sendDelay, see TcpIp.sendCommand),
+	so that they only contain the processing time of the IM.
+	"""
+
+	__slots__ = ("command", "category", "plateId", "sendTime", "timeToFirstByte", "roundTripTime", "replySize", "reply", "sendDelay", "_t0")
+
+	def __init__(self, command, plateId=""):
+		"""
+		Create a new record, the send time is set to the current time.
+
+		Parameters
+		----------
+		command : str
+			command string as sent to the IM.
+
+		plateId : str, optional
+			plate ID at the time the command was sent, used to aggregate the timings per plate.
+		"""
+		self.command  = command
+		self.category = getCommandCategory(command)
+		self.plateId  = plateId
+		self.sendTime = time.time() # wall-clock time, as seconds since the epoch
+		self.timeToFirstByte = None # in seconds, None if no reply was received
+		self.roundTripTime   = 0.0  # in seconds, until the last reply
+		self.replySize = 0          # in bytes
+		self.reply     = ""
+		self.sendDelay = 0.0        # in seconds, wait after sending the command, excluded from the timings
+		self._t0 = time.perf_counter()
+
+	def startTimer(self):
+		"""Start the timings at the current time, ex: after the fixed wait following the sending of the command. The time elapsed since the creation of the record is stored as sendDelay."""
+		now = time.perf_counter()
+		self.sendDelay = now - self._t0
+		self._t0 = now
+
+	def addReply(self, reply):
+		"""Update the record with a reply received from the IM (some commands receive several replies)."""
+		elapsed = time.perf_counter() - self._t0
+
+		if self.timeToFirstByte is None:
+			self.timeToFirstByte = elapsed
+
+		self.roundTripTime = elapsed
+		self.replySize += len(reply)
+		self.reply += reply
+
+	def toDict(self):
+		"""Return the record as a dictionary, for instance for export as json."""
+		return {"command"         : self.command,
+				"category"        : self.category,
+				"plateId"         : self.plateId,
+				"sendTime"        : self.sendTime,
+				"timeToFirstByte" : self.timeToFirstByte,
+				"roundTripTime"   : self.roundTripTime,
+				"replySize"       : self.replySize,
+				"reply"           : self.reply,
+				"sendDelay"       : self.sendDelay}
+
+	def __repr__(self):
+		return "CommandRecord({!r}, category={}, roundTripTime={:.3f}s)".format(self.command, self.category, self.roundTripTime)
+
+
+class LoggingHook(object):
+	"""Hook logging every command record with the python logging module."""
+
+	def __init__(self, logger=None, level=logging.DEBUG):
+		"""
+		Parameters
+		----------
+		logger : logging.Logger, optional
+			logger used for the records. The default is the logger of this module.
+
+		level : int, optional
+			logging level of the records. The default is logging.DEBUG.
+		"""
+		self.logger = logger if logger else logging.getLogger(__name__)
+		self.level = level
+
+	def __call__(self, record):
+		if not self.logger.isEnabledFor(self.level):
+			return
+
+		self.logger.log(self.level,
+						"%s - %s - %.1f ms (first byte %.1f ms) - %d bytes",
+						record.command,
+						record.category,
+						record.roundTripTime * 1000,
+						(record.timeToFirstByte or 0) * 1000,
+						record.replySize,
+						extra = {"command" : record.command,
+								 "category" : record.category,
+								 "duration" : record.roundTripTime})
+
+
+def getDefaultBinEdges():
+	"""Return log-spaced histogram bin edges in seconds, from 1 ms to 1000 s, with 10 bins per decade."""
+	return [10**(exponent/10) for exponent in range(-30, 31)]
+
+class _Aggregate(object):
+	"""Aggregated timings for one plate and command category."""
+
+	__slots__ = ("count", "total", "totalFirstByte", "minimum", "maximum", "replySize", "counts")
+
+	def __init__(self, nBins):
+		self.count = 0
+		self.total = 0.0
+		self.totalFirstByte = 0.0
+		self.minimum = float("inf")
+		self.maximum = 0.0
+		self.replySize = 0
+		self.counts = [0] * nBins
+
+class HistogramHook(object):
+	"""
+	Hook aggregating the round-trip time of the commands in histograms, per plate ID and per command category.
+	The memory usage is fixed, independently of the number of commands.
+	"""
+
+	def __init__(self, binEdges=None):
+		"""
+		Parameters
+		----------
+		binEdges : list of float, optional
+			sorted edges of the histogram bins in seconds. Durations outside the edges are counted in the first/last bin.
+			The default is log-spaced bins between 1 ms and 1000 s, see getDefaultBinEdges.
+		"""
+		self.binEdges = list(binEdges) if binEdges else getDefaultBinEdges()
+
+		if len(self.binEdges) < 2:
+			raise ValueError("At least 2 bin edges are needed.")
+
+		self._aggregates = {} # plateId -> category -> _Aggregate
+
+	def __call__(self, record):
+		categories = self._aggregates.setdefault(record.plateId, {})
+		aggregate = categories.get(record.category)
+
+		if aggregate is None:
+			aggregate = categories[record.category] = _Aggregate(len(self.binEdges)-1)
+
+		duration = record.roundTripTime
+		aggregate.count += 1
+		aggregate.total += duration
+		aggregate.totalFirstByte += record.timeToFirstByte or 0
+		aggregate.minimum = min(aggregate.minimum, duration)
+		aggregate.maximum = max(aggregate.maximum, duration)
+		aggregate.replySize += record.replySize
+
+		index = bisect.bisect_right(self.binEdges, duration) - 1
+		index = min(max(index, 0), len(aggregate.counts)-1)
+		aggregate.counts[index] += 1
+
+	def reset(self):
+		"""Discard all aggregated timings."""
+		self._aggregates = {}
+
+	def getPercentile(self, aggregate, percentile):
+		"""
+		Return an estimate of a percentile (0-100) of the durations for an aggregate, as the upper edge of the histogram bin containing this percentile.
+		The estimate is clipped to the min/max durations actually measured.
+		"""
+		threshold = aggregate.count * percentile / 100
+		cumulated = 0
+		edge = self.binEdges[-1]
+		for index, count in enumerate(aggregate.counts):
+			cumulated += count
+			if cumulated >= threshold:
+				edge = self.binEdges[index+1]
+				break
+
+		return min(max(edge, aggregate.minimum), aggregate.maximum)
+
+	def summary(self):
+		"""
+		Return a dictionary plateId -> category -> statistics, with the number of commands, total/mean/min/max round-trip times in seconds,
+		percentile estimates (p50, p90, p99), the mean time to first byte, the total reply size and the fraction of the plate time spent in this category.
+		"""
+		out = {}
+		for plateId, categories in self._aggregates.items():
+
+			plateTotal = sum(aggregate.total for aggregate in categories.values())
+			plateSummary = out[plateId] = {}
+
+			# Sort categories by decreasing total time, so the dominant categories come first
+			for category, aggregate in sorted(categories.items(), key=lambda item: item[1].total, reverse=True):
+				plateSummary[category] = {"count"               : aggregate.count,
+										  "total_s"             : aggregate.total,
+										  "mean_s"              : aggregate.total / aggregate.count,
+										  "min_s"               : aggregate.minimum,
+										  "max_s"               : aggregate.maximum,
+										  "p50_s"               : self.getPercentile(aggregate, 50),
+										  "p90_s"               : self.getPercentile(aggregate, 90),
+										  "p99_s"               : self.getPercentile(aggregate, 99),
+										  "meanTimeToFirstByte_s" : aggregate.totalFirstByte / aggregate.count,
+										  "replySize_bytes"     : aggregate.replySize,
+										  "fraction"            : aggregate.total / plateTotal if plateTotal else 0.0}
+
+		return out
+
+	def exportSummary(self, path):
+		"""
+		Export the per-plate summary to a .json or .csv file.
+		The csv file has one row per plate and command category.
+		"""
+		summary = self.summary()
+
+		if path.lower().endswith(".json"):
+			with open(path, "w") as jsonFile:
+				json.dump(summary, jsonFile, indent=2)
+
+		elif path.lower().endswith(".csv"):
+			with open(path, "w", newline="") as csvFile:
+				writer = None
+				for plateId, categories in summary.items():
+					for category, stats in categories.items():
+
+						row = {"plateId" : plateId, "category" : category}
+						row.update(stats)
+
+						if writer is None:
+							writer = csv.DictWriter(csvFile, fieldnames=list(row.keys()))
+							writer.writeheader()
+
+						writer.writerow(row)
+
+		else:
+			raise ValueError("Summary can be exported as .json or .csv file only.")
+
+
+class ProgressReporter(object):
+	"""
+	Hook reporting the progress of long acquisitions, at most once every `interval` seconds, independently of the number of commands.
+	Each report gives the elapsed time, the number of commands, moves and acquisitions, and an estimate of the remaining time when the total number of acquisitions is known.
+
+	myIM.addCommandHook(ProgressReporter(interval=30, nAcquisitions=384))
+	"""
+
+	def __init__(self, interval=10, nAcquisitions=None, report=print):
+		"""
+		Parameters
+		----------
+		interval : float, optional
+			minimal time in seconds between 2 reports. The default is 10.
+
+		nAcquisitions : int, optional
+			expected total number of acquire commands, used to estimate the remaining time. The default is None (no estimate).
+
+		report : callable, optional
+			function called with the progress message. The default is print, a logger method can be used instead, ex: logging.getLogger("acquifer").info
+		"""
+		if interval < 0:
+			raise ValueError("Interval must be a positive number of seconds.")
+
+		self.interval = interval
+		self.nAcquisitions = nAcquisitions
+		self.report = report
+		self.nCommands = 0
+		self.nMoves = 0
+		self.nAcquired = 0
+		self._start = None
+		self._lastReport = None
+
+	def __call__(self, record):
+		now = time.monotonic()
+
+		if self._start is None:
+			self._start = self._lastReport = now
+
+		self.nCommands += 1
+		if record.category == "move":
+			self.nMoves += 1
+
+		elif record.category == "acquire":
+			self.nAcquired += 1
+
+		if now - self._lastReport >= self.interval:
+			self._lastReport = now
+			self.report(self.getMessage(now))
+
+	def getMessage(self, now=None):
+		"""Return the current progress message."""
+		elapsed = (now if now is not None else time.monotonic()) - (self._start or 0)
+		message = "{:.0f}s elapsed - {} commands ({:.1f}/s) - {} moves - {} acquisitions".format(elapsed,
+																								  self.nCommands,
+																								  self.nCommands / elapsed if elapsed else 0,
+																								  self.nMoves,
+																								  self.nAcquired)
+
+		if self.nAcquisitions and self.nAcquired:
+			remaining = elapsed / self.nAcquired * max(self.nAcquisitions - self.nAcquired, 0)
+			message += " / {} - about {:.0f}s remaining".format(self.nAcquisitions, remaining)
+
+		return message
@@ -0,0 +1,240 @@
+"""
+Append-only journal of the commands sent to the IM, and replay of a journal against the IM simulator (or an IM).
+
+The journal has one json line per command, with the send time, the command, the reply and the durations (the fields of CommandRecord.toDict, without the derived ones).
+Each line is flushed once the command has completed, so that the journal is complete up to the last command when a run fails.
+Journals ending with .gz are gzip-compressed (the last commands may then be lost if the process crashes).
+
+from acquifer.tcpip import TcpIp
+from acquifer import journal
+
+myIM = TcpIp(journal="run.jsonl") # or myIM.addCommandHook(journal.JournalHook("run.jsonl"))
+... # acquisition
+
+report = journal.replay("run.jsonl")            # as fast as possible, against a local ImSimulatorServer (without the 50ms wait after each command)
+report = journal.replay("run.jsonl", speed=1)   # with the original timing
+report = journal.replay("run.jsonl", start=100, stop=200) # part of the journal, ex: to bisect a failure
+report.summary()
+report.mismatches # commands whose reply differs from the journal
+
+The entries returned by readJournal can also calibrate a duration model, see acquifer.dryrun.CostModel.fromRecords.
+"""
+import gzip
+import json
+import time
+import socket
+import logging
+import threading
+from .version import __version__
+from .instrumentation import CommandRecord, getCommandCategory
+from .simulator import ImSimulatorServer
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+journalFields = ("sendTime", "command", "reply", "timeToFirstByte", "roundTripTime", "plateId")
+
+def _open(path, mode):
+	return gzip.open(path, mode + "t", encoding="ascii") if path.endswith(".gz") else open(path, mode, encoding="ascii")
+
+
+class JournalHook(object):
+	"""Command hook appending each CommandRecord to a journal file, see TcpIp.addCommandHook."""
+
+	def __init__(self, path):
+		"""
+		Parameters
+		----------
+		path : str
+			journal file, created if not existing, otherwise the commands are appended. Use a .gz extension for a compressed journal.
+		"""
+		self.path = path
+		self.nEntries = 0
+		self._lock = threading.Lock()
+		self._file = _open(path, "a")
+		self._write({"journal" : 1, "version" : __version__, "startTime" : time.time()}) # header, one per session
+
+	def _write(self, entry):
+		self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+		self._file.flush()
+
+	def __call__(self, record):
+		with self._lock:
+			if self._file.closed:
+				return
+			self._write({field : getattr(record, field) for field in journalFields})
+			self.nEntries += 1
+
+	def close(self):
+		"""Close the journal file, further records are ignored."""
+		with self._lock:
+			if not self._file.closed:
+				self._file.close()
+
+	def __repr__(self):
+		return "JournalHook({!r}, {} entries)".format(self.path, self.nEntries)
+
+
+def readJournal(path):
+	"""Return the entries of a journal as a list of dictionaries (see journalFields), in the order the commands were sent. The session headers are skipped."""
+	entries = []
+	with _open(path, "r") as journalFile:
+		for line in journalFile:
+			if not line.strip():
+				continue
+
+			try:
+				entry = json.loads(line)
+			except ValueError: # line truncated by a crash
+				logger.warning("Skipped incomplete journal line : %s", line.strip())
+				continue
+
+			if "command" in entry:
+				entries.append(entry)
+
+	return entries
+
+
+class ReplayReport(object):
+	"""Results of a journal replay : recorded and replayed reply and round-trip time of each command."""
+
+	def __init__(self, entries, replies, roundTripTimes, duration, start=0, sendDelay=0.05):
+		self.entries = entries
+		self.replies = replies
+		self.roundTripTimes = roundTripTimes
+		self.duration = duration # s, of the replay
+		self.start = start # index of the first replayed entry in the journal
+		self.sendDelay = sendDelay # s, wait after sending each command
+
+	@property
+	def mismatches(self):
+		"""
+		Return the list of (index in the journal, command, recorded reply, replayed reply) of the commands whose reply differs from the journal.
+		Note that the image directories returned by Acquire or RunScript contain a timestamp, and usually differ.
+		"""
+		return [(self.start + index, entry["command"], entry["reply"], reply) for index, (entry, reply) in enumerate(zip(self.entries, self.replies)) if reply != entry["reply"]]
+
+	def getRecords(self):
+		"""Return the replayed commands as CommandRecords, ex: to aggregate them with a HistogramHook or calibrate a CostModel."""
+		records = []
+		for entry, reply, roundTripTime in zip(self.entries, self.replies, self.roundTripTimes):
+			record = CommandRecord(entry["command"], entry.get("plateId", ""))
+			record.reply, record.replySize = reply, len(reply)
+			record.roundTripTime = record.timeToFirstByte = roundTripTime
+			record.sendDelay = self.sendDelay
+			records.append(record)
+		return records
+
+	def summary(self):
+		"""
+		Return a dictionary with the number of replayed commands and of mismatching replies, the index of the first mismatch (None if none),
+		the recorded and replayed durations, and the total recorded and replayed round-trip times per command category.
+		"""
+		recorded, replayed = {}, {}
+		for entry, roundTripTime in zip(self.entries, self.roundTripTimes):
+			category = getCommandCategory(entry["command"])
+			recorded[category] = recorded.get(category, 0.0) + entry["roundTripTime"]
+			replayed[category] = replayed.get(category, 0.0) + roundTripTime
+
+		mismatches = self.mismatches
+		recordedDuration = self.entries[-1]["sendTime"] + self.entries[-1]["roundTripTime"] - self.entries[0]["sendTime"] if self.entries else 0.0
+
+		return {"nCommands"          : len(self.replies),
+				"nMismatches"        : len(mismatches),
+				"firstMismatch"      : mismatches[0][0] if mismatches else None,
+				"recordedDuration_s" : recordedDuration,
+				"replayDuration_s"   : self.duration,
+				"recordedByCategory" : recorded,
+				"replayedByCategory" : replayed}
+
+
+def _receive(connection, expectedSize, timeout):
+	"""Read replies until expectedSize characters were received, or until no data is received for timeout seconds."""
+	reply = ""
+	connection.settimeout(timeout)
+	while len(reply) < expectedSize:
+		try:
+			data = connection.recv(4096)
+		except socket.timeout:
+			break
+		if not data:
+			break
+		reply += data.decode("ascii")
+	return reply
+
+def replay(journal, port=None, host="::1", speed=None, start=0, stop=None, simulatedIM=None, replyTimeout=5, sendDelay=None):
+	"""
+	Send the commands of a journal again, and compare the replies with the recorded ones.
+
+	Parameters
+	----------
+	journal : str or list of dict
+		journal file, or entries returned by readJournal.
+
+	port, host : optional
+		address of the IM control software to replay against. The default is None, ie a local ImSimulatorServer started for the replay.
+
+	speed : float, optional
+		replay speed relative to the recorded timing, ex: 1 for the original timing, 10 for 10 times faster.
+		The default is None, ie as fast as possible : each command is sent as soon as the reply of the previous one is received.
+
+	start, stop : int, optional
+		replay only the entries start to stop (excluded), ex: to bisect a failure. The default is the whole journal.
+
+	simulatedIM : SimulatedIM, optional
+		simulated IM for the local simulator, ex: with the plate format or focus surface of the original run. The default is None, ie a 96-well plate.
+
+	replyTimeout : float, optional
+		time in seconds without data after which a reply shorter than the recorded one is considered complete. The default is 5.
+		It is extended to twice the recorded round-trip time for long commands.
+
+	sendDelay : float, optional
+		wait in seconds after sending each command, as TcpIp.sendCommand, excluded from the round-trip times.
+		The default is None, ie 0.05 s when replaying against an IM or with a speed, and no wait when replaying as fast as possible against the local simulator.
+
+	Returns
+	-------
+	ReplayReport
+	"""
+	from .tcpip import _connect # avoid circular import, tcpip imports this module for the journal option
+
+	entries = (readJournal(journal) if isinstance(journal, str) else list(journal))[start:stop]
+
+	server = None
+	if port is None:
+		server = ImSimulatorServer(simulatedIM, replyGap=0.1 if speed else 0).start() # the replies are read up to their recorded size, they can be merged
+		host, port = server.host, server.port
+
+	if sendDelay is None:
+		sendDelay = 0 if server is not None and not speed else 0.05
+
+	connection = _connect(host, port)
+	replies, roundTripTimes = [], []
+	t0 = time.perf_counter()
+
+	try:
+		for entry in entries:
+			if speed:
+				delay = (entry["sendTime"] - entries[0]["sendTime"]) / speed - (time.perf_counter() - t0)
+				if delay > 0:
+					time.sleep(delay)
+
+			connection.sendall(entry["command"].encode("ascii"))
+			if sendDelay:
+				time.sleep(sendDelay) # as TcpIp.sendCommand, so that successive commands are not merged (the local simulator separates them)
+			sendTime = time.perf_counter()
+
+			reply = _receive(connection, len(entry["reply"]), max(replyTimeout, 2 * entry["roundTripTime"])) if entry["reply"] else ""
+
+			roundTripTimes.append(time.perf_counter() - sendTime)
+			replies.append(reply)
+
+			if reply != entry["reply"]:
+				logger.info("Reply mismatch for command %d %s : %r instead of %r", start + len(replies) - 1, entry["command"], reply, entry["reply"])
+
+	finally:
+		connection.close()
+		if server is not None:
+			server.stop()
+
+	return ReplayReport(entries, replies, roundTripTimes, time.perf_counter() - t0, start, sendDelay)
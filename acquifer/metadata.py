@@ -3,9 +3,13 @@ Extract metadata from image-filename for images acquired with the IM04.
 
 This class contains a set of function to extract metadata by parsing the image file names string of images acquired on an IM04
 example filename : "-A001--PO01--LO001--CO6--SL001--PX32500--PW0080--IN0020--TM244--X014580--Y011262--Z209501--T1374031802--WE00001.tif"
+The fields are located with the filename schema of acquifer.naming, which also decodes arrays of filenames at once (naming.decodeArray).
 """
 from __future__ import division
-import string
+from . import naming
+
+# Single-filename parsers of the metadata, with a fast path for the IM04 filenames (see naming.getParser)
+_parsers = {key : naming.getParser(key) for key in ("positionX", "positionY", "subposition", "positionZ", "pixelSize", "well", "column", "row", "wellNumber", "zSlice", "channel", "timepoint", "time", "lightPower", "exposure", "temperature")}
 
 magToNA = {2:0.06, 
 		   4:0.13, 
@@ -13,76 +17,65 @@ magToNA = {2:0.06,
 		   20:0.45,
 		   40:0.6}
 
+def _getter(name, key, doc):
+	"""Return the getter of one metadata, with fixed slices for the IM04 filenames (see naming.getParser) : the getters are called for every image."""
+	getter = _parsers[key]
+	getter.__name__ = getter.__qualname__ = name
+	getter.__module__ = __name__
+	getter.__doc__ = doc
+	return getter
+
 def getPositionXY_mm(filename):
 	"""Extract the XY-axis coordinates (in mm) from the image filename. The coordinates corresponds to the objective XY coordinate and the center of the image if using the full field of view of the camera."""
-	# Parse string + do conversion
-	x0mm = int(filename[65:71]) /1000 # >0
-	y0mm = int(filename[74:80]) /1000
-	
-	return x0mm, y0mm
+	return _parsers["positionX"](filename), _parsers["positionY"](filename)
 
-def getWellSubPosition(filename):
-	"""Extract the index corresponding to the subposition for that well."""
-	return int(filename[9:11])
+getWellSubPosition = _getter("getWellSubPosition", "subposition",
+	"""Extract the index corresponding to the subposition for that well.""")
 
-def getPositionZ_um(filename):
-	"""Extract the Z-axis coordinates (in um)."""
-	return float(filename[83:89])/10
+getPositionZ_um = _getter("getPositionZ_um", "positionZ",
+	"""Extract the Z-axis coordinates (in um).""")
 	
-def getPixelSize_um(filename):
-	"""Extract the pixel size (in um) from the filename."""
-	return float(filename[34:39])*10**-4
+getPixelSize_um = _getter("getPixelSize_um", "pixelSize",
+	"""Extract the pixel size (in um) from the filename.""")
+	
+getWellId = _getter("getWellId", "well",
+	"""Extract well Id (ex:A001) from the filename (for IM4).""")
+
+getWellColumn = _getter("getWellColumn", "column",
+	"""Extract well column (1-12) from the filename (for IM4).""")
+
+getWellRow = _getter("getWellRow", "row",
+	"""Extract well row (1-8) from the filename (for IM4).""")
+
+getWellIndex = _getter("getWellIndex", "wellNumber",
+	"""Return well number corresponding to order of acquisition by the IM (snake pattern).""")
 	
-def getWellId(filename):
-	"""Extract well Id (ex:A001) from the filename (for IM4)."""
-	return filename[1:5]
-
-def getWellColumn(filename):
-	"""Extract well column (1-12) from the filename (for IM4)."""
-	return int(filename[2:5])
-
-def getWellRow(filename):
-	"""Extract well row (1-8) from the filename (for IM4)."""
-	letter = filename[1:2]
-	return string.ascii_uppercase.index(letter)+1 # alphabetical order +1 since starts at 0
-
-def getWellIndex(filename):
-	"""Return well number corresponding to order of acquisition by the IM (snake pattern)."""
-	return int(filename[106:111]) 
+getZSlice = _getter("getZSlice", "zSlice",
+	"""Return image slice number of the associated Z-Stack serie.""")
+
+getChannelIndex = _getter("getChannelIndex", "channel",
+	"""
+	Return integer index of the image channel.
 	
-def getZSlice(filename):
-	"""Return image slice number of the associated Z-Stack serie."""
-	return int(filename[27:30])
-
-def getChannelIndex(filename):
-    """
-    Return integer index of the image channel.
-    
-    1 = DAPI (385)
-    3 = FITC (GFP...)
-    5 = TRITC (mCherry...)
-    """
-    return int(filename[22:23])
-
-def getTimepoint(filename):
-	"""Return the integer index corresponding to the image timepoint."""
-	return int(filename[15:18])
-
-def getTime(filename):
-    """Return the time at which the image was recorded."""
-    return int(filename[92:102])
-    
-def getLightPower(filename):
-	"""Return relative power (%) used for the acquisition with this channel."""
-	return int(filename[43:47])
+	1 = DAPI (385)
+	3 = FITC (GFP...)
+	5 = TRITC (mCherry...)
+	""")
+
+getTimepoint = _getter("getTimepoint", "timepoint",
+	"""Return the integer index corresponding to the image timepoint.""")
+
+getTime = _getter("getTime", "time",
+	"""Return the time at which the image was recorded.""")
+
+getLightPower = _getter("getLightPower", "lightPower",
+	"""Return relative power (%) used for the acquisition with this channel.""")
 	
-def getExposure(filename):
-	"""Return exposure time in ms used for the acquisition with this channel."""
-	return int(filename[51:55])
+getExposure = _getter("getExposure", "exposure",
+	"""Return exposure time in ms used for the acquisition with this channel.""")
 
-def getTemperature(filename):
-	"""Return temperature in celsius degrees as measured by the probe at time of acquisition."""
-	return float(filename[59:62])/10
+getTemperature = _getter("getTemperature", "temperature",
+	"""Return temperature in celsius degrees as measured by the probe at time of acquisition.""")
 
 def convertXY_PixToIM(Xpix, Ypix, PixelSize_um, X0mm, Y0mm, Image_Width=2048, Image_Height=2048):
 	"""
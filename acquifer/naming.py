@@ -0,0 +1,453 @@
+"""
+Encoding and decoding of the IM image filenames, from a table describing the metadata tags.
+
+The IM names each image with a sequence of tagged fixed-width fields, ex:
+-A001--PO01--LO001--CO6--SL001--PX32500--PW0080--IN0020--TM244--X014580--Y011262--Z209501--T1374031802--WE00001.tif
+
+A FilenameSchema compiles the list of (tag, number of digits) into character offsets once,
+then the same offsets are used to decode a single filename, to decode arrays of filenames with numpy, and to build filenames.
+The schema of a filename is detected automatically : the known schemas are checked first, otherwise the fields widths are read from the filename itself.
+IM04 filenames skip the detection : they are recognized by their length and the position of the WE tag, and parsed with fixed slices (see getParser).
+
+from acquifer import naming
+
+naming.decode(filename)["positionX"] # 14.58 (mm)
+values = naming.decodeArray(filenames, ["well", "channel", "zSlice"]) # dictionary of numpy arrays
+filename = naming.encode(well="B002", channel=1, zSlice=3, positionX=14.58)
+"""
+import operator
+import os
+import re
+import numpy as np
+from . import utils
+
+# Tags of the filename fields : tag -> (metadata name, divisor), the value in the filename is the metadata value multiplied by the divisor, ex: X014580 is 14.58 mm
+# The well ID (ex: A001) is the first field, without tag. None as divisor for text fields.
+tags = {""   : ("well",        None),
+		"PO" : ("subposition", 1),
+		"LO" : ("timepoint",   1),
+		"CO" : ("channel",     1),
+		"SL" : ("zSlice",      1),
+		"PX" : ("pixelSize",   10000), # µm
+		"PW" : ("lightPower",  1),     # %
+		"IN" : ("exposure",    1),     # ms
+		"TM" : ("temperature", 10),    # °C
+		"X"  : ("positionX",   1000),  # mm
+		"Y"  : ("positionY",   1000),  # mm
+		"Z"  : ("positionZ",   10),    # µm
+		"T"  : ("time",        1),     # s
+		"WE" : ("wellNumber",  1)}
+
+# Values used when building a filename without some of the metadata
+defaults = {"subposition" : 1,
+			"timepoint"   : 1,
+			"channel"     : 1,
+			"zSlice"      : 1,
+			"pixelSize"   : 0,
+			"lightPower"  : 0,
+			"exposure"    : 0,
+			"temperature" : 0,
+			"positionX"   : 0,
+			"positionY"   : 0,
+			"positionZ"   : 0,
+			"time"        : 0,
+			"wellNumber"  : 1}
+
+def _parseWellID(wellID):
+	"""Return the plate row and column (starting at 1) of a well ID, ex: (1, 1) for A001, (32, 48) for AF48."""
+	if wellID[1].isdigit():
+		return ord(wellID[0]) - 64, int(wellID[1:])
+
+	return (ord(wellID[0]) - 64) * 26 + ord(wellID[1]) - 64, int(wellID[2:])
+
+
+class FilenameSchema(object):
+	"""Layout of the IM image filenames : ordered fields of fixed width, written as <tag><value> and separated by --, after a leading -."""
+
+	def __init__(self, fields, name=None, extension=".tif"):
+		"""
+		Parameters
+		----------
+		fields : list of (str, int)
+			tag (see tags, "" for the well ID) and number of characters of the value, in filename order.
+
+		name : str, optional
+			version name of the schema, ex: "IM04". The default is None, ie a schema detected from a filename.
+
+		extension : str, optional
+			file extension of the images. The default is ".tif".
+		"""
+		self.fields = tuple((tag, int(width)) for tag, width in fields)
+		self.name = name
+		self.extension = extension
+
+		if not self.fields or self.fields[0][0] != "":
+			raise ValueError("The first field of a filename schema must be the well ID, with an empty tag.")
+
+		if len({tag for tag, _ in self.fields}) != len(self.fields):
+			raise ValueError("Each tag can appear only once in a filename schema.")
+
+		for tag, width in self.fields:
+			if tag not in tags:
+				raise ValueError("Unknown filename tag '{}', should be one of {}.".format(tag, list(tags)))
+			if width < 1:
+				raise ValueError("The width of the field {} must be >= 1.".format(tag))
+
+		if self.fields[0][1] != 4:
+			raise ValueError("The well ID field must have 4 characters.")
+
+		# Compile the offsets : metadata name -> (start, end, divisor), and the fixed characters of the filename
+		self._slices = {}
+		markers = []
+		position = 0
+		for index, (tag, width) in enumerate(self.fields):
+			marker = ("-" if index == 0 else "--") + tag
+			markers.append((position, marker))
+			start = position + len(marker)
+			name, divisor = tags[tag]
+			self._slices[name] = (start, start + width, divisor)
+			position = start + width
+
+		self.length = position + len(extension)
+		self._markers = tuple((start, start + len(text), text) for start, text in markers)
+		self._pattern = re.compile("".join(re.escape(("-" if index == 0 else "--") + tag) + ".{{{}}}".format(width) for index, (tag, width) in enumerate(self.fields)), re.DOTALL)
+
+		# Function parsing each metadata from a filename, for the single-filename decoding
+		self._parsers = {}
+		for name, (start, end, divisor) in self._slices.items():
+			if divisor is None:
+				self._parsers[name] = operator.itemgetter(slice(start, end))
+			elif divisor == 1:
+				self._parsers[name] = lambda filename, start=start, end=end: int(filename[start:end])
+			else:
+				self._parsers[name] = lambda filename, start=start, end=end, divisor=divisor: int(filename[start:end]) / divisor
+
+		start, end, _ = self._slices["well"]
+		self._parsers["row"]    = lambda filename, start=start, end=end: _parseWellID(filename[start:end])[0]
+		self._parsers["column"] = lambda filename, start=start, end=end: _parseWellID(filename[start:end])[1]
+
+		# Template of the filename, with the fixed characters and extension, for the vectorized encoding/matching
+		self._template = np.full(self.length, ord("0"), np.uint8)
+		self._isFixed = np.zeros(self.length, bool)
+		for start, end, text in self._markers:
+			self._template[start:end] = np.frombuffer(text.encode("ascii"), np.uint8)
+			self._isFixed[start:end] = True
+		self._template[position:] = np.frombuffer(extension.encode("ascii"), np.uint8)
+
+	@classmethod
+	def fromFilename(cls, filename):
+		"""Return the schema of an IM filename, reading the tags and the width of each field from the filename."""
+		stem, extension = os.path.splitext(filename)
+		if len(stem) < 5 or not stem.startswith("-"):
+			raise ValueError("Not an IM image filename : {}".format(filename))
+
+		fields = []
+		for index, field in enumerate(stem[1:].split("--")):
+			if index == 0:
+				fields.append(("", len(field)))
+				continue
+
+			tag = field.rstrip("0123456789")
+			if tag not in tags or tag == "" or len(tag) == len(field):
+				raise ValueError("Not an IM image filename, unknown field '{}' : {}".format(field, filename))
+
+			fields.append((tag, len(field) - len(tag)))
+
+		return cls(fields, extension=extension)
+
+	@property
+	def keys(self):
+		"""Metadata names available in filenames of this schema, the plate row and column are derived from the well ID."""
+		return list(self._slices) + ["row", "column"]
+
+	def __repr__(self):
+		return "FilenameSchema({}, {})".format(self.name or "detected", "-" + "--".join(tag + "#"*width for tag, width in self.fields) + self.extension)
+
+	def __eq__(self, other):
+		return isinstance(other, FilenameSchema) and (self.fields, self.extension) == (other.fields, other.extension)
+
+	def __hash__(self):
+		return hash((self.fields, self.extension))
+
+	def matches(self, filename):
+		"""Return True if the filename has the length and the fixed characters (tags and separators) of this schema."""
+		return len(filename) == self.length and self._pattern.match(filename) is not None
+
+	def _getSlice(self, key):
+		try:
+			return self._slices[key]
+		except KeyError:
+			raise ValueError("No metadata '{}' in the filenames of {}, should be one of {}.".format(key, self, self.keys)) from None
+
+	def getValue(self, filename, key):
+		"""Return the value of one metadata (see tags) from a filename, the well ID as string, integers for the indexes and float for the physical values."""
+		parser = self._parsers.get(key)
+		if parser is None:
+			self._getSlice(key) # raise the error for unknown metadata
+
+		return parser(filename)
+
+	def decode(self, filename, keys=None):
+		"""Return a dictionary metadata name -> value for a filename, for all metadata or the given keys."""
+		return {key : self.getValue(filename, key) for key in (self.keys if keys is None else keys)}
+
+	def encode(self, **values):
+		"""
+		Return the filename for the metadata values given as keywords (see tags, the well can also be given by row and column).
+		Missing metadata take the values of the dictionary defaults, except the well ID which is required.
+		"""
+		unknown = set(values) - set(self.keys)
+		if unknown:
+			raise ValueError("Unknown metadata {}, should be among {}.".format(sorted(unknown), self.keys))
+
+		parts = []
+		for tag, width in self.fields:
+			name, divisor = tags[tag]
+
+			if divisor is None:
+				if "well" in values:
+					wellID = str(values["well"])
+				elif "row" in values and "column" in values:
+					wellID = str(utils.getWellIDs([values["row"]], [values["column"]])[0])
+				else:
+					raise ValueError("The well ID (or row and column) is required to build a filename.")
+				text = utils.checkWellID(wellID, 1536)
+
+			else:
+				number = int(round(values.get(name, defaults[name]) * divisor))
+				text = "{:0{}d}".format(number, width)
+				if number < 0 or len(text) != width:
+					raise ValueError("{} out of range for the {}-digit field {} : {}".format(name, width, tag, values.get(name)))
+
+			parts.append(tag + text)
+
+		return "-" + "--".join(parts) + self.extension
+
+	def _getCodes(self, filenames):
+		"""Return the ascii codes of the filenames as a 2D uint8 array (one row per filename), or None if any filename does not match the schema."""
+		try:
+			text = "".join(filenames).encode("ascii")
+		except UnicodeEncodeError:
+			return None
+
+		if len(text) != len(filenames) * self.length:
+			return None
+
+		codes = np.frombuffer(text, np.uint8).reshape(len(filenames), self.length)
+		if not np.all(codes[:, self._isFixed] == self._template[self._isFixed]):
+			return None
+
+		return codes
+
+	def decodeArray(self, filenames, keys=None):
+		"""
+		Vectorized version of decode for a list of filenames of this schema.
+		Return a dictionary metadata name -> numpy array with one value per filename (well IDs as 'U4' strings, int64 indexes, float64 physical values).
+		"""
+		filenames = list(filenames)
+		codes = self._getCodes(filenames)
+		if codes is None:
+			raise ValueError("Some filenames do not match {}.".format(self))
+
+		return self._decodeCodes(codes, self.keys if keys is None else keys)
+
+	def _decodeCodes(self, codes, keys):
+		values = {}
+		for key in keys:
+			if key in ("well", "row", "column"):
+				if "well" not in values:
+					start, end, _ = self._getSlice("well")
+					values["well"] = codes[:, start:end].copy().view("S4").ravel().astype("U4")
+				if key != "well":
+					rows, columns = utils.checkWellIDs(values["well"], 1536)
+					values["row"], values["column"] = rows.astype(np.int64), columns.astype(np.int64)
+				continue
+
+			start, end, divisor = self._getSlice(key)
+			digits = codes[:, start:end].astype(np.int64) - 48 # 48 is 0
+			if np.any((digits < 0) | (digits > 9)):
+				raise ValueError("The field of {} should only contain digits.".format(key))
+
+			numbers = digits @ 10**np.arange(end - start - 1, -1, -1, dtype=np.int64)
+			values[key] = numbers if divisor == 1 else numbers / divisor
+
+		return {key : values[key] for key in keys}
+
+	def encodeArray(self, **values):
+		"""
+		Vectorized version of encode : the metadata are given as arrays (or scalars) broadcast together, return a numpy array of filenames.
+		Missing metadata take the values of the dictionary defaults, except the well ID (or row and column) which is required.
+		"""
+		unknown = set(values) - set(self.keys)
+		if unknown:
+			raise ValueError("Unknown metadata {}, should be among {}.".format(sorted(unknown), self.keys))
+
+		if "well" not in values:
+			if "row" not in values or "column" not in values:
+				raise ValueError("The well ID (or row and column) is required to build a filename.")
+			rows, columns = np.broadcast_arrays(values.pop("row"), values.pop("column"))
+			values["well"] = utils.getWellIDs(rows.ravel(), columns.ravel()).reshape(rows.shape)
+
+		names = list(values)
+		arrays = np.broadcast_arrays(*[np.asarray(values[name]) for name in names])
+		arrays = dict(zip(names, (array.ravel() for array in arrays)))
+		nFilenames = arrays["well"].size
+
+		codes = np.tile(self._template, (nFilenames, 1))
+		for tag, width in self.fields:
+			name, divisor = tags[tag]
+			start, end, _ = self._slices[name]
+
+			if divisor is None:
+				utils.checkWellIDs(arrays["well"], 1536)
+				codes[:, start:end] = arrays["well"].astype("S4").view(np.uint8).reshape(-1, 4)
+				continue
+
+			numbers = np.rint(np.asarray(arrays.get(name, defaults[name]), np.float64) * divisor).astype(np.int64)
+			if np.any((numbers < 0) | (numbers >= 10**width)):
+				raise ValueError("{} out of range for the {}-digit field {}.".format(name, width, tag))
+
+			codes[:, start:end] = numbers.reshape(-1, 1) // 10**np.arange(width - 1, -1, -1, dtype=np.int64) % 10 + 48
+
+		return codes.view("S{}".format(self.length)).ravel().astype("U{}".format(self.length))
+
+
+# Known filename schemas, checked first when detecting the schema of a filename
+schemas = {"IM04" : FilenameSchema((("", 4), ("PO", 2), ("LO", 3), ("CO", 1), ("SL", 3), ("PX", 5), ("PW", 4), ("IN", 4),
+									("TM", 3), ("X", 6), ("Y", 6), ("Z", 6), ("T", 10), ("WE", 5)), "IM04")}
+defaultSchema = schemas["IM04"]
+
+# Fast path for the IM04 filenames, checked before the schema detection : length and position of the last tag (W of --WE)
+# Another schema with the same length has different field widths, which shifts the last tag, or only a different extension of the same length
+_defaultLength = defaultSchema.length
+_defaultTagIndex = defaultSchema._markers[-1][0] + 2
+
+def _isDefault(filename):
+	return len(filename) == _defaultLength and filename[_defaultTagIndex] == "W"
+
+_detectedSchemas = {} # schemas read from filenames, by fields and extension
+_last = ("", defaultSchema) # last filename and its schema : most filenames of a session follow the same schema, and the getters are often called several times per filename
+
+def getSchema(filename):
+	"""Return the FilenameSchema of an IM image filename (without directory), among the known schemas or detected from the filename."""
+	global _last
+
+	if _isDefault(filename):
+		return defaultSchema
+
+	lastFilename, schema = _last
+	if filename == lastFilename:
+		return schema
+
+	if not schema.matches(filename):
+		for schema in list(schemas.values()) + list(_detectedSchemas.values()):
+			if schema.matches(filename):
+				break
+		else:
+			schema = FilenameSchema.fromFilename(filename)
+			schema = _detectedSchemas.setdefault(schema, schema)
+
+	_last = (filename, schema)
+	return schema
+
+def getValue(filename, key):
+	"""Return the value of one metadata from an IM image filename, ex: getValue(filename, "channel"). See tags for the metadata names."""
+	lastFilename, schema = _last
+	if filename != lastFilename:
+		schema = getSchema(filename)
+
+	parser = schema._parsers.get(key)
+	if parser is None:
+		schema._getSlice(key) # raise the error for unknown metadata
+
+	return parser(filename)
+
+def getParser(key):
+	"""
+	Return a function filename -> value of one metadata, ex: getParser("well").
+	IM04 filenames are parsed with fixed slices, the schema of other filenames is detected as for getValue.
+	"""
+	defaultParser = defaultSchema._parsers.get(key)
+	if defaultParser is None:
+		defaultSchema._getSlice(key) # raise the error for unknown metadata
+
+	# The check of _isDefault and the slices are inlined in each parser, the getters are called for every image
+	length, tagIndex = _defaultLength, _defaultTagIndex
+	start, end, divisor = defaultSchema._slices["well" if key in ("row", "column") else key]
+
+	if key == "row": # see _parseWellID
+		def parse(filename):
+			if len(filename) == length and filename[tagIndex] == "W":
+				return ord(filename[start]) - 64 if filename[start + 1].isdigit() else (ord(filename[start]) - 64) * 26 + ord(filename[start + 1]) - 64
+			return getValue(filename, key)
+
+	elif key == "column":
+		def parse(filename):
+			if len(filename) == length and filename[tagIndex] == "W":
+				return int(filename[start + 1:end]) if filename[start + 1].isdigit() else int(filename[start + 2:end])
+			return getValue(filename, key)
+
+	elif divisor is None:
+		def parse(filename):
+			if len(filename) == length and filename[tagIndex] == "W":
+				return filename[start:end]
+			return getValue(filename, key)
+
+	elif divisor == 1:
+		def parse(filename):
+			if len(filename) == length and filename[tagIndex] == "W":
+				return int(filename[start:end])
+			return getValue(filename, key)
+
+	else:
+		def parse(filename):
+			if len(filename) == length and filename[tagIndex] == "W":
+				return int(filename[start:end]) / divisor
+			return getValue(filename, key)
+
+	return parse
+
+def decode(filename, keys=None):
+	"""Return a dictionary metadata name -> value for an IM image filename, for all metadata or the given keys."""
+	return getSchema(filename).decode(filename, keys)
+
+def decodeArray(filenames, keys=None):
+	"""
+	Return a dictionary metadata name -> numpy array with the value of each filename, for all metadata or the given keys.
+	The filenames are decoded together with numpy, grouped by schema if they do not all follow the same schema.
+	"""
+	filenames = list(filenames)
+	if not filenames:
+		schema = defaultSchema
+		return schema.decodeArray([], keys)
+
+	schema = getSchema(filenames[0])
+	codes = schema._getCodes(filenames)
+	if codes is not None:
+		return schema._decodeCodes(codes, schema.keys if keys is None else keys)
+
+	# Mixed schemas : decode each group of filenames, then put the values back in filename order
+	groups = {}
+	for index, filename in enumerate(filenames):
+		groups.setdefault(getSchema(filename), []).append(index)
+
+	groupValues = [(indexes, schema.decodeArray([filenames[index] for index in indexes], keys)) for schema, indexes in groups.items()]
+
+	# Metadata missing from the schema of some filenames : -1 for integers, NaN for floats, "" for strings
+	values = {}
+	for indexes, decoded in groupValues:
+		for key, array in decoded.items():
+			if key not in values:
+				dtype = np.result_type(*[other[key].dtype for _, other in groupValues if key in other])
+				values[key] = np.full(len(filenames), "" if dtype.kind == "U" else np.nan if dtype.kind == "f" else -1, dtype)
+			values[key][indexes] = array
+
+	return values
+
+def encode(schema=None, **values):
+	"""Return the filename for metadata given as keywords, ex: encode(well="A001", channel=2), with the IM04 schema by default."""
+	return (defaultSchema if schema is None else schema).encode(**values)
+
+def encodeArray(schema=None, **values):
+	"""Return a numpy array of filenames for metadata given as arrays broadcast together, with the IM04 schema by default."""
+	return (defaultSchema if schema is None else schema).encodeArray(**values)
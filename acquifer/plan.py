@@ -0,0 +1,319 @@
+"""
+Acquisition plans, compiled to a single IM script (.imsf) and run with TcpIp.runScript (or TcpIp.runPlan).
+
+Driving a plate command by command via tcpip costs a round trip per command (move, channel, acquire...) for every well.
+An AcquisitionPlan describes the whole acquisition in python instead : positions, channels with their Z-stacks, optional software autofocus, number of loops and interval.
+It is compiled to a script with the same structure as the scripts generated by the IM software (see examples/prescreen_rescreen),
+such that the acquisition runs at the speed of the IM, with a single tcpip command.
+
+import acquifer
+from acquifer.plan import AcquisitionPlan, Channel, Autofocus
+from acquifer.plates import PlateGeometry
+
+positions = PlateGeometry(96).getPositions(z=21500.1)
+plan = AcquisitionPlan(positions,
+					   channels = [Channel("bf", detectionFilter=4, intensity=30, exposure=20),
+								   Channel("010000", detectionFilter=2, intensity=50, exposure=100, nSlices=5, zStepSize=10)],
+					   objective = 2,
+					   nLoops = 24,
+					   interval = 3600) # seconds
+
+myIM = acquifer.TcpIp()
+directory = myIM.runPlan(plan, r"D:\IMAGING-DATA\SCRIPTS\timelapse.imsf")
+"""
+import numpy as np
+from .tcpip import checkCameraParameters, checkChannelParameters, checkLightSource, checkZstackParameters, getCenteredCameraRegion, isNumber, isPositiveInteger
+from .positions import WellPositionSet
+from . import plates
+
+def _isBrightfield(lightSource):
+	return lightSource.lower() in ("bf", "brightfield")
+
+def _formatBool(value):
+	return "true" if value else "false"
+
+
+class Channel(object):
+	"""Imaging channel of an acquisition plan : light source, detection filter, intensity, exposure and Z-stack."""
+
+	def __init__(self, lightSource, detectionFilter, intensity, exposure, nSlices=1, zStepSize=0.0, zOffset=0.0, lightConstantOn=False):
+		"""
+		Parameters
+		----------
+		lightSource : str
+			'brightfield'/'bf', or a 6-character string of 0 and 1 for the fluorescent light sources, ex: "010000". See TcpIp.setFluoChannel.
+
+		detectionFilter : int
+			positional index of the detection filter (1 to 4).
+
+		intensity : int
+			light intensity in range [0-100].
+
+		exposure : int
+			exposure time in ms.
+
+		nSlices : int, optional
+			number of slices of the Z-stack. The default is 1.
+
+		zStepSize : float, optional
+			distance between slices in µm. The default is 0.
+
+		zOffset : float, optional
+			offset in µm added to the Z-position of the well (or autofocus) for the center of the stack, ex: for channels focusing at a different depth. The default is 0.
+
+		lightConstantOn : bool, optional
+			if True, the light is constantly on during the acquisition, otherwise it is synchronized with the camera exposure. The default is False.
+		"""
+		checkLightSource(lightSource)
+		checkChannelParameters(1, detectionFilter, intensity, exposure, lightConstantOn)
+		checkZstackParameters(0, nSlices, zStepSize)
+
+		if not isNumber(zOffset):
+			raise ValueError("zOffset must be a number.")
+
+		self.lightSource = lightSource
+		self.detectionFilter = detectionFilter
+		self.intensity = intensity
+		self.exposure = exposure
+		self.nSlices = nSlices
+		self.zStepSize = zStepSize
+		self.zOffset = zOffset
+		self.lightConstantOn = lightConstantOn
+
+	def __repr__(self):
+		return "Channel({}, filter {}, {}%, {} ms, {} slices)".format(self.lightSource, self.detectionFilter, self.intensity, self.exposure, self.nSlices)
+
+	def getLightCommand(self, channelNumber, intensity=None, exposure=None):
+		"""Return the script command setting the light source of this channel, by default with the channel intensity and exposure."""
+		intensity = self.intensity if intensity is None else intensity
+		exposure = self.exposure if exposure is None else exposure
+
+		if _isBrightfield(self.lightSource):
+			return "SetBrightField({}, {}, {}, {}, 0, {});".format(channelNumber, self.detectionFilter, intensity, exposure, _formatBool(self.lightConstantOn))
+
+		return "SetFluoChannel({}, \"{}\", {}, {}, {}, 0, {});".format(channelNumber, self.lightSource, self.detectionFilter, intensity, exposure, _formatBool(self.lightConstantOn))
+
+	def toScript(self, channelNumber, zVariable="z"):
+		"""Return the script lines acquiring this channel, with the stack centered on the script variable zVariable (+ zOffset)."""
+		zCenter = zVariable if self.zOffset == 0 else "{} {} {:.1f}".format(zVariable, "+" if self.zOffset > 0 else "-", abs(self.zOffset))
+		return ["//{}".format("Brightfield" if _isBrightfield(self.lightSource) else "Fluorescence " + self.lightSource),
+				self.getLightCommand(channelNumber),
+				"Acquire({}, {:.1f}, {});".format(self.nSlices, self.zStepSize, zCenter),
+				self.getLightCommand(channelNumber, intensity=0, exposure=0) + " //Turn off light"]
+
+
+def _checkCamera(camera):
+	"""Return the camera settings (x, y, width, height, binning) as a tuple, raise a ValueError if they are not valid (see checkCameraParameters)."""
+	if len(camera) != 5 or camera[4] not in (1,2,4):
+		raise ValueError("camera must be a tuple (x, y, width, height, binning), with binning 1,2 or 4.")
+
+	checkCameraParameters(*camera)
+	return tuple(camera)
+
+def _getCameraCommand(camera):
+	"""Return the SetCamera script command for camera settings (x, y, width, height, binning)."""
+	x, y, width, height, binning = camera
+	return "SetCamera({}, {}, {}, {}, {});".format(binning, x, y, width, height)
+
+
+class Autofocus(object):
+	"""Software autofocus run in each well before the acquisition, with a stack centered on the Z-position of the well."""
+
+	def __init__(self, lightSource, detectionFilter, intensity, exposure, nSlices, zStepSize, lightConstantOn=False, camera=None):
+		"""
+		See TcpIp.runSoftwareAutoFocus for the parameters.
+		The camera settings of the autofocus are given as "auto" or (x, y, width, height, binning) as for AcquisitionPlan,
+		the camera settings of the plan are applied again before the acquisition.
+		"""
+		self.channel = Channel(lightSource, detectionFilter, intensity, exposure, nSlices, zStepSize, lightConstantOn=lightConstantOn)
+		self.camera = getCenteredCameraRegion() if camera == "auto" else None if camera is None else _checkCamera(camera)
+
+	def toScript(self, zVariable="z"):
+		"""Return the script lines updating the script variable zVariable with the autofocus result."""
+		lines = ["//Software autofocus"]
+		if self.camera is not None:
+			lines.append(_getCameraCommand(self.camera))
+
+		return lines + [self.channel.getLightCommand(1),
+						"{} = SoftwareAutofocus({}, {}, {:.1f});".format(zVariable, zVariable, self.channel.nSlices, self.channel.zStepSize),
+						self.channel.getLightCommand(1, intensity=0, exposure=0)]
+
+
+class AcquisitionPlan(object):
+	"""Description of a complete acquisition (positions, channels, loops), compiled to an IM script with toScript."""
+
+	def __init__(self, positions, channels, objective, z=None, autofocus=None, nLoops=1, interval=0, camera=(0, 0, 2048, 2048, 1),
+				 projectFolder=r"D:\IMAGING-DATA\IMAGES\SCRIPTS\project", plateName="default", waitPosition=None, plateFormat=None):
+		"""
+		Parameters
+		----------
+		positions : WellPositionSet or list of WellPosition
+			positions to image, in this order.
+
+		channels : list of Channel
+			channels acquired at every position, numbered 1,2,3... in this order (tag CO of the filenames).
+
+		objective : int
+			objective index, one of 1,2,3,4.
+
+		z : float, optional
+			Z-position in µm for the positions without z. The default is None, ie all positions must have a z.
+
+		autofocus : Autofocus, optional
+			software autofocus run at every position, centered on its Z-position. The default is None, ie no autofocus.
+
+		nLoops : int, optional
+			number of times the positions are imaged (time-lapse). The default is 1.
+
+		interval : float, optional
+			minimal time in seconds between the start of successive loops. The default is 0.
+
+		camera : tuple of int, optional
+			camera settings (x, y, width, height, binning), in the order of TcpIp.setCamera. The default is the full sensor without binning.
+
+		projectFolder : str, optional
+			directory where the plate folder with the images is created.
+
+		plateName : str, optional
+			suffix of the plate folder, named as date_time_plateName. The default is "default".
+
+		waitPosition : tuple of float, optional
+			x, y (mm), z (µm) where the objective waits between loops, for intervals of 5 s or more. The default is None, ie the middle of the positions with z=15000.
+
+		plateFormat : int, optional
+			number of wells of the plate (6 to 1536), for the plate size written in the script. The default is None, ie the smallest format containing all positions.
+		"""
+		if not isinstance(positions, WellPositionSet):
+			positions = WellPositionSet.fromWellPositions(positions)
+
+		if len(positions) == 0:
+			raise ValueError("The plan must have at least one position.")
+
+		if not channels:
+			raise ValueError("The plan must have at least one channel.")
+
+		for channel in channels:
+			if not isinstance(channel, Channel):
+				raise TypeError("Channels must be Channel objects.")
+
+		if not objective in (1,2,3,4):
+			raise ValueError("Objective index should be one of 1,2,3,4.")
+
+		if not isPositiveInteger(nLoops):
+			raise ValueError("nLoops must be a strictly positive integer.")
+
+		if not isNumber(interval) or interval < 0:
+			raise ValueError("interval must be a positive number of seconds.")
+
+		camera = _checkCamera(camera)
+
+		if np.any(np.isnan(positions.z)) and z is None:
+			raise ValueError("Some positions have no z-position, provide a default z.")
+
+		self.positions = positions
+		self.channels = list(channels)
+		self.objective = objective
+		self.z = z
+		self.autofocus = autofocus
+		self.nLoops = nLoops
+		self.interval = interval
+		self.camera = camera
+		self.projectFolder = projectFolder
+		self.plateName = plateName
+		self.plateFormat = None if plateFormat is None else plates.getPlateFormat(plateFormat)
+
+		if waitPosition is None:
+			waitPosition = ((positions.x.min() + positions.x.max()) / 2, (positions.y.min() + positions.y.max()) / 2, 15000)
+		self.waitPosition = waitPosition
+
+	def __repr__(self):
+		return "AcquisitionPlan({} positions, {} channels, {} loops)".format(len(self.positions), len(self.channels), self.nLoops)
+
+	def getNumberOfImages(self):
+		"""Return the total number of images acquired by the plan."""
+		return len(self.positions) * self.nLoops * sum(channel.nSlices for channel in self.channels)
+
+	def toScript(self):
+		"""Return the content of the IM script."""
+		# Plate size comment read by the IM software, by default the smallest standard plate format containing all positions
+		plateFormat = self.plateFormat
+		if plateFormat is None:
+			nRows, nColumns = int(self.positions.rows.max()), int(self.positions.columns.max())
+			plateFormat = min((plateFormat for plateFormat in plates.plateFormats.values() if plateFormat.nRows >= nRows and plateFormat.nColumns >= nColumns),
+							  key=lambda plateFormat: plateFormat.nWells)
+
+		lines = ["",
+				 "/*",
+				 "Experiment-Infos:",
+				 "-----------------",
+				 "Generated with acquifer.plan : {} positions, {} channels, {} loops, {} images.".format(len(self.positions), len(self.channels), self.nLoops, self.getNumberOfImages()),
+				 "*/",
+				 "//PlateSize:{}x{}".format(plateFormat.nColumns, plateFormat.nRows),
+				 "ProjectFolder = @\"{}\";".format(self.projectFolder),
+				 "PlateFolder = DateTime.Now.ToString(\"yyyyMMdd_HHmmss\") + @\"_{}\";".format(self.plateName),
+				 "MaxLoopNumber = {};".format(self.nLoops),
+				 "IntervalTime = {} * 1000;".format(int(round(self.interval))),
+				 "DefaultAcquireFolder = PathCombine(ProjectFolder, PlateFolder);",
+				 "",
+				 "//Well definition",
+				 "Wells = new WellInfo[]{",
+				 self.positions.toScriptWells(self.z),
+				 "};",
+				 "",
+				 "//Initialization",
+				 "SetObjective({});".format(self.objective),
+				 "GotoXYZ(Wells[0]);",
+				 "",
+				 "//Loop over the entire wellplate",
+				 "for (LoopNumber=1; LoopNumber<=MaxLoopNumber; LoopNumber++)",
+				 "{",
+				 "    StartInterval();",
+				 "",
+				 "    //Loop over the chosen wells",
+				 "    for (WellIndex=0; WellIndex<Wells.Length; WellIndex++)",
+				 "    {"]
+
+		wellBlock = ["//Get the info for a single well and move to its position",
+					 "WellInfo well = Wells[WellIndex];",
+					 "SetWellInfo(well);",
+					 "GotoXYZ(well);",
+					 "",
+					 "double z = well.Z;"]
+
+		if self.autofocus is not None:
+			wellBlock += self.autofocus.toScript("z")
+
+		wellBlock += ["",
+					  "//SetCamera(binning, x, y, width, height);",
+					  _getCameraCommand(self.camera)]
+
+		for channelNumber, channel in enumerate(self.channels, 1):
+			wellBlock += [""] + channel.toScript(channelNumber, "z")
+
+		lines += [("        " + line) if line else "" for line in wellBlock]
+
+		x, y, z = self.waitPosition
+		lines += ["    }",
+				  "",
+				  "    //Move the machine to a waiting position in the middle of the plate between loops",
+				  "    if (LoopNumber < MaxLoopNumber && IntervalTime >= 5000)",
+				  "    {",
+				  "        GotoXYZ({:.3f}, {:.3f}, {:.1f});".format(x, y, z),
+				  "        WaitEndOfInterval(IntervalTime - 5000);",
+				  "        GotoXYZ(Wells[0]);",
+				  "        WaitEndOfInterval(IntervalTime);",
+				  "    }",
+				  "}",
+				  ""]
+
+		return "\n".join(lines)
+
+	def write(self, path):
+		"""Write the script to a .imsf file, return the path."""
+		if not path.lower().endswith(".imsf"):
+			raise ValueError("The script must be a .imsf file.")
+
+		with open(path, "w") as scriptFile:
+			scriptFile.write(self.toScript())
+
+		return path
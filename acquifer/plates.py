@@ -0,0 +1,272 @@
+"""
+Plate geometry for the standard plate formats (6 to 1536 wells).
+
+A PlateGeometry precomputes numpy tables with the center of every well in objective coordinates (mm),
+such that converting well IDs to XY-positions (and back), or generating the positions of a full plate, is done without querying the IM.
+
+The plate formats list the nominal dimensions of the ANSI/SLAS microplate standard, relative to the top-left corner of the plate.
+By default, a PlateGeometry maps them to the objective coordinates of the IM (imOriginX/Y, imScaleX/Y), such that the well centers can be used with TcpIp.moveXYto,
+ex: A001 of a 96-well plate at (14.160, 11.287) mm with a pitch of 9.021 mm, instead of the nominal (14.38, 11.24) mm and 9.00 mm.
+This default calibration was fitted on a 96-well IM script, the geometry can be calibrated for a given instrument and plate with a few measured well centers (see PlateGeometry.fromWellCenters).
+
+from acquifer.plates import PlateGeometry
+
+plate = PlateGeometry(96)
+x, y = plate.getWellCenters(["A001", "B012"])
+positions = plate.getPositions() # WellPositionSet with the center of all wells, in IM acquisition order
+
+Well IDs are made of the plate row letter followed by the 3-digit plate column, ex: "A001".
+For the 1536 format, rows after Z are labelled AA to AF, followed by a 2-digit column (ex: "AF48") to keep 4-character well IDs.
+"""
+import numpy as np
+
+class PlateFormat(object):
+	"""Nominal dimensions of a plate format, in mm."""
+
+	def __init__(self, nRows, nColumns, pitch, a1X, a1Y, wellSize, wellShape="round"):
+		"""
+		The dimensions are relative to the plate, see PlateGeometry for the objective coordinates of the IM.
+
+		Parameters
+		----------
+		nRows, nColumns : int
+			number of plate rows and plate columns.
+
+		pitch : float
+			distance between the center of neighbouring wells in mm.
+
+		a1X, a1Y : float
+			position of the center of well A1 relative to the top-left corner of the plate, in mm.
+
+		wellSize : float
+			diameter of round wells, or side length of square wells, in mm (at the well bottom).
+
+		wellShape : str, optional
+			"round" or "square". The default is "round".
+		"""
+		if wellShape not in ("round", "square"):
+			raise ValueError("Well shape must be 'round' or 'square'.")
+
+		self.nRows = nRows
+		self.nColumns = nColumns
+		self.pitch = pitch
+		self.a1X = a1X
+		self.a1Y = a1Y
+		self.wellSize = wellSize
+		self.wellShape = wellShape
+
+	@property
+	def nWells(self):
+		return self.nRows * self.nColumns
+
+	def __repr__(self):
+		return "PlateFormat({} wells - {}x{})".format(self.nWells, self.nColumns, self.nRows)
+
+plateFormats = {6    : PlateFormat(2,  3,  39.12, 24.76,  23.16,  34.8),
+				12   : PlateFormat(3,  4,  26.01, 24.94,  16.79,  22.1),
+				24   : PlateFormat(4,  6,  19.30, 17.05,  13.67,  15.6),
+				48   : PlateFormat(6,  8,  13.08, 18.16,  10.08,  11.0),
+				96   : PlateFormat(8,  12, 9.00,  14.38,  11.24,  6.96),
+				384  : PlateFormat(16, 24, 4.50,  12.13,  8.99,   3.7,  "square"),
+				1536 : PlateFormat(32, 48, 2.25,  11.005, 7.865,  1.53, "square")}
+
+# Objective coordinates of the IM (mm) for positions relative to the top-left corner of the plate : xIM = imOriginX + imScaleX * xPlate
+# Fitted on the well centers of a 96-well IM script (examples/prescreen_rescreen/2X-script.imsf)
+imOriginX, imOriginY = -0.2526, 0.0333
+imScaleX,  imScaleY  = 1.00228, 1.00122
+
+def getPlateFormat(plateFormat):
+	"""
+	Return a PlateFormat from a number of wells (6, 12, 24, 48, 96, 384 or 1536).
+	A PlateFormat passed as argument is returned as is.
+	"""
+	if isinstance(plateFormat, PlateFormat):
+		return plateFormat
+
+	if plateFormat not in plateFormats:
+		raise ValueError("Plate format should be one of {}.".format(sorted(plateFormats)))
+
+	return plateFormats[plateFormat]
+
+def getRowLabel(row):
+	"""Return the label of a plate row, starting at 1 : A for 1, Z for 26, then AA for 27..."""
+	if row <= 26:
+		return chr(64 + row)
+
+	return chr(64 + (row-1) // 26) + chr(65 + (row-1) % 26)
+
+def getWellID(row, column):
+	"""Return the well ID (ex: 'A001') for a plate row and column, starting at 1."""
+	if row <= 26:
+		return "{}{:03d}".format(chr(64 + row), column)
+
+	return "{}{:02d}".format(getRowLabel(row), column)
+
+
+class PlateGeometry(object):
+	"""
+	Geometry of a plate in objective coordinates (mm), with precomputed tables of well IDs and well centers.
+	The well centers are on a regular grid : x = x0 + (column-1) * pitchX, y = y0 + (row-1) * pitchY.
+	"""
+
+	def __init__(self, plateFormat, x0=None, y0=None, pitchX=None, pitchY=None):
+		"""
+		Parameters
+		----------
+		plateFormat : int or PlateFormat
+			number of wells of a standard plate format (6, 12, 24, 48, 96, 384, 1536) or a custom PlateFormat.
+
+		x0, y0 : float, optional
+			objective coordinates in mm of the center of well A1. The default is the nominal position of the format in the IM coordinates (see imOriginX/Y).
+
+		pitchX, pitchY : float, optional
+			distance between the centers of neighbouring columns/rows in mm. The default is the nominal pitch of the format in the IM coordinates (see imScaleX/Y).
+		"""
+		self.format = getPlateFormat(plateFormat)
+		self.x0 = imOriginX + imScaleX * self.format.a1X if x0 is None else x0
+		self.y0 = imOriginY + imScaleY * self.format.a1Y if y0 is None else y0
+		self.pitchX = imScaleX * self.format.pitch if pitchX is None else pitchX
+		self.pitchY = imScaleY * self.format.pitch if pitchY is None else pitchY
+
+		nRows, nColumns = self.format.nRows, self.format.nColumns
+
+		# Lookup tables, indexed by [row-1, column-1]
+		self.rows, self.columns = np.meshgrid(np.arange(1, nRows+1, dtype=np.int16), np.arange(1, nColumns+1, dtype=np.int16), indexing="ij")
+		self.centersX = self.x0 + (self.columns - 1) * self.pitchX
+		self.centersY = self.y0 + (self.rows - 1) * self.pitchY
+		self.wellIDs = np.array([[getWellID(row, column) for column in range(1, nColumns+1)] for row in range(1, nRows+1)], dtype="U4")
+
+		# Sorted well IDs, for vectorized lookup of the well indexes
+		flatIDs = self.wellIDs.ravel()
+		self._sortOrder = np.argsort(flatIDs)
+		self._sortedIDs = flatIDs[self._sortOrder]
+
+		# Flat indexes of the wells in IM acquisition order (snake pattern : A001->A012, B012->B001...)
+		snakeColumns = np.where(self.rows % 2 == 0, nColumns - self.columns, self.columns - 1)
+		self._snakeOrder = np.argsort((self.rows.astype(np.int32) - 1) * nColumns + snakeColumns, axis=None)
+
+	@classmethod
+	def fromWellCenters(cls, plateFormat, wellIDs, x, y):
+		"""
+		Calibrate the geometry from measured well centers, ex: the well positions of an IM script (see WellPositionSet.fromScript).
+		The origin is fitted by least-squares. The pitch is fitted as well along the axes with at least 2 distinct rows or columns, the nominal pitch is used otherwise.
+		"""
+		geometry = cls(plateFormat)
+		rows, columns = geometry.getWellIndexes(wellIDs)
+		x = np.asarray(x, np.float64).ravel()
+		y = np.asarray(y, np.float64).ravel()
+
+		if len(x) != len(rows) or len(y) != len(rows):
+			raise ValueError("x and y must have the same length than the well IDs.")
+
+		def fit(index, values, pitch):
+			if len(np.unique(index)) > 1:
+				slope, intercept = np.polyfit(index - 1, values, 1)
+				return intercept, slope
+
+			return np.mean(values - (index - 1) * pitch), pitch
+
+		x0, pitchX = fit(columns, x, geometry.pitchX)
+		y0, pitchY = fit(rows, y, geometry.pitchY)
+		return cls(plateFormat, float(x0), float(y0), float(pitchX), float(pitchY))
+
+	@property
+	def nWells(self):
+		return self.format.nWells
+
+	def __repr__(self):
+		return "PlateGeometry({} wells, A1 at ({:.3f}, {:.3f}) mm, pitch ({:.3f}, {:.3f}) mm)".format(self.nWells, self.x0, self.y0, self.pitchX, self.pitchY)
+
+	def _getFlatIndexes(self, wellIDs):
+		"""Return the flat indexes in the lookup tables for a list of well IDs, raise a ValueError for well IDs not in the plate."""
+		wellIDs = np.char.upper(np.asarray(wellIDs, dtype="U")).ravel()
+
+		positions = np.searchsorted(self._sortedIDs, wellIDs)
+		positions = np.minimum(positions, len(self._sortedIDs)-1)
+		isValid = self._sortedIDs[positions] == wellIDs
+
+		if not np.all(isValid):
+			raise ValueError("Well ID(s) {} not valid for a {}-well plate, expected IDs in range {}-{}.".format(wellIDs[~isValid][:5].tolist(),
+																										   self.nWells,
+																										   self.wellIDs[0,0],
+																										   self.wellIDs[-1,-1]))
+		return self._sortOrder[positions]
+
+	def checkWellIDs(self, wellIDs):
+		"""Raise a ValueError if any of the well IDs (not case sensitive) is not a well of this plate."""
+		self._getFlatIndexes(wellIDs)
+
+	def isValidWellID(self, wellIDs):
+		"""Return a boolean array, True for the well IDs which are wells of this plate."""
+		wellIDs = np.char.upper(np.asarray(wellIDs, dtype="U")).ravel()
+		positions = np.minimum(np.searchsorted(self._sortedIDs, wellIDs), len(self._sortedIDs)-1)
+		return self._sortedIDs[positions] == wellIDs
+
+	def getWellIndexes(self, wellIDs):
+		"""Return the plate rows and columns (starting at 1) for a list of well IDs, as arrays of int16."""
+		indexes = self._getFlatIndexes(wellIDs)
+		return self.rows.ravel()[indexes], self.columns.ravel()[indexes]
+
+	def getWellCenters(self, wellIDs):
+		"""Return the objective coordinates x, y (mm) of the center of the wells, as 2 numpy arrays."""
+		indexes = self._getFlatIndexes(wellIDs)
+		return self.centersX.ravel()[indexes], self.centersY.ravel()[indexes]
+
+	def getWellAt(self, x, y, insideWell=True):
+		"""
+		Return the well IDs for objective coordinates x,y (mm), as an array of strings.
+		Positions outside of the plate (or outside of a well if insideWell is True) have an empty well ID "".
+		"""
+		x = np.asarray(x, np.float64)
+		y = np.asarray(y, np.float64)
+
+		columns = np.rint((x - self.x0) / self.pitchX).astype(np.int64)
+		rows    = np.rint((y - self.y0) / self.pitchY).astype(np.int64)
+		isValid = (columns >= 0) & (columns < self.format.nColumns) & (rows >= 0) & (rows < self.format.nRows)
+
+		if insideWell:
+			dx = x - (self.x0 + columns * self.pitchX)
+			dy = y - (self.y0 + rows * self.pitchY)
+			halfSize = self.format.wellSize / 2
+
+			if self.format.wellShape == "round":
+				isValid &= dx**2 + dy**2 <= halfSize**2
+			else:
+				isValid &= (np.abs(dx) <= halfSize) & (np.abs(dy) <= halfSize)
+
+		out = np.full(x.shape if x.ndim else (), "", dtype="U4")
+		out[isValid] = self.wellIDs[rows[isValid], columns[isValid]]
+		return out
+
+	def getPositions(self, wellIDs=None, snake=True, z=np.nan):
+		"""
+		Return a WellPositionSet with the center of the wells, with subposition 1.
+
+		Parameters
+		----------
+		wellIDs : list of str, optional
+			wells to include, in this order if snake is False. The default is None, ie all wells of the plate.
+
+		snake : bool, optional
+			if True (default), the positions are sorted in the IM acquisition order (A001->A012, B012->B001...).
+
+		z : float, optional
+			Z-position in µm of the positions. The default is NaN, ie undefined.
+		"""
+		from .positions import WellPositionSet # avoid circular import
+
+		if wellIDs is None:
+			indexes = self._snakeOrder if snake else np.arange(self.nWells)
+
+		else:
+			indexes = self._getFlatIndexes(wellIDs)
+			if snake:
+				rank = np.empty(self.nWells, np.int64)
+				rank[self._snakeOrder] = np.arange(self.nWells)
+				indexes = indexes[np.argsort(rank[indexes], kind="stable")]
+
+		return WellPositionSet(self.rows.ravel()[indexes],
+							   self.columns.ravel()[indexes],
+							   self.centersX.ravel()[indexes],
+							   self.centersY.ravel()[indexes],
+							   z = z)
@@ -0,0 +1,348 @@
+"""
+Compact collection of well positions, backed by numpy arrays.
+
+A WellPositionSet holds the same information than a list of WellPosition (well, subposition, objective coordinates),
+but with one array per field, instead of one python object per position.
+This reduces the memory and construction time for large sets of positions, for instance for high-density rescreens.
+Validation, filtering and sorting are done on whole arrays at once.
+
+from acquifer.positions import WellPositionSet
+
+positions = WellPositionSet.fromWellIDs(["A001", "A002"], x=[14.160, 23.181], y=[11.287, 11.287], z=21500.1)
+positions.toScript("rescreen.imsf", "rescreen_updated.imsf") # replace the well positions in an IM script
+"""
+from __future__ import annotations # needed to avoid having type hint as string
+from typing import TYPE_CHECKING, List
+import re
+import numpy as np
+from . import utils, plates
+
+if TYPE_CHECKING:
+	from . import WellPosition # needed to avoid circular imports, see tcpip.py
+
+# Well positions block of an IM script, ex: Wells = new WellInfo[]{ new WellInfo() {...}, ... };
+_wellsBlockPattern = re.compile(r"(Wells\s*=\s*new\s+WellInfo\s*\[\s*\]\s*\{)(.*?)(^\s*\}\s*;)", re.DOTALL | re.MULTILINE)
+
+# A single well position of an IM script, ex: new WellInfo() {Coordinate = "A001", X = 14.160, Y = 11.287, Z = 21500.1, WellNo = 1, SubPos = 1}
+_wellInfoPattern  = re.compile(r"new\s+WellInfo\s*\(\s*\)\s*\{([^}]*)\}")
+_wellInfoFieldPattern = re.compile(r"(\w+)\s*=\s*(\"[^\"]*\"|[^,\s]+)")
+
+_maxFormat = plates.getPlateFormat(1536) # largest plate format, used to validate the rows/columns
+
+_wellInfoTemplate = "new WellInfo() {{Coordinate = \"{}\", X = {:.3f}, Y = {:.3f}, Z = {:.1f}, WellNo = {}, SubPos = {}}},"
+
+
+def _asArray(values, dtype, n, name):
+	"""Return values as a 1D array of length n, broadcasting scalar values."""
+	array = np.asarray(values, dtype=dtype)
+
+	if array.ndim == 0:
+		return np.full(n, array, dtype=dtype)
+
+	if array.shape != (n,):
+		raise ValueError("{} should be a scalar or have the same length than the well IDs ({}).".format(name, n))
+
+	return array
+
+def _getWellNumbers(rows, columns):
+	"""Number the wells (starting at 1) by order of first appearance, successive subpositions of a well share the same number."""
+	_, firstIndexes, inverse = np.unique(rows.astype(np.int32) * 1000 + columns, return_index=True, return_inverse=True)
+	ranks = np.empty(len(firstIndexes), np.int32)
+	ranks[np.argsort(firstIndexes)] = np.arange(len(firstIndexes), dtype=np.int32)
+	return ranks[inverse.ravel()] + 1
+
+
+class WellPositionSet(object):
+	"""
+	Array-backed collection of well positions.
+	Each position is defined by a plate row and column (starting at 1), a subposition index within the well, objective coordinates x,y in mm and optionally z in µm (NaN if undefined).
+	The well number (WellNo in IM scripts, WE tag in filenames) is also stored for each position.
+	Rows and columns are accepted up to the largest plate format (1536 wells, 32 rows x 48 columns), see acquifer.plates.
+	"""
+
+	__slots__ = ("rows", "columns", "subpositions", "x", "y", "z", "wellNumbers")
+
+	def __init__(self, rows, columns, x, y, subpositions=1, z=np.nan, wellNumbers=None):
+		"""
+		Create a new set of positions, all fields are validated at once.
+
+		Parameters
+		----------
+		rows, columns : array-like of int
+			plate row (1 for A) and plate column of each position, starting at 1.
+
+		x, y : array-like of float, or float
+			objective coordinates in mm.
+
+		subpositions : array-like of int, or int, optional
+			subposition index within a well, in range [1-99]. The default is 1 for all positions.
+
+		z : array-like of float, or float, optional
+			objective Z-coordinate in µm. The default is NaN, ie undefined.
+
+		wellNumbers : array-like of int, optional
+			well number of each position. The default is None, ie the wells are numbered by order of first appearance.
+		"""
+		rows = np.asarray(rows).ravel()
+		n = len(rows)
+
+		self.rows         = _asArray(rows, np.int16, n, "rows")
+		self.columns      = _asArray(columns, np.int16, n, "columns")
+		self.subpositions = _asArray(subpositions, np.int16, n, "subpositions")
+		self.x = _asArray(x, np.float64, n, "x")
+		self.y = _asArray(y, np.float64, n, "y")
+		self.z = _asArray(z, np.float64, n, "z")
+
+		if np.any((self.rows < 1) | (self.rows > _maxFormat.nRows)):
+			raise ValueError("Plate rows must be in range [1-{}].".format(_maxFormat.nRows))
+
+		if np.any((self.columns < 1) | (self.columns > _maxFormat.nColumns)):
+			raise ValueError("Plate columns must be in range [1-{}].".format(_maxFormat.nColumns))
+
+		if np.any((self.subpositions < 1) | (self.subpositions > 99)):
+			raise ValueError("Subpositions must be in range [1;99].")
+
+		if np.any(~np.isfinite(self.x)) or np.any(~np.isfinite(self.y)) or np.any(self.x < 0) or np.any(self.y < 0):
+			raise ValueError("x,y must be positive.")
+
+		if np.any(self.z < 0):
+			raise ValueError("z must be positive.")
+
+		if wellNumbers is None:
+			self.wellNumbers = _getWellNumbers(self.rows, self.columns)
+
+		else:
+			self.wellNumbers = _asArray(wellNumbers, np.int32, n, "wellNumbers")
+			if np.any(self.wellNumbers < 1):
+				raise ValueError("Well numbers must be strictly positive integers.")
+
+	@classmethod
+	def fromWellIDs(cls, wellIDs, x, y, subpositions=1, z=np.nan, wellNumbers=None):
+		"""Create a new set of positions from well IDs (ex: "A001", not case sensitive), see the constructor for the other parameters."""
+		rows, columns = utils.checkWellIDs(np.char.upper(np.asarray(wellIDs)), _maxFormat)
+		return cls(rows, columns, x, y, subpositions, z, wellNumbers)
+
+	@classmethod
+	def fromWellPositions(cls, wellPositions:List[WellPosition]):
+		"""Create a new set of positions from a list of WellPosition."""
+		wellIDs = [position.wellID for position in wellPositions]
+		x = [position.x for position in wellPositions]
+		y = [position.y for position in wellPositions]
+		subpositions = [position.subposition for position in wellPositions]
+		z = [np.nan if position.z is None else position.z for position in wellPositions]
+		return cls.fromWellIDs(wellIDs, x, y, subpositions, z)
+
+	@classmethod
+	def fromScript(cls, script):
+		"""
+		Create a new set of positions from the well definitions of an IM script (Wells = new WellInfo[]{...}).
+
+		Parameters
+		----------
+		script : str
+			path to a .imsf script, or content of a script.
+		"""
+		if "WellInfo" not in script: # then it should be a path
+			with open(script, "r") as scriptFile:
+				script = scriptFile.read()
+
+		match = _wellsBlockPattern.search(script)
+		if match is None:
+			raise ValueError("No well definition (Wells = new WellInfo[]{...};) found in the script.")
+
+		fields = {"Coordinate" : [], "X" : [], "Y" : [], "Z" : [], "WellNo" : [], "SubPos" : []}
+		for wellInfo in _wellInfoPattern.finditer(match.group(2)):
+
+			values = dict(_wellInfoFieldPattern.findall(wellInfo.group(1)))
+			for key, fieldValues in fields.items():
+				fieldValues.append(values.get(key, "nan").strip('"'))
+
+		return cls.fromWellIDs(fields["Coordinate"],
+							   np.array(fields["X"], np.float64),
+							   np.array(fields["Y"], np.float64),
+							   np.array(fields["SubPos"], np.float64).astype(np.int16),
+							   np.array(fields["Z"], np.float64),
+							   np.array(fields["WellNo"], np.float64).astype(np.int32))
+
+	@classmethod
+	def concatenate(cls, positionSets, renumber=True):
+		"""
+		Return a new WellPositionSet with the positions of several sets, in order.
+
+		Parameters
+		----------
+		positionSets : list of WellPositionSet
+			sets to concatenate.
+
+		renumber : bool, optional
+			if True (default), the wells are renumbered by order of first appearance in the concatenated set, otherwise the well numbers of each set are kept.
+		"""
+		concatenated = cls.__new__(cls)
+		for field in cls.__slots__:
+			setattr(concatenated, field, np.concatenate([getattr(positionSet, field) for positionSet in positionSets]))
+
+		if renumber:
+			concatenated.wellNumbers = _getWellNumbers(concatenated.rows, concatenated.columns)
+
+		return concatenated
+
+	@property
+	def wellIDs(self):
+		"""Array of well IDs (ex: 'A001') for each position."""
+		return utils.getWellIDs(self.rows, self.columns)
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __repr__(self):
+		return "WellPositionSet({} positions, {} wells)".format(len(self), len(np.unique(self.wellNumbers)))
+
+	def _getWellPosition(self, index):
+		"""Return a WellPosition for a position index, without repeating the validation."""
+		from . import WellPosition
+
+		wellPosition = WellPosition.__new__(WellPosition)
+		wellPosition.wellID = plates.getWellID(int(self.rows[index]), int(self.columns[index]))
+		wellPosition.x = float(self.x[index])
+		wellPosition.y = float(self.y[index])
+		wellPosition.subposition = int(self.subpositions[index])
+		wellPosition.z = None if np.isnan(self.z[index]) else float(self.z[index])
+		return wellPosition
+
+	def __iter__(self):
+		"""Iterate over the positions as WellPosition objects."""
+		for index in range(len(self)):
+			yield self._getWellPosition(index)
+
+	def __getitem__(self, index):
+		"""Return a WellPosition for an integer index, or a new WellPositionSet for a slice, boolean mask or array of indexes."""
+		if isinstance(index, (int, np.integer)):
+			return self._getWellPosition(range(len(self))[index]) # handle negative indexes and out of range
+
+		return self._subset(index)
+
+	def _subset(self, index):
+		"""Return a new WellPositionSet with the positions selected by a slice, boolean mask or array of indexes."""
+		subset = WellPositionSet.__new__(WellPositionSet)
+		for field in WellPositionSet.__slots__:
+			setattr(subset, field, getattr(self, field)[index])
+		return subset
+
+	def withZ(self, z):
+		"""Return a copy of the positions with new Z-positions (µm), ex: predicted by a focus map. z is a single value or one value per position."""
+		positions = self._subset(slice(None))
+		positions.z = _asArray(z, np.float64, len(self), "z").copy()
+
+		if np.any(positions.z < 0):
+			raise ValueError("z must be positive.")
+
+		return positions
+
+	def toWellPositions(self):
+		"""Return the positions as a list of WellPosition."""
+		return list(self)
+
+	def filter(self, wellIDs=None, rows=None, columns=None, subpositions=None):
+		"""
+		Return a new WellPositionSet with the positions matching all the provided criteria.
+
+		Parameters
+		----------
+		wellIDs : list of str, optional
+			keep the positions of these wells (not case sensitive).
+
+		rows, columns, subpositions : list of int, optional
+			keep the positions in these plate rows, plate columns, or with these subposition indexes.
+		"""
+		mask = np.ones(len(self), bool)
+
+		if wellIDs is not None:
+			wellRows, wellColumns = utils.checkWellIDs(np.char.upper(np.asarray(wellIDs)), _maxFormat)
+			mask &= np.isin(self.rows.astype(np.int32) * 1000 + self.columns, wellRows.astype(np.int32) * 1000 + wellColumns)
+
+		if rows is not None:
+			mask &= np.isin(self.rows, rows)
+
+		if columns is not None:
+			mask &= np.isin(self.columns, columns)
+
+		if subpositions is not None:
+			mask &= np.isin(self.subpositions, subpositions)
+
+		return self._subset(mask)
+
+	def sortByWell(self, snake=False):
+		"""
+		Return a new WellPositionSet sorted by plate row, plate column, then subposition.
+
+		Parameters
+		----------
+		snake : bool, optional
+			if True, the columns are sorted in decreasing order for every second row, like the IM acquisition order (A001->A012, B012->B001...).
+			This minimizes the travel distance of the objective. The default is False.
+		"""
+		columns = self.columns.astype(np.int32)
+		if snake:
+			columns = np.where(self.rows % 2 == 0, -columns, columns)
+
+		order = np.lexsort((self.subpositions, columns, self.rows)) # last key is the primary one
+		return self._subset(order)
+
+	def toScriptWells(self, z=None):
+		"""
+		Return the well definitions as in IM scripts (new WellInfo() {...}), one per line.
+
+		Parameters
+		----------
+		z : float, optional
+			Z-position in µm used for the positions with undefined z. The default is None, in which case all positions must have a z-position.
+		"""
+		zValues = self.z
+		if np.any(np.isnan(zValues)):
+
+			if z is None:
+				raise ValueError("Some positions have no z-position, provide a default z.")
+
+			zValues = np.where(np.isnan(zValues), z, zValues)
+
+		return "\n".join(_wellInfoTemplate.format(wellID, x, y, zValue, wellNumber, subposition)
+						 for wellID, x, y, zValue, wellNumber, subposition in zip(self.wellIDs.tolist(),
+																				  self.x.tolist(),
+																				  self.y.tolist(),
+																				  zValues.tolist(),
+																				  self.wellNumbers.tolist(),
+																				  self.subpositions.tolist()))
+
+	def toScript(self, scriptPath, outputPath, z=None):
+		"""
+		Write a copy of an IM script, with the well definitions replaced by these positions.
+		Contrary to acquifer.scripts, this does not require pythonnet.
+
+		Parameters
+		----------
+		scriptPath : str
+			path to the template .imsf script.
+
+		outputPath : str
+			path of the script to write.
+
+		z : float, optional
+			Z-position in µm used for the positions with undefined z, see toScriptWells.
+
+		Returns
+		-------
+		outputPath
+		"""
+		with open(scriptPath, "r") as scriptFile:
+			script = scriptFile.read()
+
+		if _wellsBlockPattern.search(script) is None:
+			raise ValueError("No well definition (Wells = new WellInfo[]{...};) found in the script.")
+
+		wells = self.toScriptWells(z)
+		script = _wellsBlockPattern.sub(lambda match: match.group(1) + "\n" + wells + "\n" + match.group(3).lstrip(), script, count=1)
+
+		with open(outputPath, "w") as scriptFile:
+			scriptFile.write(script)
+
+		return outputPath
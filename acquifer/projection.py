@@ -0,0 +1,205 @@
+"""
+Z-projection of the image stacks acquired with the IM (one image file per z-slice).
+
+The slices of a stack are grouped by well, subposition, channel and timepoint using the filename metadata,
+and accumulated one slice at a time in a single buffer : the memory used does not depend on the number of slices.
+The wells of a plate are projected in parallel in a pool of processes.
+
+Available projections :
+- "max"  : maximum intensity projection
+- "mean" : average intensity (float32)
+- "sum"  : sum of the intensities (float64)
+- "edf"  : extended depth of focus, each pixel is taken from the slice where the image is locally the sharpest
+
+from acquifer import projection
+
+projection.projectPlate(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default", r"D:\projections", method="max")
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import metadata, utils
+from .dataset import Dataset
+
+projectionMethods = ("max", "mean", "sum", "edf")
+
+def _boxFilter(image, radius):
+	"""Mean filter over a (2*radius+1) square window, computed with cumulative sums (image borders are replicated)."""
+	size = 2*radius + 1
+	padded = np.pad(image, radius, mode="edge")
+
+	cumsum = np.cumsum(padded, axis=0)
+	cumsum = np.concatenate([cumsum[size-1:size], cumsum[size:] - cumsum[:-size]], axis=0)
+
+	cumsum = np.cumsum(cumsum, axis=1)
+	cumsum = np.concatenate([cumsum[:, size-1:size], cumsum[:, size:] - cumsum[:, :-size]], axis=1)
+
+	return cumsum / size**2
+
+def getLocalSharpness(image, radius=2):
+	"""
+	Return a map of the local sharpness of an image, as the squared Laplacian averaged over a (2*radius+1) square window.
+	Used to select the in-focus slice for each pixel in the extended depth of focus projection.
+	"""
+	image = np.asarray(image, np.float32)
+	padded = np.pad(image, 1, mode="edge")
+	laplacian = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:] - 4*image
+	return _boxFilter(laplacian**2, radius)
+
+
+class StackProjector(object):
+	"""
+	Accumulate the slices of a stack one at a time into a projection.
+
+	projector = StackProjector("max")
+	for path in paths:
+		projector.add(utils.readImage(path))
+	image = projector.getProjection()
+	"""
+
+	def __init__(self, method="max", sharpnessRadius=2):
+		"""
+		Parameters
+		----------
+		method : str, optional
+			one of "max", "mean", "sum" or "edf". The default is "max".
+
+		sharpnessRadius : int, optional
+			radius of the window used to measure the local sharpness for the "edf" projection. The default is 2.
+		"""
+		if method not in projectionMethods:
+			raise ValueError("Projection method must be one of {}.".format(projectionMethods))
+
+		self.method = method
+		self.sharpnessRadius = sharpnessRadius
+		self.nSlices = 0
+		self._buffer = None
+		self._sharpness = None # "edf" only, sharpness of the currently selected slice for each pixel
+
+	def add(self, image):
+		"""Add a slice to the projection."""
+		image = np.asarray(image)
+
+		if self._buffer is not None and image.shape != self._buffer.shape:
+			raise ValueError("All slices must have the same shape, expected {} got {}.".format(self._buffer.shape, image.shape))
+
+		if self.method == "max":
+			if self._buffer is None:
+				self._buffer = image.copy()
+			else:
+				np.maximum(self._buffer, image, out=self._buffer)
+
+		elif self.method in ("mean", "sum"):
+			if self._buffer is None:
+				self._buffer = np.zeros(image.shape, np.float64)
+			self._buffer += image
+
+		else:
+			sharpness = getLocalSharpness(image, self.sharpnessRadius)
+			if self._buffer is None:
+				self._buffer = image.copy()
+				self._sharpness = sharpness
+			else:
+				isSharper = sharpness > self._sharpness
+				self._buffer[isSharper] = image[isSharper]
+				self._sharpness[isSharper] = sharpness[isSharper]
+
+		self.nSlices += 1
+
+	def getProjection(self):
+		"""Return the projection of the slices added so far."""
+		if self._buffer is None:
+			raise ValueError("No slice added to the projection.")
+
+		if self.method == "mean":
+			return (self._buffer / self.nSlices).astype(np.float32)
+
+		return self._buffer.copy()
+
+def projectStack(paths, method="max", reader=utils.readImage):
+	"""
+	Return the projection of a stack, reading the slices one at a time.
+
+	Parameters
+	----------
+	paths : list of str
+		paths to the slice images.
+
+	method : str, optional
+		one of "max", "mean", "sum" or "edf". The default is "max".
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+	"""
+	projector = StackProjector(method)
+	for path in paths:
+		projector.add(reader(path))
+
+	return projector.getProjection()
+
+def _projectWell(directory, filenames, outputDirectory, method, reader, writer):
+	"""Project all stacks (subposition, channel, timepoint) of one well, return the paths of the projected images."""
+	outputPaths = []
+	for stack in Dataset(directory, filenames).groupBy("subposition", "channel", "timepoint").values():
+
+		stack.filenames.sort(key=metadata.getZSlice)
+		outputPath = os.path.join(outputDirectory, stack.filenames[0]) # keep the IM filename of the first slice, so that the projections can be loaded as a dataset
+		writer(outputPath, projectStack(stack.paths, method, reader))
+		outputPaths.append(outputPath)
+
+	return outputPaths
+
+def projectPlate(directory, outputDirectory, method="max", nWorkers=None, reader=utils.readImage, writer=utils.writeImage, **criteria):
+	"""
+	Project every stack of a plate, grouping the slices by well, subposition, channel and timepoint.
+	The wells are processed in parallel in a pool of processes, each holding at most one slice and the projection buffer in memory.
+	The projected images are saved with the filename of the first slice of the stack.
+
+	Parameters
+	----------
+	directory : str
+		directory with the IM images.
+
+	outputDirectory : str
+		directory where the projections are written, created if not existing. It must differ from directory, since the projections would overwrite the first slices.
+
+	method : str, optional
+		one of "max", "mean", "sum" or "edf". The default is "max".
+
+	nWorkers : int, optional
+		number of processes. The default is None, ie the number of CPUs. With 1, the wells are processed in the current process.
+
+	reader, writer : callable, optional
+		functions to read/write an image file, they must be picklable (ie defined at the module level) to be used in the process pool.
+		The default is utils.readImage/writeImage (requires tifffile).
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+
+	Returns
+	-------
+	list of str
+		paths to the projected images.
+	"""
+	if method not in projectionMethods:
+		raise ValueError("Projection method must be one of {}.".format(projectionMethods))
+
+	if os.path.realpath(outputDirectory) == os.path.realpath(directory):
+		raise ValueError("The output directory must differ from the image directory, the projections are saved with the filename of the first slice.")
+
+	dataset = Dataset(directory)
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	os.makedirs(outputDirectory, exist_ok=True)
+	wells = dataset.groupBy("well")
+
+	if nWorkers == 1:
+		results = [_projectWell(directory, well.filenames, outputDirectory, method, reader, writer) for well in wells.values()]
+
+	else:
+		with ProcessPoolExecutor(nWorkers) as executor:
+			futures = [executor.submit(_projectWell, directory, well.filenames, outputDirectory, method, reader, writer) for well in wells.values()]
+			results = [future.result() for future in futures]
+
+	return [path for paths in results for path in paths]
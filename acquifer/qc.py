@@ -0,0 +1,316 @@
+"""
+Quality control statistics for every image of a plate, computed in a single pass over the images.
+
+Each image is read once, in a pool of threads, to compute its intensity statistics (mean, standard deviation, min, max, percentiles),
+the fraction of saturated pixels and a focus score (see acquifer.focusmetrics).
+The intensity histogram of each image is merged into a fixed-size histogram per channel (HistogramSketch), from which the percentiles of the whole plate are estimated without keeping the images.
+The statistics are gathered in a columnar table (one numpy array per column, one row per image), joined with the metadata of the filenames (well, channel, exposure, light power, temperature...).
+
+from acquifer import qc
+
+table = qc.computePlateStatistics(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default")
+table["saturation"][table["channel"] == 1] # fraction of saturated pixels in the brightfield images
+table.getPlatePercentiles(channel=1) # plate-wide 1st, 50th and 99th percentiles
+table.export("qc.csv")
+"""
+import csv
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import naming, utils
+from .dataset import Dataset
+from .focusmetrics import getFocusMetric
+
+# Metadata of the filenames added as columns of the table, see naming.tags
+metadataColumns = ("well", "row", "column", "subposition", "timepoint", "channel", "zSlice",
+				   "exposure", "lightPower", "temperature", "positionX", "positionY", "positionZ", "time")
+
+def getPercentileFromCounts(counts, binEdges, percentile, isExact=False):
+	"""
+	Return a percentile (0-100) of the values counted in a histogram.
+	With isExact (integer values, bins of width 1), the percentile is the smallest value with at least this percentage of the values below or equal, otherwise it is interpolated linearly within the bin.
+	"""
+	cumulated = np.cumsum(counts)
+	total = cumulated[-1]
+	if total == 0:
+		return np.nan
+
+	threshold = max(percentile / 100 * total, 1)
+	index = min(int(np.searchsorted(cumulated, threshold, side="left")), len(counts) - 1)
+
+	if isExact:
+		return float(binEdges[index])
+
+	before = cumulated[index-1] if index else 0
+	fraction = (threshold - before) / counts[index] if counts[index] else 0
+	return float(binEdges[index] + fraction * (binEdges[index+1] - binEdges[index]))
+
+
+class HistogramSketch(object):
+	"""
+	Histogram of intensities with fixed bins, accumulated over many images with a fixed memory usage.
+	Values outside the range are counted in the first/last bin.
+	"""
+
+	def __init__(self, nBins=65536, valueRange=(0, 65536)):
+		"""
+		Parameters
+		----------
+		nBins : int, optional
+			number of bins. The default is 65536.
+
+		valueRange : tuple of float, optional
+			lower and upper edges of the histogram. The default is (0, 65536), ie one bin per value for 16-bit images (exact percentiles).
+		"""
+		if nBins < 1:
+			raise ValueError("The number of bins must be >= 1.")
+
+		if valueRange[1] <= valueRange[0]:
+			raise ValueError("The upper edge of the range must be larger than the lower edge.")
+
+		self.nBins = nBins
+		self.valueRange = tuple(valueRange)
+		self.binEdges = np.linspace(valueRange[0], valueRange[1], nBins + 1)
+		self.counts = np.zeros(nBins, np.int64)
+
+		binWidth = (valueRange[1] - valueRange[0]) / nBins
+		self._integerBinWidth = int(binWidth) if binWidth == int(binWidth) and valueRange[0] == int(valueRange[0]) else None
+
+	@property
+	def isExact(self):
+		"""True if the bins have a width of 1 on integer edges, ie the percentiles of integer images are exact."""
+		return self._integerBinWidth == 1
+
+	def getCounts(self, image):
+		"""Return the histogram of an image with the bins of the sketch, without adding it to the sketch."""
+		image = np.asarray(image)
+
+		if self._integerBinWidth is not None and np.issubdtype(image.dtype, np.integer):
+			# Fast path for integer images : bincount on the bin indexes
+			indexes = image.ravel()
+			if self.valueRange[0] != 0:
+				indexes = indexes.astype(np.int64) - int(self.valueRange[0])
+			if self._integerBinWidth != 1:
+				indexes = indexes // self._integerBinWidth
+			indexes = np.clip(indexes, 0, self.nBins - 1) if (indexes.min() < 0 or indexes.max() >= self.nBins) else indexes
+			return np.bincount(indexes, minlength=self.nBins)
+
+		values = np.clip(image.ravel(), self.valueRange[0], self.valueRange[1])
+		return np.histogram(values, self.nBins, self.valueRange)[0]
+
+	def add(self, image):
+		"""Add the values of an image to the histogram, and return the histogram of this image."""
+		counts = self.getCounts(image)
+		self.counts += counts
+		return counts
+
+	def addCounts(self, counts):
+		"""Add counts computed with getCounts, or the counts of another sketch with the same bins."""
+		self.counts += counts
+
+	@property
+	def count(self):
+		"""Total number of values in the histogram."""
+		return int(self.counts.sum())
+
+	def getPercentiles(self, percentiles=(1, 50, 99)):
+		"""Return the estimated percentiles (0-100) of all the values added to the histogram, as a numpy array."""
+		return np.array([getPercentileFromCounts(self.counts, self.binEdges, percentile, self.isExact) for percentile in percentiles])
+
+	def __repr__(self):
+		return "HistogramSketch({} bins in [{}; {}], {} values)".format(self.nBins, self.valueRange[0], self.valueRange[1], self.count)
+
+
+def getPlaneStatistics(image, percentiles=(1, 50, 99), saturation=None, focusMetric="varianceOfLaplacian", sketch=None):
+	"""
+	Return a dictionary with the intensity statistics of an image : mean, std, min, max, percentiles (columns p1, p50...),
+	saturation (fraction of pixels >= the saturation value) and focus (focus score, if focusMetric is not None).
+
+	Parameters
+	----------
+	image : 2D numpy array
+
+	percentiles : tuple of float, optional
+		percentiles (0-100) to compute. The default is (1, 50, 99).
+
+	saturation : float, optional
+		saturation value of the camera. The default is None, ie the maximal value of the integer data type (65535 for 16-bit images).
+
+	focusMetric : str or callable, optional
+		focus metric, see focusmetrics.getFocusMetric. None to skip the focus score. The default is "varianceOfLaplacian".
+
+	sketch : HistogramSketch, optional
+		if given, the percentiles are computed from the histogram of the image with the bins of the sketch (exact for integer images with unit bins),
+		and the histogram is returned under the key "counts", to be added to the sketch. The default is None, ie percentiles computed with numpy.
+	"""
+	image = np.asarray(image)
+	if saturation is None:
+		saturation = np.iinfo(image.dtype).max if np.issubdtype(image.dtype, np.integer) else np.inf
+
+	statistics = {"mean" : float(image.mean(dtype=np.float64)),
+				  "std"  : float(image.std(dtype=np.float64)),
+				  "min"  : float(image.min()),
+				  "max"  : float(image.max())}
+
+	if sketch is None:
+		values = np.percentile(image, percentiles) if percentiles else []
+	else:
+		statistics["counts"] = counts = sketch.getCounts(image)
+		values = [getPercentileFromCounts(counts, sketch.binEdges, percentile, sketch.isExact and np.issubdtype(image.dtype, np.integer)) for percentile in percentiles]
+
+	for percentile, value in zip(percentiles, values):
+		statistics[getPercentileColumn(percentile)] = float(value)
+
+	statistics["saturation"] = float(np.count_nonzero(image >= saturation) / image.size)
+
+	if focusMetric is not None:
+		statistics["focus"] = float(getFocusMetric(focusMetric)(image))
+
+	return statistics
+
+def getPercentileColumn(percentile):
+	"""Return the name of the column of a percentile, ex: p99 for 99, p99.9 for 99.9."""
+	return "p{:g}".format(percentile)
+
+
+class QcTable(object):
+	"""Columnar table of per-image statistics and filename metadata, with the plate-wide histogram of each channel."""
+
+	def __init__(self, columns, sketches=None):
+		"""
+		Parameters
+		----------
+		columns : dict
+			column name -> numpy array, all with the same length (one value per image).
+
+		sketches : dict, optional
+			channel -> HistogramSketch with the intensities of all images of this channel. The default is None, ie no plate-wide histogram.
+		"""
+		lengths = {len(values) for values in columns.values()}
+		if len(lengths) > 1:
+			raise ValueError("All columns must have the same length.")
+
+		self.columns = {name : np.asarray(values) for name, values in columns.items()}
+		self.sketches = sketches if sketches else {}
+
+	def __len__(self):
+		return len(next(iter(self.columns.values()))) if self.columns else 0
+
+	def __getitem__(self, column):
+		return self.columns[column]
+
+	def __contains__(self, column):
+		return column in self.columns
+
+	@property
+	def columnNames(self):
+		return list(self.columns)
+
+	def __repr__(self):
+		return "QcTable({} images, columns {})".format(len(self), self.columnNames)
+
+	def filter(self, **criteria):
+		"""
+		Return a new table with the rows matching all criteria, each criterion being a column name with a single value or a list of accepted values.
+		ex: table.filter(channel=1, well=["A001", "A002"]). The plate-wide histograms are kept unchanged.
+		"""
+		isSelected = np.ones(len(self), bool)
+		for column, values in criteria.items():
+			values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+			isSelected &= np.isin(self[column], values)
+
+		return QcTable({name : values[isSelected] for name, values in self.columns.items()}, self.sketches)
+
+	def getPlatePercentiles(self, percentiles=(1, 50, 99), channel=None):
+		"""
+		Return the percentiles (0-100) of the intensities of all images of a channel, from the plate-wide histogram.
+		If channel is None, the histograms of all channels are merged.
+		"""
+		if channel is None:
+			if not self.sketches:
+				raise ValueError("No plate-wide histogram in this table.")
+			sketches = list(self.sketches.values())
+			merged = HistogramSketch(sketches[0].nBins, sketches[0].valueRange)
+			for sketch in sketches:
+				merged.addCounts(sketch.counts)
+			return merged.getPercentiles(percentiles)
+
+		if channel not in self.sketches:
+			raise ValueError("No plate-wide histogram for channel {}, available channels are {}.".format(channel, sorted(self.sketches)))
+
+		return self.sketches[channel].getPercentiles(percentiles)
+
+	def export(self, path):
+		"""Export the table as a .csv file (one row per image) or a .npz file (one array per column)."""
+		if path.lower().endswith(".npz"):
+			np.savez_compressed(path, **self.columns)
+
+		elif path.lower().endswith(".csv"):
+			with open(path, "w", newline="") as csvFile:
+				writer = csv.writer(csvFile)
+				writer.writerow(self.columnNames)
+				writer.writerows(zip(*(values.tolist() for values in self.columns.values())))
+
+		else:
+			raise ValueError("The table can be exported as .csv or .npz file only.")
+
+
+def computePlateStatistics(directory, percentiles=(1, 50, 99), saturation=None, focusMetric="varianceOfLaplacian",
+						   nBins=65536, valueRange=(0, 65536), nWorkers=None, reader=utils.readImage, **criteria):
+	"""
+	Compute the statistics of every image of a plate folder in a single pass, with the images read and processed in a pool of threads.
+	Return a QcTable with one row per image : filename, filename metadata (see metadataColumns) and statistics (see getPlaneStatistics).
+
+	Parameters
+	----------
+	directory : str or Dataset
+		directory with the IM images, or a Dataset.
+
+	percentiles, saturation, focusMetric :
+		see getPlaneStatistics.
+
+	nBins, valueRange : optional
+		bins of the plate-wide histogram of each channel, see HistogramSketch. The default is one bin per value for 16-bit images.
+
+	nWorkers : int, optional
+		number of threads. The default is None, ie the default of ThreadPoolExecutor.
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+	"""
+	dataset = directory if isinstance(directory, Dataset) else Dataset(directory)
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	if focusMetric is not None:
+		focusMetric = getFocusMetric(focusMetric)
+
+	metadataValues = naming.decodeArray(dataset.filenames, metadataColumns)
+	channels = metadataValues["channel"].tolist()
+	sketches = {channel : HistogramSketch(nBins, valueRange) for channel in set(channels)}
+	lock = threading.Lock()
+
+	def processImage(index):
+		image = reader(os.path.join(dataset.directory, dataset.filenames[index]))
+		sketch = sketches[channels[index]]
+		statistics = getPlaneStatistics(image, percentiles, saturation, focusMetric, sketch)
+
+		with lock:
+			sketch.addCounts(statistics.pop("counts"))
+
+		return statistics
+
+	with ThreadPoolExecutor(nWorkers) as executor:
+		rows = list(executor.map(processImage, range(len(dataset))))
+
+	columns = {"filename" : np.array(dataset.filenames, dtype="U")}
+	columns.update(metadataValues)
+	statisticNames = list(rows[0]) if rows else []
+	for name in statisticNames:
+		columns[name] = np.array([row[name] for row in rows], np.float64)
+
+	return QcTable(columns, sketches)
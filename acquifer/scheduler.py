@@ -0,0 +1,203 @@
+"""
+Time-lapse scheduler for acquisitions driven from python with TcpIp.
+
+Looping by hand with time.sleep(interval) after each timepoint makes the timepoints drift by the acquisition time of every loop.
+The scheduler instead starts each timepoint at a fixed deadline on the monotonic clock, start + (timepoint-1) * interval, whatever the duration of the previous timepoints.
+
+When a timepoint takes longer than the interval (overrun), the next deadline has already passed, this is handled according to the policy :
+- "skip" : the timepoints whose deadline has passed are skipped, the acquisition resumes at the next deadline.
+  The timepoint index (LO tag of the images) keeps matching the nominal time (timepoint-1) * interval, skipped timepoints are missing.
+- "compress" : the late timepoints are started immediately one after the other, until the acquisition catches up with the deadlines.
+  All timepoints are acquired, but some intervals are shorter than requested.
+
+The actual start time of every timepoint is recorded, for the analysis of the time-lapse.
+
+import acquifer
+from acquifer.scheduler import TimelapseScheduler
+
+myIM = acquifer.TcpIp()
+
+def acquireTimepoint(timepoint):
+	for position in positions:
+		myIM.moveXYtoWellPosition(position) # positions : list of WellPosition
+		myIM.acquire(1, 2, "bf", 1, 50, 10, 21500, 1, 0)
+
+scheduler = TimelapseScheduler(interval=600, nTimepoints=48, policy="skip")
+scheduler.run(acquireTimepoint, im=myIM) # the timepoint metadata is updated before each call
+scheduler.exportRecords("timelapse.csv")
+"""
+import csv
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+overrunPolicies = ("skip", "compress")
+
+
+class TimepointRecord(object):
+	"""Scheduled and actual times of one timepoint, in seconds from the start of the time-lapse (monotonic clock)."""
+
+	__slots__ = ("timepoint", "scheduledTime", "startTime", "endTime", "timestamp", "isSkipped")
+
+	def __init__(self, timepoint, scheduledTime, startTime=None, endTime=None, timestamp=None, isSkipped=False):
+		self.timepoint = timepoint
+		self.scheduledTime = scheduledTime
+		self.startTime = startTime # None for skipped timepoints
+		self.endTime = endTime
+		self.timestamp = timestamp # wall-clock start time, as seconds since the epoch
+		self.isSkipped = isSkipped
+
+	@property
+	def delay(self):
+		"""Time in seconds between the deadline and the actual start of the timepoint, None for skipped timepoints."""
+		return None if self.startTime is None else self.startTime - self.scheduledTime
+
+	@property
+	def duration(self):
+		"""Duration of the acquisition of the timepoint in seconds, None for skipped timepoints."""
+		return None if self.startTime is None or self.endTime is None else self.endTime - self.startTime
+
+	def toDict(self):
+		return {"timepoint"     : self.timepoint,
+				"scheduledTime" : self.scheduledTime,
+				"startTime"     : self.startTime,
+				"endTime"       : self.endTime,
+				"delay"         : self.delay,
+				"duration"      : self.duration,
+				"timestamp"     : self.timestamp,
+				"isSkipped"     : self.isSkipped}
+
+	def __repr__(self):
+		if self.isSkipped:
+			return "TimepointRecord({}, skipped)".format(self.timepoint)
+		return "TimepointRecord({}, start={:.3f}s, delay={:.3f}s)".format(self.timepoint, self.startTime, self.delay)
+
+
+class TimelapseScheduler(object):
+	"""Run a function for every timepoint of a time-lapse, at fixed intervals on the monotonic clock."""
+
+	def __init__(self, interval, nTimepoints=None, policy="skip"):
+		"""
+		Parameters
+		----------
+		interval : float
+			time between the start of 2 consecutive timepoints in seconds.
+
+		nTimepoints : int, optional
+			number of timepoints of the time-lapse, including skipped timepoints. The default is None, ie until stop is called.
+
+		policy : str, optional
+			what to do when a timepoint overruns the interval, "skip" or "compress" (see module documentation). The default is "skip".
+		"""
+		if not isinstance(interval, (int, float)) or interval <= 0:
+			raise ValueError("The interval must be a strictly positive number of seconds.")
+
+		if nTimepoints is not None and (not isinstance(nTimepoints, int) or nTimepoints < 1):
+			raise ValueError("The number of timepoints must be a strictly positive integer, or None.")
+
+		if policy not in overrunPolicies:
+			raise ValueError("The policy must be one of {}.".format(overrunPolicies))
+
+		self.interval = interval
+		self.nTimepoints = nTimepoints
+		self.policy = policy
+		self.records = []
+		self._stopEvent = threading.Event()
+
+	def stop(self):
+		"""Stop the time-lapse after the current timepoint, can be called from another thread or from the timepoint function."""
+		self._stopEvent.set()
+
+	def _wait(self, duration):
+		"""Wait for a duration in seconds, return True if the time-lapse was stopped in the meantime."""
+		return self._stopEvent.wait(duration) if duration > 0 else self._stopEvent.is_set()
+
+	def run(self, acquireTimepoint, im=None, firstTimepoint=1):
+		"""
+		Run the time-lapse and return the list of TimepointRecord (also available as the attribute records while running).
+
+		Parameters
+		----------
+		acquireTimepoint : callable
+			function called with the timepoint index (starting at firstTimepoint) to acquire one timepoint.
+
+		im : TcpIp, optional
+			if given, the timepoint metadata (LO tag of the image filenames) is updated before each timepoint. The default is None.
+
+		firstTimepoint : int, optional
+			index of the first timepoint. The default is 1.
+		"""
+		self.records = []
+		self._stopEvent.clear()
+
+		start = time.monotonic()
+		slot = 0 # index of the next deadline, from 0
+
+		while self.nTimepoints is None or slot < self.nTimepoints:
+
+			deadline = slot * self.interval
+			if self._wait(deadline - (time.monotonic() - start)):
+				break
+
+			timepoint = firstTimepoint + slot
+			record = TimepointRecord(timepoint, deadline, startTime=time.monotonic() - start, timestamp=time.time())
+			self.records.append(record)
+
+			if im is not None:
+				im.setMetadataTimepoint(timepoint)
+
+			acquireTimepoint(timepoint)
+			record.endTime = time.monotonic() - start
+			slot += 1
+
+			# Overrun : the deadline of the next timepoint has already passed
+			nextDeadline = slot * self.interval
+			if record.endTime > nextDeadline:
+				nLate = math.ceil((record.endTime - nextDeadline) / self.interval) # number of deadlines already passed
+
+				if self.policy == "skip":
+					nSkipped = nLate if self.nTimepoints is None else min(nLate, self.nTimepoints - slot)
+					self.records.extend(TimepointRecord(firstTimepoint + slot + index, (slot + index) * self.interval, isSkipped=True) for index in range(nSkipped))
+					slot += nSkipped
+					logger.warning("Timepoint %d ended %.1f s after the next deadline (duration %.1f s, interval %.1f s) : skipped %d timepoint(s).",
+								   timepoint, record.endTime - nextDeadline, record.duration, self.interval, nSkipped)
+
+				elif record.duration > self.interval:
+					logger.warning("Timepoint %d took %.1f s, longer than the interval of %.1f s : the next timepoint starts immediately.", timepoint, record.duration, self.interval)
+
+				else:
+					logger.debug("Timepoint %d ended %.1f s after the next deadline, catching up.", timepoint, record.endTime - nextDeadline)
+
+		return self.records
+
+	def getOverruns(self):
+		"""Return the records of the timepoints which lasted longer than the interval."""
+		return [record for record in self.records if record.duration is not None and record.duration > self.interval]
+
+	def summary(self):
+		"""
+		Return a dictionary with the number of acquired and skipped timepoints, the number of overruns,
+		the mean and maximal delay of the starts relative to the deadlines, and the mean interval between the starts of the acquired timepoints (in seconds).
+		"""
+		acquired = [record for record in self.records if not record.isSkipped]
+		delays = [record.delay for record in acquired]
+		starts = [record.startTime for record in acquired]
+
+		return {"nAcquired"      : len(acquired),
+				"nSkipped"       : len(self.records) - len(acquired),
+				"nOverruns"      : len(self.getOverruns()),
+				"meanDelay_s"    : sum(delays) / len(delays) if delays else 0.0,
+				"maxDelay_s"     : max(delays) if delays else 0.0,
+				"meanInterval_s" : (starts[-1] - starts[0]) / (len(starts) - 1) if len(starts) > 1 else 0.0}
+
+	def exportRecords(self, path):
+		"""Export the records as a csv file, with one row per timepoint (including skipped timepoints)."""
+		with open(path, "w", newline="") as csvFile:
+			writer = csv.DictWriter(csvFile, fieldnames=list(TimepointRecord(0, 0).toDict()))
+			writer.writeheader()
+			for record in self.records:
+				writer.writerow(record.toDict())
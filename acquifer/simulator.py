@@ -0,0 +1,316 @@
+"""
+Local stand-in for the IM control software, answering the tcpip commands sent by acquifer.tcpip.TcpIp.
+
+The simulator does not acquire any image, it only keeps track of the machine state (position, objective, mode...) and replies to the commands like the IM control software.
+It is used to run benchmarks, and test acquisition code without an IM.
+
+from acquifer.simulator import ImSimulatorServer
+from acquifer.tcpip import TcpIp
+
+with ImSimulatorServer() as server:
+	myIM = TcpIp(port=server.port, host=server.host)
+	myIM.moveXYto(10, 20)
+"""
+import socket, socketserver, threading, time, os, re
+
+def parseCommand(command):
+	"""
+	Split a command string into the command name and the list of arguments (as strings, without surrounding quotes).
+	ex: 'GotoXY(10.000, 20.000, GotoMode.Abs)' -> ('GotoXY', ['10.000', '20.000', 'GotoMode.Abs'])
+	"""
+	command = command.strip()
+	name, _, arguments = command.partition("(")
+	arguments = arguments.rsplit(")", 1)[0].strip()
+
+	if not arguments:
+		return name.strip(), []
+
+	return name.strip(), [argument.strip().strip('"') for argument in arguments.split(",")]
+
+
+class SimulatedIM(object):
+	"""State of a simulated IM, returning the replies of the IM control software to tcpip commands."""
+
+	def __init__(self, nColumns=12, nRows=8, xRange=(0, 130), yRange=(0, 90), latency=0.0, focusSurface=None):
+		"""
+		Parameters
+		----------
+		nColumns, nRows : int, optional
+			plate format returned by GetCountWellsX/GetCountWellsY. The default is a 96-well plate (12x8).
+
+		xRange, yRange : tuple of float, optional
+			range of valid objective positions in mm, positions outside the range are replied with "out of range".
+
+		latency : float, optional
+			processing time in seconds added for every command. The default is 0, ie immediate replies.
+
+		focusSurface : callable, optional
+			function f(x,y) returning the in-focus Z-position (µm) at objective position x,y (mm), used for the autofocus commands.
+			The default is None, ie the focus is always at the center of the autofocus stack.
+		"""
+		self.nColumns = nColumns
+		self.nRows = nRows
+		self.xRange = xRange
+		self.yRange = yRange
+		self.latency = latency
+		self.focusSurface = focusSurface
+
+		self.x, self.y, self.z = 0.0, 0.0, 0.0
+		self.objective = 1
+		self.isLive = True
+		self.isLidOpened = False
+		self.isTemperatureRegulated = False
+		self.temperatureTarget = 25.0
+		self.projectFolder = os.path.join(os.path.expanduser("~"), "IM-SIMULATOR")
+		self.plateId = "default"
+		self.plateFolder = None
+		self.nCommands = 0
+
+		self._commands = {"OpenLid"                  : self._openLid,
+						  "CloseLid"                 : self._closeLid,
+						  "LidOpened"                : lambda args: str(int(self.isLidOpened)),
+						  "LidClosed"                : lambda args: str(int(not self.isLidOpened)),
+						  "LiveModeActive"           : lambda args: str(int(self.isLive)),
+						  "SetScriptMode"            : self._setScriptMode,
+						  "SettingModeOn"            : lambda args: "finished",
+						  "SettingModeOff"           : lambda args: "finished",
+						  "GetTemperatureRegulation" : lambda args: str(int(self.isTemperatureRegulated)),
+						  "SetTemperatureRegulation" : self._setTemperatureRegulation,
+						  "GetAmbientTemperature"    : lambda args: "22.0",
+						  "GetSampleTemperature"     : lambda args: "{:.1f}".format(self.temperatureTarget if self.isTemperatureRegulated else 22.0),
+						  "GetTargetTemperature"     : lambda args: "{:.1f}".format(self.temperatureTarget),
+						  "SetTargetTemperature"     : self._setTargetTemperature,
+						  "GetCountWellsX"           : lambda args: str(self.nColumns),
+						  "GetCountWellsY"           : lambda args: str(self.nRows),
+						  "GetObjective"             : lambda args: str(self.objective),
+						  "SetObjective"             : self._setObjective,
+						  "GetXPosition"             : lambda args: "{:.3f}".format(self.x),
+						  "GetYPosition"             : lambda args: "{:.3f}".format(self.y),
+						  "GetZPosition"             : lambda args: "{:.3f}".format(self.z),
+						  "Log"                      : lambda args: "finished",
+						  "GotoXY"                   : self._gotoXY,
+						  "GotoZ"                    : self._gotoZ,
+						  "GotoXYZ"                  : self._gotoXYZ,
+						  "RunScript"                : self._runScript,
+						  "StopScript"               : lambda args: "finished",
+						  "SetCamera"                : lambda args: "finished",
+						  "SetBinning"               : lambda args: "finished",
+						  "SetDefaultProjectFolder"  : self._setDefaultProjectFolder,
+						  "SetPlateId"               : self._setPlateId,
+						  "SetImageFileNameAttribute": lambda args: "finished",
+						  "SetBrightField"           : lambda args: "finished",
+						  "SetFluoChannel"           : lambda args: "finished",
+						  "Acquire"                  : self._acquire,
+						  "SoftwareAutofocus"        : self._softwareAutofocus,
+						  "HardwareAutofocus"        : self._hardwareAutofocus}
+
+	def respond(self, command):
+		"""
+		Update the state according to a command and return the list of replies to send back.
+		Most commands have a single reply, the Acquire command has 2 replies : the image directory, then "finished".
+		"""
+		self.nCommands += 1
+
+		if self.latency:
+			time.sleep(self.latency)
+
+		name, args = parseCommand(command)
+		function = self._commands.get(name)
+
+		if function is None:
+			return ["Unknown command : {}".format(command)]
+
+		try:
+			replies = function(args)
+
+		except (ValueError, IndexError):
+			return ["Invalid arguments : {}".format(command)]
+
+		return replies if isinstance(replies, list) else [replies]
+
+	def getFocus(self, x, y):
+		"""Return the in-focus Z-position for objective position x,y, or None if no focus surface is defined."""
+		return self.focusSurface(x, y) if self.focusSurface else None
+
+	def _openLid(self, args):
+		self.isLidOpened = True
+		return "finished"
+
+	def _closeLid(self, args):
+		self.isLidOpened = False
+		return "finished"
+
+	def _setScriptMode(self, args):
+		self.isLive = args[0] == "0"
+		if not self.isLive:
+			self.objective = 1 # switching to script mode resets the objective
+		return "finished"
+
+	def _setTemperatureRegulation(self, args):
+		self.isTemperatureRegulated = args[0] == "1"
+		return "finished"
+
+	def _setTargetTemperature(self, args):
+		self.temperatureTarget = float(args[0])
+		return "finished"
+
+	def _setObjective(self, args):
+		self.objective = int(args[0])
+		return "finished"
+
+	def _isInRange(self, x, y):
+		return (self.xRange[0] <= x <= self.xRange[1]) and (self.yRange[0] <= y <= self.yRange[1])
+
+	def _gotoXY(self, args):
+		x, y = float(args[0]), float(args[1])
+
+		if len(args) > 2 and args[2] == "GotoMode.Rel":
+			x, y = self.x + x, self.y + y
+
+		if not self._isInRange(x, y):
+			return "out of range"
+
+		self.x, self.y = x, y
+		return "finished"
+
+	def _gotoZ(self, args):
+		z = float(args[0])
+
+		if len(args) > 1 and args[1] == "GotoMode.Rel":
+			z += self.z
+
+		self.z = z
+		return "finished"
+
+	def _gotoXYZ(self, args):
+		x, y, z = float(args[0]), float(args[1]), float(args[2])
+
+		if not self._isInRange(x, y):
+			return "out of range"
+
+		self.x, self.y, self.z = x, y, z
+		return "finished"
+
+	def _getPlateFolder(self):
+		if self.plateFolder is None:
+			self.plateFolder = os.path.join(self.projectFolder, time.strftime("%Y%m%d_%H%M%S") + "_" + self.plateId)
+		return self.plateFolder
+
+	def _setDefaultProjectFolder(self, args):
+		self.projectFolder = args[0]
+		self.plateFolder = None
+		return "finished"
+
+	def _setPlateId(self, args):
+		self.plateId = args[0]
+		self.plateFolder = None
+		return "finished"
+
+	def _runScript(self, args):
+		return self._getPlateFolder()
+
+	def _acquire(self, args):
+		directory = args[3] if len(args) > 3 else self._getPlateFolder()
+		return [directory, "finished"]
+
+	def _softwareAutofocus(self, args):
+		zCenter, nSlices, zStep = float(args[0]), int(args[1]), float(args[2])
+
+		focus = self.getFocus(self.x, self.y)
+		if focus is None:
+			return "{:.1f}".format(zCenter)
+
+		# Return the slice of the stack the closest to the focus
+		zStart = zCenter - (nSlices-1) / 2 * zStep
+		index = round((focus - zStart) / zStep) if zStep else 0
+		index = min(max(index, 0), nSlices-1)
+		return "{:.1f}".format(zStart + index * zStep)
+
+	def _hardwareAutofocus(self, args):
+		focus = self.getFocus(self.x, self.y)
+		return "{:.1f}".format(focus if focus is not None else float(args[0]))
+
+
+# Boundary between two commands received in a single read, ex: 'SetPlateId(plate)GotoXY(10, 20, GotoMode.Abs)'
+_commandSeparator = re.compile(r"(?<=\))\s*(?=[A-Za-z_]\w*\()")
+
+
+class _ImSimulatorHandler(socketserver.BaseRequestHandler):
+	"""Handle one tcpip connection, replying to the commands with the SimulatedIM of the server."""
+
+	def handle(self):
+		while True:
+			try:
+				data = self.request.recv(4096)
+
+			except OSError:
+				return
+
+			if not data:
+				return # connection closed by the client
+
+			for command in _commandSeparator.split(data.decode("ascii")): # commands sent without delay can be received together
+				with self.server.lock: # a single machine state shared by all connections
+					replies = self.server.simulatedIM.respond(command)
+
+				for index, reply in enumerate(replies):
+					if index:
+						time.sleep(self.server.replyGap) # avoid merging successive replies in a single read by the client
+					self.request.sendall(reply.encode("ascii"))
+
+
+class ImSimulatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	"""
+	TCP server running a SimulatedIM in a background thread.
+	The server listens on the IPv6 loopback address, like the IM control software.
+	"""
+	address_family = socket.AF_INET6
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, simulatedIM=None, host="::1", port=0, replyGap=0.1):
+		"""
+		Parameters
+		----------
+		simulatedIM : SimulatedIM, optional
+			simulated machine state. The default is a new SimulatedIM with default settings.
+
+		host : str, optional
+			IPv6 address to listen on. The default is the loopback address "::1".
+
+		port : int, optional
+			port to listen on. The default is 0, ie a free port is picked, see the port attribute.
+
+		replyGap : float, optional
+			delay in seconds between successive replies to the same command (ex: Acquire), so they are received separately by the client.
+		"""
+		socketserver.TCPServer.__init__(self, (host, port), _ImSimulatorHandler)
+		self.simulatedIM = simulatedIM if simulatedIM else SimulatedIM()
+		self.replyGap = replyGap
+		self.lock = threading.Lock()
+		self._thread = None
+
+	@property
+	def host(self):
+		return self.server_address[0]
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def start(self):
+		"""Start serving in a background thread."""
+		self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		"""Stop serving and close the listening socket."""
+		self.shutdown()
+		self.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
@@ -0,0 +1,248 @@
+"""
+Assemble the subposition tiles of a well into a single mosaic image.
+
+The tiles are placed on a common canvas using the objective coordinates and pixel size stored in the image filenames (metadata.getPositionXY_mm, metadata.getPixelSize_um).
+The placement can optionally be refined by phase correlation of the overlapping regions of neighbouring tiles (computed with numpy FFTs).
+
+Mosaics are written into a preallocated array, or a memory-mapped .npy file, such that stitching a full plate only holds the tiles of one well in memory.
+
+from acquifer import stitching
+
+stitching.stitchPlate(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default", r"D:\mosaics", refine=True)
+"""
+import os
+import numpy as np
+from . import metadata, utils
+from .dataset import Dataset
+
+def getTilePositions(filenames, tileShape):
+	"""
+	Return the pixel position (row, column) of the top-left corner of each tile on a common canvas, and the shape of the canvas.
+	The stage X-axis is oriented like the image columns, while the stage Y-axis is oriented towards the top of the images (see metadata.convertXY_PixToIM).
+
+	Parameters
+	----------
+	filenames : list of str
+		IM image filenames (or paths) of the tiles.
+
+	tileShape : tuple of int
+		height and width of the tiles, in pixels.
+
+	Returns
+	-------
+	positions : numpy array of int, shape (nTiles, 2)
+		top-left (row, column) of each tile.
+
+	canvasShape : tuple of int
+		height and width of the canvas containing all tiles.
+	"""
+	filenames = [os.path.basename(filename) for filename in filenames]
+
+	pixelSizes = {metadata.getPixelSize_um(filename) for filename in filenames}
+	if len(pixelSizes) != 1:
+		raise ValueError("All tiles must have the same pixel size, found {}.".format(sorted(pixelSizes)))
+
+	pixelSize_mm = pixelSizes.pop() / 1000
+	xy = np.array([metadata.getPositionXY_mm(filename) for filename in filenames])
+
+	columns = (xy[:,0] - xy[:,0].min()) / pixelSize_mm
+	rows    = (xy[:,1].max() - xy[:,1]) / pixelSize_mm
+	positions = np.rint(np.stack([rows, columns], axis=1)).astype(np.int64)
+
+	return positions, _getCanvasShape(positions, tileShape)
+
+def _getCanvasShape(positions, tileShape):
+	return int(positions[:,0].max()) + tileShape[0], int(positions[:,1].max()) + tileShape[1]
+
+def phaseCorrelation(image1, image2):
+	"""
+	Return the translation (dy, dx) between 2 images of the same shape, such that image1[y, x] ~ image2[y-dy, x-dx], and the height of the correlation peak (0-1) as a confidence score.
+	The images are apodized with a Hann window to limit the effect of the image borders.
+	"""
+	if image1.shape != image2.shape:
+		raise ValueError("Images must have the same shape.")
+
+	window = np.outer(np.hanning(image1.shape[0]), np.hanning(image1.shape[1]))
+	spectrum1 = np.fft.rfft2((image1 - image1.mean()) * window)
+	spectrum2 = np.fft.rfft2((image2 - image2.mean()) * window)
+
+	crossPower = spectrum1 * np.conj(spectrum2)
+	crossPower /= np.abs(crossPower) + 1e-12
+	correlation = np.fft.irfft2(crossPower, s=image1.shape)
+
+	peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+	shift = [index if index <= size // 2 else index - size for index, size in zip(peak, correlation.shape)] # wrap to signed shifts
+	return (shift[0], shift[1]), float(correlation[peak])
+
+def refinePositions(tiles, positions, maxShift=50, minOverlap=32, minScore=0.05):
+	"""
+	Refine the tile positions by phase correlation of the overlapping regions between each pair of overlapping tiles.
+	The pairwise translations are combined in a global least-squares solution, such that the corrections are consistent over the mosaic.
+
+	Parameters
+	----------
+	tiles : list of 2D numpy arrays
+		tile images, all of the same shape.
+
+	positions : numpy array of int, shape (nTiles, 2)
+		initial top-left (row, column) positions, see getTilePositions.
+
+	maxShift : int, optional
+		maximal correction in pixels between 2 tiles, larger translations are considered unreliable and ignored. The default is 50.
+
+	minOverlap : int, optional
+		minimal overlap in pixels (along both axes) between 2 tiles to compute a translation. The default is 32.
+
+	minScore : float, optional
+		minimal height of the correlation peak to accept a translation. The default is 0.05.
+
+	Returns
+	-------
+	numpy array of int, shape (nTiles, 2)
+		refined positions, shifted such that the minimal row/column is 0.
+	"""
+	nTiles = len(tiles)
+	tileHeight, tileWidth = tiles[0].shape
+
+	equations, shifts = [], []
+	for i in range(nTiles):
+		for j in range(i+1, nTiles):
+
+			# Overlapping region in canvas coordinates
+			top    = max(positions[i,0], positions[j,0])
+			bottom = min(positions[i,0], positions[j,0]) + tileHeight
+			left   = max(positions[i,1], positions[j,1])
+			right  = min(positions[i,1], positions[j,1]) + tileWidth
+
+			if bottom - top < minOverlap or right - left < minOverlap:
+				continue
+
+			crop1 = tiles[i][top - positions[i,0] : bottom - positions[i,0], left - positions[i,1] : right - positions[i,1]]
+			crop2 = tiles[j][top - positions[j,0] : bottom - positions[j,0], left - positions[j,1] : right - positions[j,1]]
+			shift, score = phaseCorrelation(crop1.astype(np.float32), crop2.astype(np.float32))
+
+			if score < minScore or max(abs(shift[0]), abs(shift[1])) > maxShift:
+				continue
+
+			equation = np.zeros(nTiles)
+			equation[j], equation[i] = 1, -1 # correction_j - correction_i = shift
+			equations.append(equation)
+			shifts.append(shift)
+
+	if not equations:
+		return positions - positions.min(axis=0)
+
+	# Weak regularization towards no correction, this anchors tiles without any reliable neighbour
+	equations = np.vstack(equations + [np.eye(nTiles) * 1e-3])
+	shifts = np.vstack([np.array(shifts, np.float64), np.zeros((nTiles, 2))])
+
+	corrections = np.linalg.lstsq(equations, shifts, rcond=None)[0]
+	corrections -= corrections[0] # the first tile stays at its initial position
+
+	refined = positions + np.rint(corrections).astype(np.int64)
+	return refined - refined.min(axis=0)
+
+def _getOutput(out, shape, dtype):
+	"""Return the output array : a new array, a memory-mapped .npy file for a path, or the provided array (reset to 0)."""
+	if out is None:
+		return np.zeros(shape, dtype)
+
+	if isinstance(out, str):
+		return np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape) # initialized with 0
+
+	if out.shape[0] < shape[0] or out.shape[1] < shape[1]:
+		raise ValueError("Output array too small, the mosaic has shape {}.".format(shape))
+
+	out[:] = 0
+	return out
+
+def stitchTiles(paths, out=None, refine=False, maxShift=50, reader=utils.readImage):
+	"""
+	Stitch tiles into a single mosaic image, using the objective coordinates from the filenames.
+	Tiles are pasted in the order of the paths, the last tile wins in overlapping regions.
+
+	Parameters
+	----------
+	paths : list of str
+		paths to the tile images, with IM filenames. Typically all subpositions of one well, for a given channel, z-slice and timepoint.
+
+	out : numpy array or str, optional
+		preallocated output array (at least as large as the mosaic), or path of a .npy file written as a memory-map. The default is None, ie a new array.
+
+	refine : bool, optional
+		refine the tile positions by phase correlation, see refinePositions. The default is False.
+
+	maxShift : int, optional
+		maximal correction in pixels for the refinement. The default is 50.
+
+	reader : callable, optional
+		function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+
+	Returns
+	-------
+	mosaic : numpy array (or numpy memmap)
+	"""
+	if not paths:
+		raise ValueError("No tile to stitch.")
+
+	tiles = [reader(path) for path in paths]
+	if len({tile.shape for tile in tiles}) != 1:
+		raise ValueError("All tiles must have the same shape.")
+
+	positions, canvasShape = getTilePositions(paths, tiles[0].shape)
+
+	if refine and len(tiles) > 1:
+		positions = refinePositions(tiles, positions, maxShift)
+		canvasShape = _getCanvasShape(positions, tiles[0].shape)
+
+	mosaic = _getOutput(out, canvasShape, tiles[0].dtype)
+
+	tileHeight, tileWidth = tiles[0].shape
+	for tile, (row, column) in zip(tiles, positions):
+		mosaic[row : row + tileHeight, column : column + tileWidth] = tile
+
+	return mosaic
+
+def stitchPlate(directory, outputDirectory, refine=False, maxShift=50, reader=utils.readImage, **criteria):
+	"""
+	Stitch the subposition tiles of every well of a plate, for each channel, z-slice and timepoint.
+	Each mosaic is written as a memory-mapped .npy file named as well_channel_slice_timepoint, ex: A001_CO1_SL001_LO001.npy.
+	Only the tiles of one well are held in memory at a time.
+
+	Parameters
+	----------
+	directory : str
+		directory with the IM images of the plate.
+
+	outputDirectory : str
+		directory where the mosaics are written, created if not existing.
+
+	criteria : optional
+		metadata filters, as for Dataset.filter, ex: channel=1.
+
+	See stitchTiles for the other parameters.
+
+	Returns
+	-------
+	list of str
+		paths to the mosaic files.
+	"""
+	dataset = Dataset(directory)
+	if criteria:
+		dataset = dataset.filter(**criteria)
+
+	os.makedirs(outputDirectory, exist_ok=True)
+
+	outputPaths = []
+	for (wellId, channel, zSlice, timepoint), tiles in dataset.groupBy("well", "channel", "zSlice", "timepoint").items():
+
+		tiles.filenames.sort(key=metadata.getWellSubPosition)
+		outputPath = os.path.join(outputDirectory, "{}_CO{}_SL{:03d}_LO{:03d}.npy".format(wellId, channel, zSlice, timepoint))
+
+		mosaic = stitchTiles(tiles.paths, outputPath, refine, maxShift, reader)
+		mosaic.flush()
+		del mosaic # close the memory-map before the next well
+
+		outputPaths.append(outputPath)
+
+	return outputPaths
@@ -16,12 +16,22 @@ myIM = TcpIp() # create the connection
 myIM.openLid() # example
 """
 from __future__ import annotations # needed to avoid having type hint as string
-from typing import TYPE_CHECKING   
-import socket, time, os
-from . import utils # if we need to use utils
+from typing import TYPE_CHECKING, Iterable, Union
+import socket, time, os, tempfile
+from contextlib import contextmanager
+import logging
+from . import utils, plates # if we need to use utils
+from .instrumentation import CommandRecord
+from .journal import JournalHook
 
 if TYPE_CHECKING:
-	from . import WellPosition # needed to avoid circular imports : acquifer.py __init__ importing tcpip, and tcpip importing the init in return
+	from .plan import AcquisitionPlan
+	from . import WellPosition, WellPositionSet # needed to avoid circular imports : acquifer.py __init__ importing tcpip, and tcpip importing the init in return
+
+# Commands are logged with this module logger, silent by default
+# use logging.basicConfig(level=logging.DEBUG) to see every command with its arguments and duration
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
 def isPositiveInteger(value):
 	"""Return false if the input is not a strictly positive >0 integer."""
@@ -101,23 +111,96 @@ def checkZstackParameters(zStackCenter, nSlices, zStepSize):
 	if not isNumber(zStepSize) or zStepSize < 0 :
 		raise ValueError("zStepSize must be a positive number.")
 
+def checkCameraParameters(x, y, width, height, binning=None):
+	"""
+	Check the validity of the camera sensor region and binning (see TcpIp.setCamera).
+	Raise a ValueError if there is an issue with any of the parameters.
+	"""
+	if binning and binning not in (1,2,4):
+		raise ValueError("Binning should be 1,2 or 4.")
+	
+	# Check that the values are integer in range 0,2048
+	for value in (x,y,width,height) : 
+	
+		if not isinstance(value, int) or value < 0 or value > 2048 :
+			raise ValueError("x,y,width,height must be integer values in range [0;2048].")
+	
+	# Check that x+width, y+height < 2048
+	if (x + width) > 2048 :
+		raise ValueError("x + width exceeds the maximal value of 2048 for the camera sensor area.")
+	
+	if (y + height) > 2048 :
+		raise ValueError("y + height exceeds the maximal value of 2048 for the camera sensor area.")
+
+def getCenteredCameraRegion(width=512, height=512, binning=2):
+	"""Return the camera settings (x, y, width, height, binning) for a sensor region of the given size centred on the 2048x2048 sensor, ex: for a faster autofocus."""
+	return ((2048 - width) // 2, (2048 - height) // 2, width, height, binning)
+
+
+def _connect(host, port, timeout=None):
+	"""Return a socket connected to the first reachable address of the host, trying the IPv6 addresses first."""
+	addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+	addresses.sort(key=lambda address: address[0] != socket.AF_INET6) # stable sort, IPv6 first
+
+	error = None
+	for family, socketType, protocol, _, address in addresses:
+		connection = socket.socket(family, socketType, protocol)
+		try:
+			connection.settimeout(timeout)
+			connection.connect(address)
+			connection.settimeout(None) # blocking commands, some take minutes (ex: RunScript)
+			return connection
+
+		except socket.error as exception:
+			connection.close()
+			error = exception
+
+	raise error if error else socket.error("No address found for host {}.".format(host))
+
 
 class TcpIp(object):
 	"""Object representing an active TcpIp connection to the Imaging Machine Control Software for remote control."""
 
-	def __init__(self, port=6200):
-		"""Initialize a TCP/IP socket for the exchange of commands."""
+	def __init__(self, port=6200, host="localhost", timeout=None, journal=None):
+		"""
+		Initialize a TCP/IP socket for the exchange of commands.
+		
+		Parameters
+		----------
+		port : int, optional
+			port number of the IM control software. The default is 6200.
+		
+		host : str, optional
+			address or name of the host running the IM control software, ex: "localhost", "::1", "192.168.0.12" or "im-02.lab.local".
+			The addresses of the host are tried in turn, IPv6 first (latest IM). The default is "localhost".
 		
-		self._socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM) # IPv6 on latest IM 
+		timeout : float, optional
+			maximal time in seconds to establish the connection, ex: for remote IMs. The default is None, ie the system default.
+			Once connected, the commands wait for the IM replies without timeout.
+		
+		journal : str, optional
+			path of a journal file, where every command is appended with its reply and timing (see acquifer.journal). The default is None, ie no journal.
+		"""
 		try:
-			self._socket.connect(("localhost", port))
+			self._socket = _connect(host, port, timeout)
 		
 		except socket.error:
 			msg = ("Cannot connect to IM GUI.\nMake sure an IM is available, powered-on and the IM program is running.\n" +
-			"Also make sure that the option 'Block remote connection' of the admin panel is deactivated, and that the port numbers match (here set to {}).".format(port))
+			"Also make sure that the option 'Block remote connection' of the admin panel is deactivated, and that the host and port number match (here set to {}, {}).".format(host, port))
 			raise socket.error(msg)
 		
 		self._isConnected = True # only False once socket is closed
+		self._hooks = [] # called with a CommandRecord for each command, see addCommandHook
+		self._pendingRecord = None
+		self._plateId = ""
+		self._plateGeometry = None # cached, see getPlateGeometry
+		self._cameraSettings = None # (x, y, width, height, binning) last set, None when unknown, see getCameraSettings
+		self._journal = None
+		
+		if journal:
+			self._journal = JournalHook(journal)
+			self.addCommandHook(self._journal)
+		
 		print("Connected to IM on port {}, in {} mode.".format(port, self.getMode()))
 
 	def closeConnection(self):
@@ -132,8 +215,12 @@ class TcpIp(object):
 		self.resetCamera()
 		self.setBrightFieldOff()
 		self.setFluoChannelOff()
+		self._endCommand()
 		self._socket.close()
 		self._isConnected = False
+		
+		if self._journal is not None:
+			self._journal.close()
 		print("Closed connection : no more commands can be sent via this IM object.")
 
 	def sendCommand(self, stringCommand):
@@ -144,8 +231,54 @@ class TcpIp(object):
 		if not self._isConnected:
 			raise socket.error("Connection to IM was closed. Create a new IM object to establish a new connection.")
 		
+		self._endCommand() # in case the previous command did not explicitly end its record
+		
+		if self._hooks:
+			self._pendingRecord = CommandRecord(stringCommand, self._plateId)
+		
 		self._socket.sendall(bytearray(stringCommand, "ascii"))
 		time.sleep(0.05) # wait 50ms, before sending another command (which is usually whats done next, e.g. with _getFeedback
+		
+		if self._pendingRecord is not None:
+			self._pendingRecord.startTimer() # the timings exclude the 50ms wait
+
+	def addCommandHook(self, hook):
+		"""
+		Register a hook called with a CommandRecord (see acquifer.instrumentation), once each command sent to the IM has completed.
+		The record contains the send time, the time to the first reply byte, the round-trip time, the reply size and the command category.
+		A hook can be any callable taking the record as argument, ex: a custom function, list.append, or a LoggingHook/HistogramHook.
+		No record is created as long as no hook is registered.
+		"""
+		if not callable(hook):
+			raise TypeError("A command hook must be callable with a CommandRecord as argument.")
+		
+		self._hooks.append(hook)
+
+	def removeCommandHook(self, hook):
+		"""Unregister a hook previously registered with addCommandHook."""
+		self._hooks.remove(hook)
+
+	def _endCommand(self):
+		"""Pass the record of the last command to the hooks, once the command has completed."""
+		record = self._pendingRecord
+		if record is None:
+			return
+		
+		self._pendingRecord = None
+		for hook in self._hooks:
+			hook(record)
+
+	def _logCommand(self, command, args, t0, level=logging.DEBUG):
+		"""
+		Emit a structured log record for a command, with its arguments and the duration since t0 (from time.perf_counter).
+		The record has the extra attributes command, commandArgs and duration (in seconds), usable by log handlers/formatters.
+		"""
+		if not logger.isEnabledFor(level):
+			return
+		
+		duration = time.perf_counter() - t0
+		logger.log(level, "%s%s - %.1f ms", command, args, duration*1000,
+				   extra = {"command" : command, "commandArgs" : args, "duration" : duration})
 
 	def checkLidClosed(self):
 		"""Throw an exception if the lid is opened.""" 
@@ -158,7 +291,12 @@ class TcpIp(object):
 		This should be called after "get" commands.
 		Calling this function will block execution (ie the function wont return), until at least one byte is available for reading.
 		"""
-		return self._socket.recv(nbytes).decode("ascii")
+		feedback = self._socket.recv(nbytes).decode("ascii")
+		
+		if self._pendingRecord is not None:
+			self._pendingRecord.addReply(feedback)
+		
+		return feedback
 
 	def _waitForFinished(self):
 		"""
@@ -166,6 +304,8 @@ class TcpIp(object):
 		It will pause code execution until this amount of bytes can be read.
 		"""
 		feedback = self._getFeedback()
+		self._endCommand()
+		
 		if feedback != "finished":
 			self.setMode("live")      # come back to live in case it was in script
 			raise Exception(feedback) # this also interrupts execution
@@ -173,7 +313,9 @@ class TcpIp(object):
 	def _getValueAsType(self, command, cast):
 		"""Send a command, get the feedback and cast it to the type provided by the cast function ex: int."""
 		self.sendCommand(command)
-		return cast(self._getFeedback())
+		feedback = self._getFeedback()
+		self._endCommand()
+		return cast(feedback)
 
 	def _getIntegerValue(self, command):
 		"""Send a command and parse the feedback to an integer value."""
@@ -267,6 +409,17 @@ class TcpIp(object):
 		"""Return the number of plate rows."""
 		return self._getIntegerValue("GetCountWellsY()")
 
+	def getPlateGeometry(self, refresh=False):
+		"""
+		Return a plates.PlateGeometry for the plate format currently set in the IM, with the default well centers in objective coordinates (see plates.imOriginX).
+		The plate format is queried only once then cached, use refresh=True after changing the plate format in the IM software.
+		"""
+		if refresh or self._plateGeometry is None:
+			nWells = self.getNumberOfColumns() * self.getNumberOfRows()
+			self._plateGeometry = plates.PlateGeometry(nWells)
+		
+		return self._plateGeometry
+
 	def getObjectiveIndex(self):
 		"""Return the currently selected objective-index (1 to 4)."""
 		return self._getIntegerValue("GetObjective()")
@@ -306,11 +459,15 @@ class TcpIp(object):
 			raise ValueError("mode is 'absolute' or 'relative'.")
 		
 		cmd = "GotoXY({:.3f}, {:.3f}, {})".format(x, y, goToMode)
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
-		print(cmd)
 		
 		# Feedback
-		if self._getFeedback() == "out of range":
+		feedback = self._getFeedback()
+		self._endCommand()
+		self._logCommand("GotoXY", (x, y, mode), t0)
+		
+		if feedback == "out of range":
 			raise ValueError("X,Y position out of range.")
 
 	def moveXYto(self, x, y):
@@ -340,7 +497,32 @@ class TcpIp(object):
 		self.moveXYto(wellPosition.x, wellPosition.y)
 		self.setMetadataWellId(wellPosition.wellID)
 		self.setMetadataSubposition(wellPosition.subposition)
-	
+
+	def iterWellPositions(self, wellPositions:Union[WellPositionSet, Iterable[WellPosition]]):
+		"""
+		Move successively to each well position, and update the well/subposition metadata.
+		The positions are yielded once reached, so that acquisition commands can be sent for each of them.
+		Positions with a z-coordinate are reached with a single XYZ move.
+
+		for position in myIM.iterWellPositions(positionSet):
+			myIM.acquire(...)
+
+		Parameters
+		----------
+		wellPositions : WellPositionSet or iterable of WellPosition
+			positions to visit, in this order.
+		"""
+		for wellPosition in wellPositions:
+
+			if getattr(wellPosition, "z", None) is None:
+				self.moveXYto(wellPosition.x, wellPosition.y)
+			else:
+				self.moveXYZto(wellPosition.x, wellPosition.y, wellPosition.z)
+
+			self.setMetadataWellId(wellPosition.wellID)
+			self.setMetadataSubposition(wellPosition.subposition)
+			yield wellPosition
+
 	def moveXYby(self, xStep, yStep):
 		"""Increment/Decrement the x, y position by a given step in mm, with 0.001 decimal precision."""
 		self._moveXY(xStep, yStep, mode = "relative")
@@ -362,9 +544,10 @@ class TcpIp(object):
 			raise ValueError("mode is 'absolute' or 'relative'.")
 		
 		cmd = "GotoZ({:.1f}, {})".format(z, goToMode)
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
-		print(cmd)
 		self._waitForFinished()
+		self._logCommand("GotoZ", (z, mode), t0)
 
 	def moveZto(self, z):
 		"""
@@ -385,9 +568,10 @@ class TcpIp(object):
 		This commands blocks code execution until the position is reached.
 		"""
 		cmd = "GotoXYZ({:.3f},{:.3f},{:.1f})".format(x,y,z)
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
-		print(cmd)
 		self._waitForFinished()
+		self._logCommand("GotoXYZ", (x, y, z), t0)
 
 	def runScript(self, scriptPath):
 		"""
@@ -412,11 +596,37 @@ class TcpIp(object):
 		
 		cmd = "RunScript({})".format(scriptPath)
 		self.sendCommand(cmd)
-		print(cmd)
+		logger.info(cmd)
 		print("Note : Running script cannot be stopped by tcpip, only via the IM software, in the 'Run' tab.")
 		
 		# Return the directory where the images were saved
-		return self._getFeedback()
+		directory = self._getFeedback()
+		self._endCommand()
+		return directory
+
+	def runPlan(self, plan:AcquisitionPlan, scriptPath=None):
+		"""
+		Compile an acquisition plan (see acquifer.plan) to an IM script and run it with runScript.
+		The whole acquisition is then executed by the IM, with a single tcpip command.
+
+		Parameters
+		----------
+		plan : AcquisitionPlan
+			the acquisition to run.
+
+		scriptPath : str, optional
+			path of the .imsf script to write, it must be accessible by the IM software. The default is None, ie a temporary file.
+
+		Returns
+		-------
+		The directory where the images were last saved.
+		"""
+		if scriptPath is None:
+			fileDescriptor, scriptPath = tempfile.mkstemp(suffix=".imsf", prefix="acquifer_plan_")
+			os.close(fileDescriptor)
+
+		plan.write(scriptPath)
+		return self.runScript(scriptPath)
 
 	def stopScript(self):
 		"""Stop any script currently running."""
@@ -447,41 +657,65 @@ class TcpIp(object):
 			Binning factor for width/height. One of 1,2,4 The default is None, ie it wont change the current binning setting.
 		"""
 		self.checkLidClosed()
-		
-		if binning and binning not in (1,2,4):
-			raise ValueError("Binning should be 1,2 or 4.")
-		
-		# Check that the values are integer in range 0,2048
-		for value in (x,y,width,height) : 
-		
-			if not isinstance(value, int) or value < 0 or value > 2048 :
-				raise ValueError("x,y,width,height must be integer values in range [0;2048].")
-		
-		# Check that x+width, y+height < 2048
-		if (x + width) > 2048 :
-			raise ValueError("x + width exceeds the maximal value of 2048 for the camera sensor area.")
-		
-		if (y + height) > 2048 :
-			raise ValueError("y + height exceeds the maximal value of 2048 for the camera sensor area.")
-		
+		checkCameraParameters(x, y, width, height, binning)
+		self._setCamera(x, y, width, height, binning)
+
+	def _setCamera(self, x, y, width, height, binning=None):
+		"""Send the SetCamera command without checking the parameters, and update the cached camera settings."""
 		if binning : 
 			cmd = "SetCamera({},{},{},{},{})".format(binning, x, y, width, height)
 		else:
 			cmd = "SetCamera({},{},{},{})".format(x, y, width, height)
 		
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
 		self._waitForFinished()
-		print("Updated camera settings.")
+		self._logCommand("SetCamera", (x, y, width, height, binning), t0)
+		
+		if not binning: # unchanged binning
+			binning = self._cameraSettings[4] if self._cameraSettings else None
+		self._cameraSettings = (x, y, width, height, binning)
 
 	def setCameraBinning(self, binning):
 		"""Set the binning factor for the camera. Also resets the camera sensor region to the full frame 2048x2048."""
 		self.sendCommand("SetBinning({})".format(binning))
 		self._waitForFinished()
-
+		self._cameraSettings = (0, 0, 2048, 2048, binning)
 
 	def resetCamera(self):
 		"""Reset camera to full-size field of view (2048x2048 pixels) and no binning."""
-		self.setCamera(0,0,2048,2048)
+		self.setCamera(0,0,2048,2048,1)
+	
+	def getCameraSettings(self):
+		"""
+		Return the camera settings (x, y, width, height, binning) last set with setCamera, setCameraBinning or resetCamera, without querying the IM.
+		Return None if the camera was not set since the connection, the binning is None if it was never set.
+		"""
+		return self._cameraSettings
+	
+	@contextmanager
+	def _temporaryCameraSettings(self, x, y, width, height, binning):
+		"""
+		Context manager applying camera settings, and restoring the previous ones on exit, also in case of exception.
+		No command is sent if the settings are already the current ones.
+		Raise a ValueError if the previous settings are not known (including the binning), since they could not be restored.
+		"""
+		previous = self._cameraSettings
+		
+		if previous is None or previous[4] is None:
+			raise ValueError("The current camera settings are unknown and could not be restored, set them first with setCamera (with binning) or resetCamera.")
+		
+		if previous == (x, y, width, height, binning):
+			yield
+			return
+		
+		self._setCamera(x, y, width, height, binning)
+		try:
+			yield
+		
+		finally:
+			if self._isConnected:
+				self._setCamera(*previous)
 	
 	def setObjective(self, index):
 		"""
@@ -498,9 +732,10 @@ class TcpIp(object):
 		self.checkLidClosed()
 
 		cmd =  "SetObjective({})".format(index)
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
 		self._waitForFinished()
-		print(cmd)
+		self._logCommand("SetObjective", (index,), t0)
 
 	def setDefaultProjectFolder(self, folder):
 		r"""
@@ -516,7 +751,7 @@ class TcpIp(object):
 		#self.cmd = cmd # this was just to inspect the sent command without having a print version but really the string object
 		self.sendCommand(cmd)
 		self._waitForFinished()
-		print(cmd)
+		logger.info(cmd)
 
 	def setPlateId(self, plateId):
 		"""
@@ -528,7 +763,8 @@ class TcpIp(object):
 		cmd = "SetPlateId(\"{}\")".format(plateId)
 		self.sendCommand(cmd)
 		self._waitForFinished()
-		print(cmd)
+		self._plateId = str(plateId) # used to aggregate command records per plate
+		logger.info(cmd)
 
 	def _setImageFilenameAttribute(self, attribute, value):
 		"""
@@ -559,9 +795,10 @@ class TcpIp(object):
 			raise ValueError("Channel index ('CO') must be in range [1,9].")
 		
 		cmd = "SetImageFileNameAttribute(ImageFileNameAttribute.{}, {})".format(attribute, value)
-		#print(cmd)
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
 		self._waitForFinished()
+		self._logCommand("SetImageFileNameAttribute", (attribute, value), t0)
 
 	def setMetadata(self, wellId, wellNumber, subposition=1, timepoint=1):
 		"""Update multiple metadata at once, used to name image files for the next acquisition(s)."""
@@ -573,7 +810,6 @@ class TcpIp(object):
 	def setMetadataWellNumber(self, number):
 		"""Update well number used to name image files for the next acquisitions (WE tag)."""
 		self._setImageFilenameAttribute("WE", number)
-		print("Set metadata well number - WE:" + str(number))
 
 	def setMetadataWellId(self, wellID, leadingChar = "-"):
 		"""
@@ -597,17 +833,14 @@ class TcpIp(object):
 			raise ValueError("WellID must start with a letter, example of well ID 'A001'.")
 		
 		self._setImageFilenameAttribute("Coordinate", leadingChar + wellID)
-		print("Set metadata wellID:" + wellID)
 
 	def setMetadataSubposition(self, subposition):
 		"""Update the well subposition index (within a given well), used to name the image files for the next acquisitions (PO tag)."""
 		self._setImageFilenameAttribute("PO", subposition)
-		print("Set metadata subposition - PO:" + str(subposition))
 
 	def setMetadataTimepoint(self, timepoint):
 		"""Update the timepoint (or loop iteration) index, used to name the image files for the next acquisitions (LO tag)."""
 		self._setImageFilenameAttribute("LO", timepoint) # LO for LOOP
-		print("Set metadata timepoint - LO:" + str(timepoint))
 
 	def setBrightField(self, channelNumber, detectionFilter, intensity, exposure, lightConstantOn=False):
 		"""
@@ -640,9 +873,10 @@ class TcpIp(object):
 		lightConstantOn = "true" if lightConstantOn else "false" # just making sure to use a lower case for true : python boolean is True
 		offsetAF = 0 # if one wants to apply an offset, directly do it in the acquire command
 		
+		t0 = time.perf_counter()
 		self.sendCommand("SetBrightField({}, {}, {}, {}, {}, {})".format(channelNumber, detectionFilter, intensity, exposure, offsetAF, lightConstantOn) )
-		print("Switched-on brightfield light-source - filter:{} - {}% - {}ms".format(detectionFilter, intensity, exposure))
 		self._waitForFinished()
+		self._logCommand("SetBrightField", (channelNumber, detectionFilter, intensity, exposure, lightConstantOn), t0)
 		
 	def setBrightFieldOff(self):
 		"""
@@ -655,8 +889,8 @@ class TcpIp(object):
 		
 		if self.getMode() == "live":
 			self.sendCommand("SetBrightField(1, 1, 0, 0, 0, false)") # any channel, filter should do, as long as intensity is 0
-			print("Switched-off brightfield light-source.")
 			self._waitForFinished()
+			logger.debug("Switched-off brightfield light-source.")
 		
 	def setFluoChannel(self, channelNumber, lightSource, detectionFilter, intensity, exposure, lightConstantOn=False):
 		"""
@@ -695,10 +929,10 @@ class TcpIp(object):
 		offsetAF = 0 # if one wants to apply an offset, directly do it in the acquire command
 		
 		cmd = "SetFluoChannel({}, \"{}\", {}, {}, {}, {}, {})".format(channelNumber, lightSource, detectionFilter, intensity, exposure, offsetAF, lightConstantOn)
-		#print(cmd)
+		t0 = time.perf_counter()
 		self.sendCommand(cmd)
-		print("Switched-on fluorescent light source - filter:{} - {}% - {}ms".format(detectionFilter, intensity, exposure))
 		self._waitForFinished()
+		self._logCommand("SetFluoChannel", (channelNumber, lightSource, detectionFilter, intensity, exposure, lightConstantOn), t0)
 
 	def setFluoChannelOff(self):
 		"""
@@ -711,8 +945,8 @@ class TcpIp(object):
 		
 		if self.getMode() == "live":
 			self.sendCommand("SetFluoChannel(1, \"111111\", 1, 0, 0, 0, false)")
-			print("Switch-off fluorescent light sources.")
 			self._waitForFinished()
+			logger.debug("Switched-off fluorescent light sources.")
 
 	def setLightSource(self, channelNumber, lightSource, detectionFilter, intensity, exposure, lightConstantOn = False):
 		"""
@@ -857,7 +1091,8 @@ class TcpIp(object):
 		else:
 			cmd = "Acquire({}, {:.1f}, {:.1f})".format(nSlices, zStepSize, zStackCenter)
 		
-		print(cmd) # Should appear as top-level command before subcommands are called within Acquire
+		logger.debug("%s - start", cmd) # Should appear as top-level command before subcommands are called within Acquire
+		t0 = time.perf_counter()
 		
 		mode0 = self.getMode() # if we want to go back to live mode
 		self.setMode("script") # for acquire to work, needs to be in script mode
@@ -876,6 +1111,7 @@ class TcpIp(object):
 		if mode0 == "live":
 			self.setMode("live") 
 		
+		self._logCommand("Acquire", (channelNumber, objective, lightSource, detectionFilter, intensity, exposure, zStackCenter, nSlices, zStepSize), t0)
 		return outDirectory
 
 	def _setSettingMode(self, state):
@@ -911,11 +1147,11 @@ class TcpIp(object):
 		
 		if mode == "script":
 			self.sendCommand("SetScriptMode(1)")
-			print("Switch to 'script' mode.\nNOTE : interaction with the GUI are suspended until 'live' mode is reactivated.")
+			logger.info("Switch to 'script' mode. NOTE : interaction with the GUI are suspended until 'live' mode is reactivated.")
 		
 		elif mode == "live":
 			self.sendCommand("SetScriptMode(0)")
-			print("Switch to 'live' mode.")
+			logger.info("Switch to 'live' mode.")
 		
 		else:
 			raise ValueError("Mode can be either 'script' or 'live'.")
@@ -931,7 +1167,8 @@ class TcpIp(object):
 							  zStackCenter,
 							  nSlices, 
 							  zStepSize, 
-							  lightConstantOn=False):
+							  lightConstantOn=False,
+							  camera=None):
 		"""
 		Run a software autofocus with a custom channel and current objective and camera settings.
 		Return the Z-position of the most focused slice, within a stack centred on a given Z-position, with nSlices each separated by zStepSize.
@@ -979,6 +1216,13 @@ class TcpIp(object):
 			if true, the light is constantly on (only during the acquisition in script mode)
 			if false, the light lightSource is synchronized with the camera exposure, and thus is blinking.
 		
+		camera : str or tuple, optional
+			camera settings used for the autofocus only, the previous camera settings are restored afterwards (also if the autofocus fails).
+			"auto" for a 512x512 region centred on the sensor with binning 2 (see getCenteredCameraRegion), which speeds up the autofocus,
+			or a tuple (x, y, width, height, binning) as for setCamera.
+			The current camera settings must be known to be restored : set them first with setCamera (with binning) or resetCamera, otherwise a ValueError is raised.
+			The default is None, ie the current camera settings.
+		
 		Returns
 		-------
 		zFocus : float
@@ -992,6 +1236,32 @@ class TcpIp(object):
 		checkChannelParameters(channelNumber, detectionFilter, intensity, exposure, lightConstantOn)
 		checkZstackParameters(zStackCenter, nSlices, zStepSize )
 		
+		if camera is None:
+			return self._runSoftwareAutoFocus(objective, lightSource, detectionFilter, intensity, exposure, zStackCenter, nSlices, zStepSize, lightConstantOn)
+		
+		if camera == "auto":
+			camera = getCenteredCameraRegion()
+		
+		if len(camera) != 5:
+			raise ValueError("camera must be 'auto' or a tuple (x, y, width, height, binning).")
+		
+		checkCameraParameters(*camera)
+		
+		with self._temporaryCameraSettings(*camera):
+			return self._runSoftwareAutoFocus(objective, lightSource, detectionFilter, intensity, exposure, zStackCenter, nSlices, zStepSize, lightConstantOn)
+
+	def _runSoftwareAutoFocus(self, objective, lightSource, detectionFilter, intensity, exposure, zStackCenter, nSlices, zStepSize, lightConstantOn):
+		"""Run the software autofocus with checked parameters, see runSoftwareAutoFocus."""
+		with self._softwareAutoFocusChannel(objective, lightSource, detectionFilter, intensity, exposure, lightConstantOn):
+			return self._sendSoftwareAutoFocus(zStackCenter, nSlices, zStepSize)
+	
+	@contextmanager
+	def _softwareAutoFocusChannel(self, objective, lightSource, detectionFilter, intensity, exposure, lightConstantOn):
+		"""
+		Context manager setting the objective and the light-source of a software autofocus with checked parameters, such that successive SoftwareAutofocus commands can be sent with _sendSoftwareAutoFocus.
+		In live mode, the setting mode is switched on, and on exit the light-source is switched off and the setting mode is switched off.
+		"""
+		channelNumber = 1
 		self.setObjective(objective)
 
 		mode = self.getMode()
@@ -1002,17 +1272,20 @@ class TcpIp(object):
 		# Switch-on light
 		self.setLightSource(channelNumber, lightSource, detectionFilter, intensity, exposure, lightConstantOn)
 		
-		# Send autofocus command and read feedback
-		cmd = "SoftwareAutofocus({:.1f}, {}, {:.1f})".format(zStackCenter, nSlices, zStepSize)
-		print(cmd)
-		zFocus = self._getFloatValue(cmd)
-		print("Z-focus = {} µm".format(zFocus))
+		yield
 		
 		# In live mode, switch-off light and exit setting mode
 		if mode == "live":
 			self.setLightSourceOff(lightSource)
 			self._setSettingMode(False)
-		
+	
+	def _sendSoftwareAutoFocus(self, zStackCenter, nSlices, zStepSize):
+		"""Send a SoftwareAutofocus command with checked parameters and return the Z-focus, the objective and light-source must be set (see _softwareAutoFocusChannel)."""
+		cmd = "SoftwareAutofocus({:.1f}, {}, {:.1f})".format(zStackCenter, nSlices, zStepSize)
+		t0 = time.perf_counter()
+		zFocus = self._getFloatValue(cmd)
+		self._logCommand("SoftwareAutofocus", (zStackCenter, nSlices, zStepSize), t0)
+		logger.debug("Z-focus = %s µm", zFocus)
 		return zFocus
 
 	def runHardwareAutoFocus(self, objective, detectionFilter, zStart) :
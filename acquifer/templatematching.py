@@ -0,0 +1,218 @@
+"""
+Template matching by normalized cross-correlation, implemented with numpy FFTs (no OpenCV needed).
+
+The score map is the zero-normalized cross-correlation (same as cv2.TM_CCOEFF_NORMED), in range [-1;1] :
+the correlation with the template is computed in the Fourier domain, and the local mean/variance of the image under the template are computed with integral images.
+Matching can run on binned images (pyramid), with a refinement of each hit at full resolution, which is much faster for large images (ex: 2048x2048).
+Several objects per image are found with a non-maximum suppression.
+
+from acquifer import templatematching, utils
+
+template = utils.readImage("medaka_crop.tif")
+detector = templatematching.TemplateDetector(template, scoreThreshold=0.5, nObjects=3, binning=4)
+hits = detector(utils.readImage(imagePath)) # list of (x, y, score) of the object centers
+"""
+import numpy as np
+
+def binImage(image, factor):
+	"""
+	Return the image binned by an integer factor (average of factor x factor pixels) as float32, the incomplete pixels at the bottom/right borders are dropped.
+	An image acquired with a camera binning (see TcpIp.setCameraBinning) has the same sampling as the full-resolution image binned by the same factor.
+	"""
+	if factor == 1:
+		return np.asarray(image, np.float32)
+
+	height, width = image.shape[0] // factor, image.shape[1] // factor
+	if height == 0 or width == 0:
+		raise ValueError("Image too small for a binning of {}.".format(factor))
+
+	blocks = np.asarray(image[:height*factor, :width*factor], np.float32).reshape(height, factor, width, factor)
+	return blocks.mean(axis=(1, 3))
+
+def _getWindowSums(image, height, width):
+	"""Return the sum of the image over every window of size height x width (valid positions only), computed with an integral image."""
+	integral = np.zeros((image.shape[0]+1, image.shape[1]+1), np.float64)
+	np.cumsum(np.cumsum(image, axis=0), axis=1, out=integral[1:, 1:])
+	return integral[height:, width:] - integral[:-height, width:] - integral[height:, :-width] + integral[:-height, :-width]
+
+def _getFastLength(n):
+	"""Return the smallest length >= n with only 2, 3 and 5 as prime factors, for which the FFT is fast."""
+	length = n
+	while True:
+		remainder = length
+		for factor in (2, 3, 5):
+			while remainder % factor == 0:
+				remainder //= factor
+		if remainder == 1:
+			return length
+		length += 1
+
+def matchTemplate(image, template):
+	"""
+	Return the map of normalized cross-correlation scores, for every position of the template fully inside the image.
+	The score at [row, column] corresponds to the template top-left corner at (row, column), the map has shape (H-h+1, W-w+1).
+	Flat image regions (no intensity variation under the template) have a score of 0.
+	"""
+	image = np.asarray(image, np.float64)
+	template = np.asarray(template, np.float64)
+	height, width = template.shape
+
+	if image.ndim != 2 or template.ndim != 2:
+		raise ValueError("Image and template must be 2D arrays.")
+
+	if height > image.shape[0] or width > image.shape[1]:
+		raise ValueError("The template must be smaller than the image.")
+
+	image = image - image.mean() # better precision for the integral images
+	template = template - template.mean()
+	templateNorm = np.sqrt(np.sum(template**2))
+
+	# Correlation = convolution with the flipped template, computed in the Fourier domain
+	shape = (_getFastLength(image.shape[0]), _getFastLength(image.shape[1]))
+	spectrum = np.fft.rfft2(image, shape) * np.fft.rfft2(template[::-1, ::-1], shape)
+	correlation = np.fft.irfft2(spectrum, shape)[height-1 : image.shape[0], width-1 : image.shape[1]]
+
+	# Local variance of the image under the template
+	nPixels = height * width
+	windowSums = _getWindowSums(image, height, width)
+	windowVariances = _getWindowSums(image**2, height, width) - windowSums**2 / nPixels
+
+	denominator = np.sqrt(np.maximum(windowVariances, 0)) * templateNorm
+	isValid = denominator > 1e-6 * max(denominator.max(), 1e-12)
+
+	scores = np.zeros(correlation.shape, np.float32)
+	scores[isValid] = np.clip(correlation[isValid] / denominator[isValid], -1, 1)
+	return scores
+
+def findMatches(scores, templateShape, nObjects=None, scoreThreshold=0.5, maxOverlap=0.25):
+	"""
+	Return the best matches of a score map, as a list of (column, row, score) of the template top-left corner, by decreasing score.
+	Overlapping matches are removed by non-maximum suppression.
+
+	Parameters
+	----------
+	scores : 2D numpy array
+		score map, see matchTemplate.
+
+	templateShape : tuple of int
+		height and width of the template, to compute the overlap between matches.
+
+	nObjects : int, optional
+		maximal number of matches. The default is None, ie all matches above the threshold.
+
+	scoreThreshold : float, optional
+		minimal score of the matches. The default is 0.5.
+
+	maxOverlap : float, optional
+		maximal intersection over union between the bounding boxes of 2 matches, in range [0;1]. The default is 0.25.
+	"""
+	if not 0 <= maxOverlap <= 1:
+		raise ValueError("maxOverlap must be in range [0;1].")
+
+	# Candidates : local maxima (3x3 neighbourhood) above the threshold
+	padded = np.pad(scores, 1, mode="constant", constant_values=-np.inf)
+	isPeak = scores >= scoreThreshold
+	for dy in (0, 1, 2):
+		for dx in (0, 1, 2):
+			if (dy, dx) != (1, 1):
+				isPeak &= scores >= padded[dy : dy + scores.shape[0], dx : dx + scores.shape[1]]
+
+	rows, columns = np.nonzero(isPeak)
+	peakScores = scores[rows, columns]
+	order = np.argsort(-peakScores, kind="stable")
+
+	candidates = [(float(peakScores[index]), int(rows[index]), int(columns[index])) for index in order]
+	return [(column, row, score) for score, row, column in _suppressNonMaxima(candidates, templateShape, nObjects, maxOverlap)]
+
+def _suppressNonMaxima(candidates, templateShape, nObjects, maxOverlap):
+	"""Greedy non-maximum suppression of candidate matches (score, row, column) sorted by decreasing score, all boxes having the template size."""
+	height, width = templateShape
+	area = height * width
+
+	matches = []
+	for score, row, column in candidates:
+
+		isOverlapping = False
+		for _, keptRow, keptColumn in matches:
+			intersection = max(height - abs(row - keptRow), 0) * max(width - abs(column - keptColumn), 0)
+			if intersection / (2*area - intersection) > maxOverlap:
+				isOverlapping = True
+				break
+
+		if not isOverlapping:
+			matches.append((score, row, column))
+			if nObjects is not None and len(matches) >= nObjects:
+				break
+
+	return matches
+
+
+class TemplateDetector(object):
+	"""
+	Detector of objects by template matching, usable with detection.detectObjects.
+	Called with an image, it returns a list of (x, y, score) with x,y the pixel coordinates of the center of each detected object.
+	"""
+
+	def __init__(self, template, scoreThreshold=0.5, nObjects=1, maxOverlap=0.25, binning=1, imageBinning=1):
+		"""
+		Parameters
+		----------
+		template : 2D numpy array
+			image of the object to detect, smaller than the images.
+
+		scoreThreshold : float, optional
+			minimal score of the detections, in range [-1;1]. The default is 0.5.
+
+		nObjects : int, optional
+			maximal number of detections per image, None for no limit. The default is 1.
+
+		maxOverlap : float, optional
+			maximal overlap (intersection over union) between the bounding boxes of 2 detections. The default is 0.25.
+
+		binning : int, optional
+			the matching is first done on images (and template) binned by this factor (1, 2 or 4), then refined at full resolution around each match. The default is 1, ie no binning.
+
+		imageBinning : int, optional
+			camera binning of the images relative to the template (1, 2 or 4), ex: 2 if the template was cropped from an image without binning and the images are acquired with setCameraBinning(2).
+			The template is binned accordingly. The default is 1.
+		"""
+		if binning not in (1,2,4) or imageBinning not in (1,2,4):
+			raise ValueError("Binning should be 1,2 or 4.")
+
+		self.template = binImage(template, imageBinning)
+		self.scoreThreshold = scoreThreshold
+		self.nObjects = nObjects
+		self.maxOverlap = maxOverlap
+		self.binning = binning
+		self._binnedTemplate = binImage(self.template, binning)
+
+	def __call__(self, image):
+		height, width = self.template.shape
+
+		if self.binning == 1:
+			matches = findMatches(matchTemplate(image, self.template), self.template.shape, self.nObjects, self.scoreThreshold, self.maxOverlap)
+			return [(column + width / 2, row + height / 2, score) for column, row, score in matches]
+
+		# Coarse matching on the binned image, with a lower threshold since binning smooths the scores
+		binnedScores = matchTemplate(binImage(image, self.binning), self._binnedTemplate)
+		coarseMatches = findMatches(binnedScores, self._binnedTemplate.shape, None, self.scoreThreshold * 0.8, self.maxOverlap)
+
+		# Refine each match at full resolution, in a window of +/- binning pixels around the coarse position
+		refined = []
+		margin = self.binning
+		for column, row, _ in coarseMatches:
+			top  = max(row * self.binning - margin, 0)
+			left = max(column * self.binning - margin, 0)
+			crop = image[top : top + height + 2*margin, left : left + width + 2*margin]
+
+			if crop.shape[0] < height or crop.shape[1] < width:
+				continue
+
+			scores = matchTemplate(crop, self.template)
+			bestRow, bestColumn = np.unravel_index(np.argmax(scores), scores.shape)
+			refined.append((float(scores[bestRow, bestColumn]), top + bestRow, left + bestColumn))
+
+		# Final selection on the full-resolution scores
+		refined = sorted((match for match in refined if match[0] >= self.scoreThreshold), reverse=True)
+		matches = _suppressNonMaxima(refined, self.template.shape, self.nObjects, self.maxOverlap)
+		return [(column + width / 2, row + height / 2, score) for score, row, column in matches]
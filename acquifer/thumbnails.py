@@ -0,0 +1,187 @@
+"""
+Cache of downsampled thumbnails of the images of a dataset, to display plate overviews without reading the full-resolution images.
+
+Each image is downsampled once into a pyramid of thumbnails (binned 2x, 4x, 8x, 16x by default), stored in a sidecar zip file next to the images (thumbnails.zip).
+The entries are keyed by image filename, which holds the metadata (well, channel, slice...) used to assemble the montages.
+The cache is updated incrementally : only the images not yet in the cache are processed, ex: while an acquisition is running.
+
+from acquifer.thumbnails import ThumbnailCache
+
+cache = ThumbnailCache(r"D:\IMAGING-DATA\IMAGES\20240117_152537_default")
+cache.update()
+montage = cache.getMontage(binning=16, channel=1)
+"""
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import naming, utils
+from .dataset import Dataset
+from .templatematching import binImage
+
+def getPyramid(image, levels=(2, 4, 8, 16)):
+	"""
+	Return a dictionary binning factor -> downsampled image, each level being computed from the previous one by 2x2 binning.
+	The thumbnails keep the data type of the image.
+	"""
+	for level in levels:
+		if level < 2 or level & (level-1):
+			raise ValueError("Pyramid levels must be powers of 2, >= 2.")
+
+	pyramid = {}
+	current, factor = np.asarray(image), 1
+	for level in sorted(levels):
+		while factor < level:
+			current = binImage(current, 2)
+			factor *= 2
+
+		pyramid[level] = np.rint(current).astype(image.dtype) if np.issubdtype(image.dtype, np.integer) else current.astype(image.dtype)
+
+	return pyramid
+
+
+class ThumbnailCache(object):
+	"""Sidecar zip file with the thumbnail pyramids of the images of a directory, entries are named <image filename>/<binning>.npy."""
+
+	def __init__(self, directory, cachePath=None, levels=(2, 4, 8, 16)):
+		"""
+		Parameters
+		----------
+		directory : str
+			directory with the IM images.
+
+		cachePath : str, optional
+			path of the zip file. The default is None, ie thumbnails.zip in the image directory.
+
+		levels : tuple of int, optional
+			binning factors of the thumbnails, powers of 2. The default is (2, 4, 8, 16).
+		"""
+		self.directory = directory
+		self.cachePath = os.path.join(directory, "thumbnails.zip") if cachePath is None else cachePath
+		self.levels = tuple(sorted(levels))
+		self._reader = None # zip file opened for reading, reopened after updates
+		self._cached = None # set of cached image filenames
+
+	def close(self):
+		if self._reader is not None:
+			self._reader.close()
+			self._reader = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _getReader(self):
+		if self._reader is None:
+			self._reader = zipfile.ZipFile(self.cachePath, "r")
+		return self._reader
+
+	@property
+	def filenames(self):
+		"""Set of image filenames with thumbnails in the cache."""
+		if self._cached is None:
+			if os.path.exists(self.cachePath):
+				self._cached = {name.rsplit("/", 1)[0] for name in self._getReader().namelist()}
+			else:
+				self._cached = set()
+
+		return self._cached
+
+	def __contains__(self, filename):
+		return filename in self.filenames
+
+	def __len__(self):
+		return len(self.filenames)
+
+	def _computePyramid(self, filename, reader):
+		return filename, getPyramid(reader(os.path.join(self.directory, filename)), self.levels)
+
+	def update(self, nWorkers=None, reader=utils.readImage):
+		"""
+		Add the thumbnails of the images of the directory not yet in the cache, and return the number of images added.
+		The images are read and downsampled in a pool of threads, the thumbnails are appended to the zip file.
+
+		Parameters
+		----------
+		nWorkers : int, optional
+			number of threads. The default is None, ie the default of ThreadPoolExecutor.
+
+		reader : callable, optional
+			function reading an image file as a 2D numpy array. The default is utils.readImage (requires tifffile).
+		"""
+		newFilenames = [filename for filename in Dataset(self.directory).filenames if filename not in self.filenames]
+		if not newFilenames:
+			return 0
+
+		self.close()
+		with ThreadPoolExecutor(nWorkers) as executor, zipfile.ZipFile(self.cachePath, "a", zipfile.ZIP_DEFLATED, compresslevel=1) as cacheFile:
+			for filename, pyramid in utils.mapBounded(executor, lambda filename: self._computePyramid(filename, reader), newFilenames, 2 * nWorkers if nWorkers else None):
+
+				for level, thumbnail in pyramid.items():
+					buffer = io.BytesIO()
+					np.save(buffer, thumbnail)
+					cacheFile.writestr("{}/{}.npy".format(filename, level), buffer.getvalue())
+
+				self._cached.add(filename)
+
+		return len(newFilenames)
+
+	def getThumbnail(self, filename, binning=8):
+		"""Return the thumbnail of an image for a binning factor (one of the cache levels)."""
+		if binning not in self.levels:
+			raise ValueError("Binning must be one of the cache levels {}.".format(self.levels))
+
+		if filename not in self:
+			raise KeyError("No thumbnail for {}, call update first.".format(filename))
+
+		with self._getReader().open("{}/{}.npy".format(filename, binning)) as entry:
+			return np.load(io.BytesIO(entry.read()))
+
+	def getMontage(self, binning=8, channel=1, zSlice=1, timepoint=1, subposition=1, nRows=None, nColumns=None, spacing=0):
+		"""
+		Return a plate montage with the thumbnail of each well at its plate row/column, for the given channel, slice, timepoint and subposition.
+		Wells without image are left empty (0).
+
+		Parameters
+		----------
+		binning : int, optional
+			binning factor of the thumbnails, one of the cache levels. The default is 8.
+
+		channel, zSlice, timepoint, subposition : int, optional
+			image to show for each well. The default is 1 for each.
+
+		nRows, nColumns : int, optional
+			plate dimensions. The default is None, ie the last row/column with images.
+
+		spacing : int, optional
+			number of empty pixels between wells. The default is 0.
+		"""
+		filenames = sorted(self.filenames)
+		values = naming.decodeArray(filenames, ["channel", "zSlice", "timepoint", "subposition", "row", "column"])
+		isSelected = (values["channel"] == channel) & (values["zSlice"] == zSlice) & (values["timepoint"] == timepoint) & (values["subposition"] == subposition)
+
+		if not np.any(isSelected):
+			raise ValueError("No cached thumbnail for channel {}, slice {}, timepoint {}, subposition {}.".format(channel, zSlice, timepoint, subposition))
+
+		filenames = [filename for filename, selected in zip(filenames, isSelected) if selected]
+		rows = values["row"][isSelected].tolist()
+		columns = values["column"][isSelected].tolist()
+		nRows = max(rows) if nRows is None else nRows
+		nColumns = max(columns) if nColumns is None else nColumns
+
+		thumbnails = [self.getThumbnail(filename, binning) for filename in filenames]
+		height = max(thumbnail.shape[0] for thumbnail in thumbnails)
+		width  = max(thumbnail.shape[1] for thumbnail in thumbnails)
+
+		montage = np.zeros((nRows * (height + spacing) - spacing, nColumns * (width + spacing) - spacing), thumbnails[0].dtype)
+		for row, column, thumbnail in zip(rows, columns, thumbnails):
+			if row > nRows or column > nColumns:
+				continue
+
+			top, left = (row-1) * (height + spacing), (column-1) * (width + spacing)
+			montage[top : top + thumbnail.shape[0], left : left + thumbnail.shape[1]] = thumbnail
+
+		return montage
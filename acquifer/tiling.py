@@ -0,0 +1,157 @@
+"""
+Generate tiled subpositions to image specimens larger than the camera field of view.
+
+The tiles cover a well, or a region of interest in objective coordinates (mm), with a given overlap between neighbouring tiles.
+They are ordered in a snake pattern (alternating direction for each row of tiles) to minimize the travel of the objective,
+and returned as a WellPositionSet with one subposition per tile, ready to be used with TcpIp.iterWellPositions or WellPositionSet.toScript.
+
+from acquifer import tiling
+from acquifer.plates import PlateGeometry
+
+plate = PlateGeometry(96)
+tiles = tiling.tileWells(plate, ["A001", "A002"], magnification=4, overlap=0.1)
+"""
+import math
+import numpy as np
+from . import metadata
+from .positions import WellPositionSet
+
+sensorPixelSize_um = 6.5 # physical pixel size of the IM camera sensor
+sensorSize = 2048        # number of pixels along each axis of the camera sensor
+
+def getPixelSize_um(magnification, binning=1):
+	"""Return the pixel size in the image (in µm) for an objective magnification (one of the keys of metadata.magToNA) and a camera binning factor."""
+	if magnification not in metadata.magToNA:
+		raise ValueError("Magnification must be one of {}.".format(sorted(metadata.magToNA)))
+
+	if binning not in (1,2,4):
+		raise ValueError("Binning should be 1,2 or 4.")
+
+	return sensorPixelSize_um * binning / magnification
+
+def getFieldOfView_mm(magnification, width=sensorSize, height=sensorSize):
+	"""
+	Return the width and height (mm) of the field of view, for an objective magnification and a camera region of interest.
+
+	Parameters
+	----------
+	magnification : int
+		objective magnification, one of the keys of metadata.magToNA.
+
+	width, height : int, optional
+		size of the camera region of interest, in the coordinate system of the camera sensor (when no binning) as for TcpIp.setCamera. The default is the full sensor.
+	"""
+	for value in (width, height):
+		if not isinstance(value, int) or value < 1 or value > sensorSize:
+			raise ValueError("width, height must be integer values in range [1;{}].".format(sensorSize))
+
+	pixelSize_mm = getPixelSize_um(magnification) / 1000
+	return width * pixelSize_mm, height * pixelSize_mm
+
+def _getTileCenters(start, stop, fieldOfView, step):
+	"""Return the tile centers covering [start, stop] along one axis, the grid is centered on the interval."""
+	length = stop - start
+	nTiles = 1 if length <= fieldOfView else math.ceil((length - fieldOfView) / step - 1e-9) + 1
+	center = (start + stop) / 2
+	return center + (np.arange(nTiles) - (nTiles-1) / 2) * step
+
+def getTileGrid(xmin, ymin, xmax, ymax, magnification, width=sensorSize, height=sensorSize, binning=1, overlap=0.1):
+	"""
+	Return the objective coordinates (mm) of tiles covering a rectangular region, as 2 arrays x, y in snake order.
+	The tiles are arranged in rows along x, successive rows are acquired in alternating directions.
+
+	Parameters
+	----------
+	xmin, ymin, xmax, ymax : float
+		limits of the region to cover, in objective coordinates (mm).
+
+	magnification : int
+		objective magnification, one of the keys of metadata.magToNA.
+
+	width, height : int, optional
+		size of the camera region of interest (sensor pixels, without binning). The default is the full sensor (2048).
+
+	binning : int, optional
+		camera binning factor (1,2,4). The step between tiles is rounded to a whole number of (binned) image pixels, so that the tiles align on a common pixel grid.
+
+	overlap : float, optional
+		minimal overlap between neighbouring tiles, as a fraction of the field of view in range [0;1[. The default is 0.1 (10%).
+	"""
+	if xmax < xmin or ymax < ymin:
+		raise ValueError("The region limits must verify xmin <= xmax and ymin <= ymax.")
+
+	if not 0 <= overlap < 1:
+		raise ValueError("Overlap must be in range [0;1[.")
+
+	fieldX, fieldY = getFieldOfView_mm(magnification, width, height)
+	pixelSize_mm = getPixelSize_um(magnification, binning) / 1000
+
+	# Step between tiles, as a whole number of pixels, rounded down to keep at least the requested overlap
+	stepX = max(math.floor(fieldX * (1 - overlap) / pixelSize_mm), 1) * pixelSize_mm
+	stepY = max(math.floor(fieldY * (1 - overlap) / pixelSize_mm), 1) * pixelSize_mm
+
+	centersX = _getTileCenters(xmin, xmax, fieldX, stepX)
+	centersY = _getTileCenters(ymin, ymax, fieldY, stepY)
+
+	gridX, gridY = np.meshgrid(centersX, centersY) # one row of tiles per y
+	gridX[1::2] = gridX[1::2, ::-1].copy()        # snake : reverse every second row
+	return gridX.ravel(), gridY.ravel()
+
+def tileRegion(wellID, xmin, ymin, xmax, ymax, magnification, width=sensorSize, height=sensorSize, binning=1, overlap=0.1, z=np.nan):
+	"""
+	Return a WellPositionSet with tiles covering a rectangular region of interest (objective coordinates in mm) within a well.
+	The tiles are numbered as subpositions 1,2,3... in snake order. See getTileGrid for the parameters.
+	"""
+	x, y = getTileGrid(xmin, ymin, xmax, ymax, magnification, width, height, binning, overlap)
+
+	if len(x) > 99:
+		raise ValueError("The region requires {} tiles, the maximal number of subpositions is 99 : use a lower magnification or overlap.".format(len(x)))
+
+	return WellPositionSet.fromWellIDs(np.full(len(x), wellID.upper()), x, y, np.arange(1, len(x)+1), z)
+
+def tileWell(plateGeometry, wellID, magnification, width=sensorSize, height=sensorSize, binning=1, overlap=0.1, margin=0.0, z=np.nan):
+	"""
+	Return a WellPositionSet with tiles covering a whole well, numbered as subpositions 1,2,3... in snake order.
+	For round wells, the tiles which do not intersect the well are skipped.
+
+	Parameters
+	----------
+	plateGeometry : plates.PlateGeometry
+		geometry of the plate, giving the well centers and the well size.
+
+	wellID : str
+		well to cover, ex: "A001".
+
+	margin : float, optional
+		distance in mm added around the well, ex: to cover the well edges despite positioning errors. The default is 0.
+
+	See getTileGrid for the other parameters.
+	"""
+	x, y = plateGeometry.getWellCenters([wellID])
+	centerX, centerY = float(x[0]), float(y[0])
+	halfSize = plateGeometry.format.wellSize / 2 + margin
+
+	tilesX, tilesY = getTileGrid(centerX - halfSize, centerY - halfSize, centerX + halfSize, centerY + halfSize,
+								 magnification, width, height, binning, overlap)
+
+	if plateGeometry.format.wellShape == "round":
+
+		# Keep tiles whose field of view intersects the well disk : distance from the well center to the tile rectangle < radius
+		fieldX, fieldY = getFieldOfView_mm(magnification, width, height)
+		dx = np.maximum(np.abs(tilesX - centerX) - fieldX / 2, 0)
+		dy = np.maximum(np.abs(tilesY - centerY) - fieldY / 2, 0)
+		isInWell = dx**2 + dy**2 < halfSize**2
+		tilesX, tilesY = tilesX[isInWell], tilesY[isInWell]
+
+	if len(tilesX) > 99:
+		raise ValueError("The well requires {} tiles, the maximal number of subpositions is 99 : use a lower magnification or overlap.".format(len(tilesX)))
+
+	return WellPositionSet.fromWellIDs(np.full(len(tilesX), wellID.upper()), tilesX, tilesY, np.arange(1, len(tilesX)+1), z)
+
+def tileWells(plateGeometry, wellIDs, magnification, width=sensorSize, height=sensorSize, binning=1, overlap=0.1, margin=0.0, z=np.nan):
+	"""
+	Return a WellPositionSet with the tiles of several wells (see tileWell).
+	The wells are visited in the IM acquisition order (snake pattern over the plate), and numbered by order of acquisition.
+	"""
+	wellOrder = plateGeometry.getPositions(wellIDs).wellIDs.tolist()
+	return WellPositionSet.concatenate([tileWell(plateGeometry, wellID, magnification, width, height, binning, overlap, margin, z) for wellID in wellOrder])
@@ -3,12 +3,27 @@ This module provides a set of utility functions when working with IM datasets.
 It includes loading IM datasets as multi-dimensional array in python...
 """
 import os
+from collections import deque
 import numpy as np
+from . import plates
 
-def checkWellID(wellID:str):
+def _getPlateLimits(plateFormat):
+	"""Return the number of rows and columns for a plate format, the default (None) is the 384 plate format."""
+	plateFormat = plates.getPlateFormat(384 if plateFormat is None else plateFormat)
+	return plateFormat.nRows, plateFormat.nColumns
+
+def checkWellID(wellID:str, plateFormat=None):
 	"""
 	Raise a ValueError if the wellID is not a 4-character string starting with a capital letter in range A-P, followed by 3 numbers for the plate column.
 	The plate column shouldbe in range (1-24) corresponding to the 384 plate format.
+	
+	Parameters
+	----------
+	plateFormat : int or plates.PlateFormat, optional
+		check the row and column ranges for this plate format instead, ex: 96 for rows A-H and columns 1-12.
+		For the 1536 format, rows after Z are labelled AA-AF followed by a 2-digit column, ex: "AF48".
+		The default is None, ie the 384 plate format.
+	
 	Return
 	------
 	The wellID if it passes the checks
@@ -20,15 +35,142 @@ def checkWellID(wellID:str):
 	if len(wellID) != 4:
 		raise ValueError(error)
 	
-	asciiValueRow = ord(wellID[0])
-	if asciiValueRow < 65 or asciiValueRow > 80 :
-		raise ValueError("WellID should start with a capital letter in range A-P.")
+	nRows, nColumns = _getPlateLimits(plateFormat)
+	lastRow = plates.getRowLabel(nRows)
+	
+	nLetters = 2 if (nRows > 26 and wellID[1].isalpha()) else 1
+	rowLabel = wellID[:nLetters]
+	
+	if not all(65 <= ord(char) <= 90 for char in rowLabel):
+		raise ValueError("WellID should start with a capital letter in range A-{}.".format(lastRow))
+	
+	row = sum((ord(char) - 64) * 26**(nLetters - 1 - index) for index, char in enumerate(rowLabel))
+	if row > nRows:
+		raise ValueError("WellID should start with a capital letter in range A-{}.".format(lastRow))
+	
+	if not wellID[nLetters:].isdecimal():
+		raise ValueError("The WellID should start with a capital letter in range A-{}, followed by {} numbers.".format(lastRow, 4 - nLetters))
+	
+	column = int(wellID[nLetters:])
+	if column < 1 or column > nColumns:
+		raise ValueError("Plate column {} out of range [1-{}]".format(column, nColumns))
+	
+	return wellID
+
+
+def checkWellIDs(wellIDs, plateFormat=None):
+	"""
+	Vectorized version of checkWellID, for a list or array of well IDs (ex: ["A001", "B012"]).
+	Raise a ValueError if any of the well IDs is not a 4-character string starting with a capital letter in range A-P, followed by 3 numbers for the plate column in range (1-24).
+	Use plateFormat to check the ranges of another plate format, see checkWellID.
+	
+	Return
+	------
+	rows, columns : numpy arrays of int16
+		the plate row (1 for A) and plate column (starting at 1) for each well ID.
+	"""
+	wellIDs = np.asarray(wellIDs)
+	
+	if wellIDs.dtype.kind not in ("U", "S"):
+		raise TypeError("WellIDs should be strings, in the form 'A001'")
+	
+	wellIDs = wellIDs.ravel()
+	if wellIDs.size == 0:
+		return np.empty(0, np.int16), np.empty(0, np.int16)
+	
+	if np.any(np.char.str_len(wellIDs) != 4):
+		raise ValueError("WellID should be a 4-character string, in the form 'A001'")
+	
+	try:
+		codes = wellIDs.astype("S4").view(np.uint8).reshape(-1, 4).astype(np.int16) # ascii code of each character
+	except UnicodeEncodeError:
+		raise ValueError("WellID should only contain ascii characters, in the form 'A001'")
+	
+	nRows, nColumns = _getPlateLimits(plateFormat)
+	lastRow = plates.getRowLabel(nRows)
+	
+	isLetter = (codes >= 65) & (codes <= 90) # 65 is A, 90 is Z
+	hasTwoLetters = isLetter[:,1] if nRows > 26 else np.zeros(len(codes), bool)
+	
+	rows = np.where(hasTwoLetters, (codes[:,0] - 64) * 26 + codes[:,1] - 64, codes[:,0] - 64).astype(np.int16)
+	if np.any(~isLetter[:,0] | (rows > nRows)):
+		raise ValueError("WellID should start with a capital letter in range A-{}.".format(lastRow))
 	
-	if not wellID[1:].isdecimal():
-		raise ValueError("The WellID should start with a capital letter in range A-P, followed by 3 numbers.")
+	digits = codes[:,1:] - 48 # 48 is 0
+	digits[hasTwoLetters, 0] = 0
+	if np.any((digits < 0) | (digits > 9)):
+		raise ValueError("The WellID should start with a capital letter in range A-{}, followed by numbers.".format(lastRow))
+	
+	columns = (digits @ np.array([100, 10, 1], np.int16)).astype(np.int16)
+	if np.any((columns < 1) | (columns > nColumns)):
+		raise ValueError("Plate column out of range [1-{}]".format(nColumns))
+	
+	return rows, columns
+
+def getWellIDs(rows, columns):
+	"""
+	Return an array of well IDs (ex: 'A001') from arrays of plate rows and columns (starting at 1).
+	Rows after Z are labelled AA, AB... followed by a 2-digit column, see plates.getWellID.
+	"""
+	rows = np.asarray(rows).astype(np.int64)
+	columns = np.asarray(columns)
+	
+	if np.all(rows <= 26): # fast path, single letter rows
+		letters = (rows + 64).astype(np.uint8).view("S1").astype("U1")
+		return np.char.add(letters, np.char.zfill(columns.astype("U3"), 3))
+	
+	return np.array([plates.getWellID(row, column) for row, column in zip(rows.tolist(), columns.tolist())], dtype="U4")
+
+def readImage(path):
+	"""
+	Read an image file (ex: a TIFF from an IM dataset) as a numpy array.
+	This requires the tifffile package (pip install tifffile).
+	"""
+	try:
+		import tifffile
+	except ImportError:
+		raise ImportError("Reading images requires the tifffile package : pip install tifffile")
+	
+	return tifffile.imread(path)
+
+def writeImage(path, image):
+	"""
+	Write a numpy array as a TIFF image.
+	This requires the tifffile package (pip install tifffile).
+	"""
+	try:
+		import tifffile
+	except ImportError:
+		raise ImportError("Writing images requires the tifffile package : pip install tifffile")
+	
+	tifffile.imwrite(path, image)
+
+def mapBounded(executor, function, iterable, nPending=None):
+	"""
+	Like executor.map, but with at most nPending calls submitted and not yet consumed, so that the results (ex: images) do not pile up in memory
+	when they are consumed slower than they are computed. The results are yielded in the order of the iterable.
+	
+	Parameters
+	----------
+	executor : concurrent.futures.Executor
+		pool running the calls.
+	
+	function : callable
+		function called with each item of the iterable.
+	
+	iterable : iterable
+		arguments of the calls.
+	
+	nPending : int, optional
+		maximal number of pending calls. The default is None, ie twice the number of CPUs.
+	"""
+	nPending = nPending or 2 * (os.cpu_count() or 1)
+	futures = deque()
 	
-	column = int(wellID[1:])
-	if column < 1 or column > 24:
-		raise ValueError("Plate column {} out of range [1-24]".format(column))
+	for item in iterable:
+		if len(futures) >= nPending:
+			yield futures.popleft().result()
+		futures.append(executor.submit(function, item))
 	
-	return wellID
\ No newline at end of file
+	while futures:
+		yield futures.popleft().result()
@@ -0,0 +1,217 @@
+"""
+Benchmark suite for the acquifer package.
+
+The benchmarks do not need an IM : the tcpip benchmarks run against a local IM simulator (acquifer.simulator).
+Results are written as json, to compare the performance between releases.
+
+Usage, from the root of the repository :
+python benchmarks/run_benchmarks.py --output bench_output.json
+
+Benchmarks
+- metadata_parsing : number of filenames parsed per second, with all the getters of acquifer.metadata
+- filename_decoding : number of filenames decoded per second (all metadata) with the vectorized naming.decodeArray, and encoded per second with naming.encodeArray
+- import_time : time for "import acquifer" in a fresh python process
+- tcpip_round_trips : number of command round trips per second with TcpIp
+- plate_acquisition : time to acquire a full plate (move + acquire per well) with TcpIp
+- script_rewrite : time to replace N positions in a .imsf script (requires pythonnet, skipped otherwise)
+- script_rewrite_python : same as script_rewrite, with the pure python WellPositionSet.toScript
+- template_matching : time to detect objects in a 2048x2048 image with templatematching.TemplateDetector, for binning 1, 2 and 4
+"""
+import os, sys, time, json, argparse, platform, statistics, subprocess, tempfile, shutil
+import numpy as np
+
+repositoryDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repositoryDir) # benchmark the repository version, not an installed one
+
+import acquifer
+from acquifer import metadata, naming, WellPosition, WellPositionSet
+from acquifer.templatematching import TemplateDetector
+from acquifer.simulator import ImSimulatorServer
+from acquifer.tcpip import TcpIp
+
+exampleScript = os.path.join(repositoryDir, "examples", "prescreen_rescreen", "4X-script.imsf")
+
+def makeFilenames(n):
+	"""Return a list of n distinct IM filenames."""
+	template = "-{}{:03d}--PO{:02d}--LO001--CO{}--SL{:03d}--PX32500--PW0080--IN0020--TM244--X014580--Y011262--Z209501--T{:010d}--WE{:05d}.tif"
+	return [template.format(chr(65 + i % 16), 1 + i % 24, 1 + i % 9, 1 + i % 6, 1 + i % 100, i, 1 + i % 384) for i in range(n)]
+
+def timeRepeated(function, repeat):
+	"""Call function repeat times and return the list of durations in seconds."""
+	durations = []
+	for _ in range(repeat):
+		t0 = time.perf_counter()
+		function()
+		durations.append(time.perf_counter() - t0)
+	return durations
+
+def summarize(durations, **extra):
+	"""Return a result dictionary with statistics over the durations (seconds)."""
+	result = {"repeat"   : len(durations),
+			  "median_s" : statistics.median(durations),
+			  "min_s"    : min(durations),
+			  "max_s"    : max(durations)}
+	result.update(extra)
+	return result
+
+def benchmarkMetadataParsing(nFilenames, repeat):
+	filenames = makeFilenames(nFilenames)
+	getters = (metadata.getWellId, metadata.getWellRow, metadata.getWellColumn, metadata.getWellSubPosition,
+			   metadata.getWellIndex, metadata.getTimepoint, metadata.getChannelIndex, metadata.getZSlice,
+			   metadata.getPixelSize_um, metadata.getLightPower, metadata.getExposure, metadata.getTemperature,
+			   metadata.getPositionXY_mm, metadata.getPositionZ_um, metadata.getTime)
+
+	def parseAll():
+		for filename in filenames:
+			for getter in getters:
+				getter(filename)
+
+	durations = timeRepeated(parseAll, repeat)
+	return summarize(durations,
+					 nFilenames = nFilenames,
+					 filenamesPerSecond = nFilenames / statistics.median(durations))
+
+def benchmarkFilenameDecoding(nFilenames, repeat):
+	filenames = makeFilenames(nFilenames)
+	decodeDurations = timeRepeated(lambda: naming.decodeArray(filenames), repeat)
+
+	values = naming.decodeArray(filenames)
+	del values["row"], values["column"]
+	encodeDurations = timeRepeated(lambda: naming.encodeArray(**values), repeat)
+
+	return summarize(decodeDurations,
+					 nFilenames = nFilenames,
+					 filenamesPerSecond = nFilenames / statistics.median(decodeDurations),
+					 encodedFilenamesPerSecond = nFilenames / statistics.median(encodeDurations))
+
+def benchmarkImportTime(repeat):
+	code = "import time; t0 = time.perf_counter(); import acquifer; print(time.perf_counter() - t0)"
+	durations = []
+	for _ in range(repeat):
+		output = subprocess.check_output([sys.executable, "-c", code], cwd=repositoryDir)
+		durations.append(float(output.decode().strip()))
+	return summarize(durations)
+
+def benchmarkRoundTrips(nCommands, repeat):
+	with ImSimulatorServer() as server:
+		im = TcpIp(port=server.port, host=server.host)
+
+		def getPositions():
+			for _ in range(nCommands):
+				im.getPositionX()
+
+		durations = timeRepeated(getPositions, repeat)
+
+	return summarize(durations,
+					 nCommands = nCommands,
+					 roundTripsPerSecond = nCommands / statistics.median(durations))
+
+def benchmarkPlateAcquisition(nColumns, nRows, repeat):
+	positions = [WellPosition("{}{:03d}".format(chr(65 + row), column + 1), 14.160 + 9*column, 11.287 + 9*row)
+				 for row in range(nRows) for column in range(nColumns)]
+
+	with ImSimulatorServer() as server:
+		im = TcpIp(port=server.port, host=server.host)
+		im.setMode("script")
+
+		def acquirePlate():
+			for position in positions:
+				im.moveXYtoWellPosition(position)
+				im.acquire(1, 1, "bf", 4, 30, 20, 21500.1, 1, 2.7)
+
+		durations = timeRepeated(acquirePlate, repeat)
+
+	return summarize(durations,
+					 nWells = len(positions),
+					 wellsPerSecond = len(positions) / statistics.median(durations))
+
+def benchmarkScriptRewrite(nPositions, repeat):
+	try:
+		from acquifer import scripts
+		from ScriptUtils import WellInfo
+
+	except Exception as error: # pythonnet or the .NET runtime is not available
+		return {"skipped" : "acquifer.scripts not available : {}".format(error)}
+
+	listPositions = [WellInfo("{}{:03d}".format(chr(65 + (i // 24) % 16), 1 + i % 24), 10 + (i % 24), 10 + (i // 24) % 16, 21500.1, i+1)
+					 for i in range(nPositions)]
+
+	directory = tempfile.mkdtemp()
+	try:
+		script = shutil.copy(exampleScript, os.path.join(directory, "script.imsf"))
+		durations = timeRepeated(lambda: scripts.replacePositionsInScriptFile(script, listPositions), repeat)
+
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+	return summarize(durations,
+					 nPositions = nPositions,
+					 positionsPerSecond = nPositions / statistics.median(durations))
+
+def benchmarkScriptRewritePython(nPositions, repeat):
+	indexes = np.arange(nPositions)
+	positions = WellPositionSet(1 + (indexes // 24) % 16, 1 + indexes % 24, 10 + indexes % 24, 10 + (indexes // 24) % 16, z=21500.1)
+
+	directory = tempfile.mkdtemp()
+	try:
+		script = os.path.join(directory, "script_updated.imsf")
+		durations = timeRepeated(lambda: positions.toScript(exampleScript, script), repeat)
+
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+	return summarize(durations,
+					 nPositions = nPositions,
+					 positionsPerSecond = nPositions / statistics.median(durations))
+
+def benchmarkTemplateMatching(imageSize, repeat):
+	rng = np.random.default_rng(0)
+	image = rng.normal(1000, 50, (imageSize, imageSize)).astype(np.uint16)
+	template = image[500:628, 700:828].copy()
+
+	result = {"imageSize" : imageSize}
+	for binning in (1, 2, 4):
+		detector = TemplateDetector(template, nObjects=3, binning=binning)
+		result["binning{}_median_s".format(binning)] = statistics.median(timeRepeated(lambda: detector(image), repeat))
+
+	return result
+
+def runBenchmarks(quick=False):
+	"""Run all benchmarks and return the results as a dictionary."""
+	repeat = 3 if quick else 5
+
+	benchmarks = {"metadata_parsing"  : lambda: benchmarkMetadataParsing(10000 if quick else 100000, repeat),
+				  "filename_decoding" : lambda: benchmarkFilenameDecoding(10000 if quick else 100000, repeat),
+				  "import_time"       : lambda: benchmarkImportTime(repeat),
+				  "tcpip_round_trips" : lambda: benchmarkRoundTrips(20 if quick else 100, repeat),
+				  "plate_acquisition" : lambda: benchmarkPlateAcquisition(3 if quick else 12, 2 if quick else 8, 1 if quick else repeat),
+				  "script_rewrite"    : lambda: benchmarkScriptRewrite(384 if quick else 10000, repeat),
+				  "script_rewrite_python" : lambda: benchmarkScriptRewritePython(384 if quick else 10000, repeat),
+				  "template_matching" : lambda: benchmarkTemplateMatching(1024 if quick else 2048, repeat)}
+
+	results = {}
+	for name, benchmark in benchmarks.items():
+		print("Running {}...".format(name))
+		results[name] = benchmark()
+
+	return {"acquiferVersion" : acquifer.__version__,
+			"python"          : platform.python_version(),
+			"platform"        : platform.platform(),
+			"timestamp"       : time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"quick"           : quick,
+			"results"         : results}
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Run the acquifer benchmarks and report the results as json.")
+	parser.add_argument("--output", help="path of the output json file, printed to the console if not specified")
+	parser.add_argument("--quick", action="store_true", help="run smaller benchmarks, for a quick check")
+	arguments = parser.parse_args()
+
+	report = json.dumps(runBenchmarks(arguments.quick), indent=2)
+
+	if arguments.output:
+		with open(arguments.output, "w") as jsonFile:
+			jsonFile.write(report)
+	else:
+		print(report)
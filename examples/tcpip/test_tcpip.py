@@ -18,8 +18,8 @@ im.setPlateId("test_{}_mode".format(mode))
 objectiveIndex = 2 # 2 = 4X
 
 #%% Run autofocus on Brightfield
-im.setCamera(256, 256, 512, 512) # Use ROI for autofocus
-zFocus = im.runSoftwareAutoFocus(objectiveIndex, "bf", 2, 50, 100, 200, 10, 10)
+im.resetCamera() # camera settings restored after the autofocus
+zFocus = im.runSoftwareAutoFocus(objectiveIndex, "bf", 2, 50, 100, 200, 10, 10, camera="auto") # centred ROI with binning for the autofocus only
 
 #%% Acquire an image
 #print("Set Metadata")
@@ -34,7 +34,6 @@ im.setMetadataWellNumber(3)
 im.setMetadataWellId("B001")
 im.setMetadataTimepoint(2)
 
-im.resetCamera()
 im.acquire(1, objectiveIndex, "001000", 3, 80, 120, zFocus, 10, 5)
 
 